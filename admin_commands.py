@@ -4,6 +4,7 @@
 """
 
 import logging
+import time
 from datetime import datetime, timedelta
 from typing import Optional
 import io
@@ -13,6 +14,8 @@ from aiogram import Router, Bot
 from aiogram.filters import Command
 from aiogram.types import Message, BufferedInputFile
 
+from subscription_cache import subscription_cache
+
 logger = logging.getLogger(__name__)
 
 # Создаем роутер для административных команд
@@ -39,8 +42,8 @@ async def export_users_command(message: Message):
     try:
         await message.answer("📊 Подготавливаю файл с ID пользователей...")
         
-        # Получаем список всех пользователей
-        async with admin_router.db.acquire() as conn:
+        # Получаем список всех пользователей (читающее соединение не блокирует писателя)
+        async with admin_router.db.acquire(readonly=True) as conn:
             cursor = await conn.execute("""
                 SELECT id, username, join_date, last_active, source
                 FROM users
@@ -171,9 +174,10 @@ async def gift_subscription_command(message: Message):
             
             # Сохраняем подписку
             await conn.execute(
-                "INSERT OR REPLACE INTO subscriptions (user_id, expires_at) VALUES (?, ?)",
-                (user_id, new_expires.isoformat())
+                "INSERT OR REPLACE INTO subscriptions (user_id, expires_at, expires_at_ts) VALUES (?, ?, ?)",
+                (user_id, new_expires.isoformat(), int(new_expires.timestamp()))
             )
+        subscription_cache.invalidate(user_id)
         
         # Отправляем уведомление админу
         await message.answer(
@@ -216,91 +220,91 @@ async def gift_subscription_command(message: Message):
 @admin_router.message(Command("db_clean"))
 async def clean_database_command(message: Message):
     """
-    Очищает контекст всех пользователей в БД для снижения нагрузки.
+    Очищает контекст всех пользователей и старые данные в БД для снижения нагрузки.
     Сохраняет пользователей и их настройки, но удаляет историю диалогов.
+    Удаление идёт небольшими пачками в фоне, бот при этом продолжает отвечать.
+    Формат: /db_clean [vacuum] - с vacuum дополнительно выполняется полный VACUUM
+    (блокирует бота, переводит базу в режим инкрементального VACUUM)
     """
     # Проверяем права доступа
     if not is_admin(message.from_user.id):
         await message.answer("❌ У вас нет доступа к этой команде")
         return
     
+    maintenance = admin_router.db.maintenance
+    full_vacuum = 'vacuum' in (message.text or '').split()[1:]
     try:
-        await message.answer("🧹 Начинаю очистку базы данных...")
+        status = await message.answer("🧹 Начинаю очистку базы данных...")
         
-        async with admin_router.db.acquire() as conn:
-            # Подсчитываем сколько контекста будет очищено
-            cursor = await conn.execute("""
-                SELECT COUNT(*) as count
-                FROM users
-                WHERE context IS NOT NULL AND context != '[]'
-            """)
-            row = await cursor.fetchone()
-            contexts_to_clean = row['count'] if row else 0
-            
-            # Подсчитываем количество сообщений для удаления (старше 7 дней)
-            cursor = await conn.execute("""
-                SELECT COUNT(*) as count
-                FROM messages
-                WHERE datetime(ts) < datetime('now', '-7 days')
-            """)
-            row = await cursor.fetchone()
-            messages_to_delete = row['count'] if row else 0
-            
-            # Очищаем контексты всех пользователей
-            await conn.execute("""
-                UPDATE users
-                SET context = '[]'
-                WHERE context IS NOT NULL AND context != '[]'
-            """)
-            
-            # Удаляем старые сообщения (старше 7 дней)
-            await conn.execute("""
-                DELETE FROM messages
-                WHERE datetime(ts) < datetime('now', '-7 days')
-            """)
-            
-            # Очищаем старые записи daily_messages (старше 30 дней)
-            await conn.execute("""
-                DELETE FROM daily_messages
-                WHERE date < date('now', '-30 days')
-            """)
-            
-            # Очищаем старые записи monthly_images (старше 3 месяцев)
-            await conn.execute("""
-                DELETE FROM monthly_images
-                WHERE datetime(month || '-01') < datetime('now', '-3 months')
-            """)
-            
-            # Оптимизируем базу данных
-            await conn.execute("VACUUM")
-            await conn.execute("ANALYZE")
-            
-            # Получаем размер БД после очистки
-            cursor = await conn.execute("SELECT page_count * page_size as size FROM pragma_page_count(), pragma_page_size()")
-            row = await cursor.fetchone()
-            db_size_bytes = row['size'] if row else 0
-            db_size_mb = db_size_bytes / (1024 * 1024)
+        # Прогресс обновляем не чаще раза в 2 секунды (лимиты Telegram на редактирование)
+        last_update = 0.0
+        stage_names = {
+            'contexts': 'контексты', 'messages': 'сообщения',
+            'daily_messages': 'дневные лимиты', 'monthly_images': 'лимиты изображений',
+            'vacuum': 'освобождено страниц',
+        }
+        
+        async def progress(stage: str, done: int):
+            nonlocal last_update
+            if time.monotonic() - last_update < 2:
+                return
+            last_update = time.monotonic()
+            try:
+                await status.edit_text(f"🧹 Очистка: {stage_names.get(stage, stage)} - {done}...")
+            except Exception:
+                pass
+        
+        contexts_cleaned = await maintenance.clear_contexts(progress)
+        retention = await maintenance.run_retention(progress)
+        freed_pages = await maintenance.incremental_vacuum(progress=progress)
+        if full_vacuum:
+            await status.edit_text("🧹 Выполняю полный VACUUM, бот может не отвечать...")
+            await maintenance.full_vacuum()
+        await maintenance.optimize()
+        db_size_mb = await maintenance.database_size() / (1024 * 1024)
         
         # Отправляем отчет
         report = (
             "✅ **Очистка базы данных завершена!**\n\n"
-            f"🔹 Очищено контекстов: {contexts_to_clean}\n"
-            f"🔹 Удалено старых сообщений: {messages_to_delete}\n"
+            f"🔹 Очищено контекстов: {contexts_cleaned}\n"
+            f"🔹 Удалено старых сообщений: {retention['messages']}\n"
+            f"🔹 Удалено дневных/месячных счётчиков: {retention['daily_messages']}/{retention['monthly_images']}\n"
+            f"🔹 Освобождено страниц: {freed_pages}\n"
             f"🔹 Размер БД после очистки: {db_size_mb:.2f} MB\n\n"
-            "📝 База данных оптимизирована (VACUUM + ANALYZE)"
+            f"📝 База данных оптимизирована ({'VACUUM' if full_vacuum else 'incremental_vacuum'} + optimize)"
         )
         
         await message.answer(report, parse_mode="Markdown")
         
         logger.info(
             f"[ADMIN] User {message.from_user.id} cleaned DB: "
-            f"{contexts_to_clean} contexts, {messages_to_delete} messages"
+            f"{contexts_cleaned} contexts, {retention['messages']} messages"
         )
         
     except Exception as e:
         logger.error(f"[ADMIN] Error cleaning database: {e}")
         await message.answer(f"❌ Ошибка при очистке БД: {str(e)}")
 
+@admin_router.message(Command("stats_rebuild"))
+async def rebuild_stats_command(message: Message):
+    """
+    Пересчитывает свёртки статистики (/stats) из исходных таблиц.
+    Нужна после ручных правок БД; сообщения, удалённые /db_clean, в пересчёт не попадут.
+    """
+    # Проверяем права доступа
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде")
+        return
+    
+    try:
+        await message.answer("🔄 Пересчитываю статистику...")
+        elapsed = await admin_router.db.rebuild_rollups()
+        await message.answer(f"✅ Статистика пересчитана за {elapsed:.2f} сек")
+        logger.info(f"[ADMIN] User {message.from_user.id} rebuilt stats rollups in {elapsed:.2f}s")
+    except Exception as e:
+        logger.error(f"[ADMIN] Error rebuilding stats: {e}")
+        await message.answer(f"❌ Ошибка при пересчёте статистики: {str(e)}")
+
 def setup_admin_commands(dp, database, bot_instance):
     """
     Регистрирует административные команды в диспетчере.
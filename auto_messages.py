@@ -0,0 +1,437 @@
+"""
+Автосообщения пользователям, которые давно не писали.
+Проход запускается раз в interval: кандидаты читаются страницами по индексу
+(auto_message, last_active_at), отправки равномерно распределяются по окну прохода
+со случайным сдвигом, а генерация текста и отправка идут с ограниченной
+параллельностью. Время автосообщения пишется в users.last_auto_message_at, поэтому
+пользователь не выбирается повторно раньше repeat_after. После прохода в лог
+уходит отчёт о пропускной способности.
+
+OpenerPool хранит заранее сгенерированные первые сообщения для каждой пары
+(персонаж, время суток) в таблице auto_openers со счётчиками показов: автосообщение
+берётся из пула без запроса к LLM и не повторяется пользователю (auto_opener_uses).
+Пул пополняется одним запросом на пару и обновляется раз в сутки в тихие часы.
+"""
+
+import asyncio
+import logging
+import random
+import re
+import time
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Callable, Awaitable, Tuple
+
+from aiogram.exceptions import TelegramForbiddenError
+
+from llm_admission import llm_lane
+from telegram_outbound import send_priority
+
+logger = logging.getLogger(__name__)
+
+# Время суток: код в пуле, часы начала и конца, фраза для промпта
+DAYPARTS = (
+    ('morning', 6, 12, "сейчас утро"),
+    ('day', 12, 18, "сейчас день"),
+    ('evening', 18, 22, "сейчас вечер"),
+    ('night', 22, 6, "сейчас ночь"),
+)
+TIME_CONTEXTS = {code: phrase for code, _, _, phrase in DAYPARTS}
+
+
+def daypart(hour: Optional[int] = None) -> str:
+    """Код времени суток для часа (по умолчанию - текущего)"""
+    hour = datetime.now().hour if hour is None else hour
+    for code, start, end, _ in DAYPARTS:
+        if (start <= hour < end) if start < end else (hour >= start or hour < end):
+            return code
+    return 'night'
+
+
+# Нумерация и маркеры списка, которые модель ставит перед вариантами
+_OPENER_PREFIX_RE = re.compile(r'^\s*(?:\d+[.)]|[-*•])\s*')
+
+
+def parse_openers(text: str, limit: int) -> List[str]:
+    """Варианты из ответа LLM: по одному на строку, без нумерации, кавычек и повторов"""
+    openers: List[str] = []
+    for line in text.splitlines():
+        line = _OPENER_PREFIX_RE.sub('', line).strip().strip('"«»').strip()
+        # Вступление вроде "Вот варианты:" пропускаем
+        if len(line) >= 10 and not line.endswith(':') and line not in openers:
+            openers.append(line)
+            if len(openers) == limit:
+                break
+    return openers
+
+
+class AutoMessageEngine:
+    """Проходы автосообщений: страницы кандидатов, отправки по расписанию внутри окна"""
+
+    def __init__(self, db, generate: Callable[[Dict[str, Any]], Awaitable[str]],
+                 deliver: Callable[[Dict[str, Any], str], Awaitable[None]],
+                 interval: float = 3600, window_share: float = 0.8, jitter: float = 0.5,
+                 page_size: int = 500, concurrency: int = 8,
+                 idle_after: float = 86400, repeat_after: float = 86400,
+                 is_busy: Callable[[int], bool] = None):
+        """
+        Args:
+            db: экземпляр Database (acquire() отдаёт писателя или читателя)
+            generate: корутина (user) -> текст автосообщения
+            deliver: корутина (user, text) - отправляет сообщение и начинает контекст заново
+            interval: период проходов в секундах
+            window_share: доля интервала, по которой распределяются отправки прохода
+            jitter: случайный сдвиг отправки в долях шага между отправками
+            page_size: сколько кандидатов читается за один запрос
+            concurrency: одновременных генераций и отправок
+            idle_after: сколько секунд пользователь должен молчать
+            repeat_after: не чаще одного автосообщения пользователю за этот срок
+            is_busy: (user_id) -> обрабатывается ли сейчас сообщение пользователя
+        """
+        self.db = db
+        self.generate = generate
+        self.deliver = deliver
+        self.interval = interval
+        self.window_share = window_share
+        self.jitter = jitter
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.idle_after = idle_after
+        self.repeat_after = repeat_after
+        self.is_busy = is_busy
+        self._task: Optional[asyncio.Task] = None
+        # Задачи отправок текущего прохода
+        self._workers: set = set()
+        # Метрики
+        self.passes = 0
+        self.last_pass: Dict[str, Any] = {}
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        workers = list(self._workers)
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _run(self):
+        # Автосообщения - фоновая нагрузка, уступают LLM и слоты отправки пользователям
+        llm_lane.set('background')
+        send_priority.set('auto')
+        while True:
+            started = time.monotonic()
+            try:
+                await self.run_pass()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[AUTO] Ошибка прохода автосообщений: {e}")
+            await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    # --- Кандидаты ---
+
+    def _bounds(self) -> Tuple[int, int]:
+        now = int(time.time())
+        return now - int(self.idle_after), now - int(self.repeat_after)
+
+    _CANDIDATE_FILTER = '''
+        auto_message = 1
+        AND last_active_at <= ?
+        AND (bot_blocked IS NULL OR bot_blocked = 0)
+        AND (last_auto_message_at IS NULL OR last_auto_message_at <= ?)
+    '''
+
+    async def count_candidates(self, idle_before: int, repeat_before: int) -> int:
+        async with self.db.acquire(readonly=True) as conn:
+            cursor = await conn.execute(
+                f'SELECT COUNT(*) FROM users WHERE {self._CANDIDATE_FILTER}', (idle_before, repeat_before)
+            )
+            return (await cursor.fetchone())[0]
+
+    async def _pages(self, idle_before: int, repeat_before: int):
+        """Кандидаты страницами по ключу (last_active_at, id) - по индексу, без OFFSET"""
+        last_key = (-1, -1)
+        while True:
+            async with self.db.acquire(readonly=True) as conn:
+                cursor = await conn.execute(
+                    f'SELECT id, username, name, current_model, last_active_at FROM users '
+                    f'WHERE {self._CANDIDATE_FILTER} AND (last_active_at, id) > (?, ?) '
+                    f'ORDER BY last_active_at, id LIMIT ?',
+                    (idle_before, repeat_before, *last_key, self.page_size)
+                )
+                rows = await cursor.fetchall()
+            if not rows:
+                return
+            last_key = (rows[-1]['last_active_at'], rows[-1]['id'])
+            yield [{
+                'id': row['id'],
+                'username': row['username'],
+                'name': row['name'],
+                'current_model': row['current_model'],
+                'auto_message': True,
+                'context': [],
+            } for row in rows]
+            if len(rows) < self.page_size:
+                return
+
+    async def still_idle(self, user_id: int) -> bool:
+        """Проверка кандидата по свежим данным: страница могла устареть, пока ждала своей очереди"""
+        if self.is_busy and self.is_busy(user_id):
+            return False
+        async with self.db.acquire(readonly=True) as conn:
+            cursor = await conn.execute(
+                f'SELECT 1 FROM users WHERE id = ? AND {self._CANDIDATE_FILTER}', (user_id, *self._bounds())
+            )
+            return await cursor.fetchone() is not None
+
+    async def mark_sent(self, user_id: int):
+        await self.db.write_behind.put(
+            'UPDATE users SET last_auto_message_at = ? WHERE id = ?',
+            (int(time.time()), user_id), key=user_id
+        )
+
+    # --- Проход ---
+
+    async def _process(self, user: Dict[str, Any], report: Dict[str, Any]):
+        try:
+            if not await self.still_idle(user['id']):
+                report['skipped'] += 1
+                return
+            generated = time.monotonic()
+            text = await self.generate(user)
+            report['generate_seconds'] += time.monotonic() - generated
+            # deliver очищает контекст: пользователь, заговоривший во время генерации, его бы потерял
+            if not await self.still_idle(user['id']):
+                report['skipped'] += 1
+                return
+            await self.deliver(user, text)
+            await self.mark_sent(user['id'])
+            report['sent'] += 1
+        except TelegramForbiddenError:
+            # bot_blocked отметил планировщик исходящих сообщений
+            report['blocked'] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            report['failed'] += 1
+            logger.error(f"[AUTO] Ошибка автосообщения пользователю {user['id']}: {e}")
+
+    async def run_pass(self) -> Dict[str, Any]:
+        """Один проход: отправки распределены по window_share * interval"""
+        idle_before, repeat_before = self._bounds()
+        total = await self.count_candidates(idle_before, repeat_before)
+        report = {'candidates': total, 'sent': 0, 'failed': 0, 'blocked': 0, 'skipped': 0, 'generate_seconds': 0.0}
+        if not total:
+            self._finish(report, 0.0)
+            return report
+
+        step = self.interval * self.window_share / total
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks: List[asyncio.Task] = []
+        started = time.monotonic()
+        index = 0
+
+        async def process(user):
+            try:
+                await self._process(user, report)
+            finally:
+                slots.release()
+
+        async for page in self._pages(idle_before, repeat_before):
+            for user in page:
+                # Слот отправки: равномерная сетка по окну плюс сдвиг, чтобы не совпадать с другими задачами
+                due = started + step * (index + random.uniform(-self.jitter, self.jitter))
+                index += 1
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await slots.acquire()
+                task = asyncio.create_task(process(user))
+                self._workers.add(task)
+                task.add_done_callback(self._workers.discard)
+                tasks.append(task)
+            tasks = [task for task in tasks if not task.done()]
+        await asyncio.gather(*tasks)
+        self._finish(report, time.monotonic() - started)
+        return report
+
+    def _finish(self, report: Dict[str, Any], duration: float):
+        self.passes += 1
+        processed = report['sent'] + report['failed'] + report['blocked']
+        report['duration'] = round(duration, 1)
+        report['per_minute'] = round(processed / duration * 60, 1) if duration > 0 else 0.0
+        report['generate_avg'] = round(report.pop('generate_seconds') / processed, 2) if processed else None
+        self.last_pass = report
+        if report['candidates']:
+            logger.info(
+                f"[AUTO] Проход: {report['candidates']} кандидатов, отправлено {report['sent']}, "
+                f"пропущено {report['skipped']}, заблокировали {report['blocked']}, ошибок {report['failed']} за {report['duration']} сек "
+                f"({report['per_minute']} в минуту, генерация {report['generate_avg']} сек)"
+            )
+            if duration > self.interval:
+                logger.warning(f"[AUTO] Проход длился дольше интервала ({duration:.0f} > {self.interval:.0f} сек)")
+
+    def stats(self) -> Dict[str, Any]:
+        return {'passes': self.passes, 'last_pass': self.last_pass}
+
+
+class OpenerPool:
+    """Пул готовых первых сообщений по (персонаж, время суток) со счётчиками показов"""
+
+    def __init__(self, db, generate: Callable[[str, str, int], Awaitable[str]],
+                 size: int = 12, refresh_hour: int = 4, tick: float = 600, fill_cooldown: float = 900):
+        """
+        Args:
+            db: экземпляр Database (acquire() отдаёт писателя или читателя)
+            generate: корутина (model, time_context, count) -> ответ LLM с вариантами по строкам
+            size: сколько вариантов держать на пару (персонаж, время суток)
+            refresh_hour: час (местное время), в который пул обновляется целиком
+            tick: как часто проверять, не пора ли обновить пул
+            fill_cooldown: сколько секунд не наполнять пару после неудачной попытки
+        """
+        self.db = db
+        self.generate = generate
+        self.size = size
+        self.refresh_hour = refresh_hour
+        self.tick = tick
+        self.fill_cooldown = fill_cooldown
+        self._task: Optional[asyncio.Task] = None
+        self._fill_locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        # (персонаж, время суток) -> до какого момента (monotonic) не пытаться наполнить пару
+        self._fill_failed_until: Dict[Tuple[str, str], float] = {}
+        self._refreshed_on = datetime.now().date()
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+        self.llm_calls = 0
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    async def _run(self):
+        # Обновление пула - фоновая нагрузка на LLM
+        llm_lane.set('background')
+        while True:
+            await asyncio.sleep(self.tick)
+            now = datetime.now()
+            if now.hour != self.refresh_hour or self._refreshed_on == now.date():
+                continue
+            self._refreshed_on = now.date()
+            try:
+                await self.refresh_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[OPENERS] Ошибка обновления пула: {e}")
+
+    async def draw(self, model: str, part: str, user_id: int) -> Optional[str]:
+        """Вариант, который пользователь ещё не видел (реже всего показанный); None - пул исчерпан"""
+        opener = await self._pick(model, part, user_id)
+        if opener is None and not await self._has_pool(model, part):
+            # Первый запрос к паре - наполняем её одним вызовом LLM
+            await self._fill(model, part)
+            opener = await self._pick(model, part, user_id)
+        if opener is None:
+            self.misses += 1
+            return None
+        opener_id, text = opener
+        self.hits += 1
+        # Показ пишем сразу, а не через очередь отложенной записи: следующий выбор должен его видеть
+        async with self.db.acquire() as conn:
+            await conn.execute('UPDATE auto_openers SET uses = uses + 1 WHERE id = ?', (opener_id,))
+            await conn.execute(
+                'INSERT OR REPLACE INTO auto_opener_uses (user_id, opener_id, used_at) VALUES (?, ?, ?)',
+                (user_id, opener_id, int(time.time()))
+            )
+        return text
+
+    async def _pick(self, model: str, part: str, user_id: int) -> Optional[Tuple[int, str]]:
+        async with self.db.acquire(readonly=True) as conn:
+            cursor = await conn.execute(
+                'SELECT id, text FROM auto_openers o WHERE model = ? AND daypart = ? AND NOT EXISTS ('
+                'SELECT 1 FROM auto_opener_uses u WHERE u.user_id = ? AND u.opener_id = o.id) '
+                'ORDER BY uses, random() LIMIT 1',
+                (model, part, user_id)
+            )
+            row = await cursor.fetchone()
+            return (row['id'], row['text']) if row else None
+
+    async def _has_pool(self, model: str, part: str) -> bool:
+        async with self.db.acquire(readonly=True) as conn:
+            cursor = await conn.execute(
+                'SELECT 1 FROM auto_openers WHERE model = ? AND daypart = ? LIMIT 1', (model, part)
+            )
+            return await cursor.fetchone() is not None
+
+    async def _fill(self, model: str, part: str, replace: bool = False) -> int:
+        """Генерирует варианты для пары; replace=True заменяет прежние вместе с историей показов"""
+        pair = (model, part)
+        lock = self._fill_locks.setdefault(pair, asyncio.Lock())
+        async with lock:
+            if not replace:
+                # После неудачи не наполняем пару на каждом кандидате - пусть работает запасной путь
+                if time.monotonic() < self._fill_failed_until.get(pair, 0.0):
+                    return 0
+                if await self._has_pool(model, part):
+                    return 0
+            self.llm_calls += 1
+            try:
+                openers = parse_openers(await self.generate(model, TIME_CONTEXTS[part], self.size), self.size)
+            except Exception:
+                self._fill_failed_until[pair] = time.monotonic() + self.fill_cooldown
+                raise
+            if not openers:
+                self._fill_failed_until[pair] = time.monotonic() + self.fill_cooldown
+                logger.warning(f"[OPENERS] Пустой ответ LLM для {model}/{part}, повтор через {self.fill_cooldown:.0f} сек")
+                return 0
+            self._fill_failed_until.pop(pair, None)
+            async with self.db.acquire() as conn:
+                await conn.execute('BEGIN IMMEDIATE')
+                if replace:
+                    await conn.execute(
+                        'DELETE FROM auto_opener_uses WHERE opener_id IN ('
+                        'SELECT id FROM auto_openers WHERE model = ? AND daypart = ?)',
+                        (model, part)
+                    )
+                    await conn.execute('DELETE FROM auto_openers WHERE model = ? AND daypart = ?', (model, part))
+                now = int(time.time())
+                await conn.executemany(
+                    'INSERT INTO auto_openers (model, daypart, text, created_at) VALUES (?, ?, ?, ?)',
+                    [(model, part, text, now) for text in openers]
+                )
+            logger.info(f"[OPENERS] {model}/{part}: {len(openers)} вариантов")
+            return len(openers)
+
+    async def refresh_all(self):
+        """Обновляет все пары, которые уже есть в пуле (в тихие часы, по одной)"""
+        async with self.db.acquire(readonly=True) as conn:
+            cursor = await conn.execute('SELECT DISTINCT model, daypart FROM auto_openers')
+            pairs = [(row['model'], row['daypart']) for row in await cursor.fetchall()]
+        for model, part in pairs:
+            try:
+                await self._fill(model, part, replace=True)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[OPENERS] Не удалось обновить {model}/{part}: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'llm_calls': self.llm_calls}
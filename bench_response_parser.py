@@ -0,0 +1,133 @@
+"""
+Микробенчмарк разбора ответов LLM: прежняя цепочка re.findall/re.sub против
+однопроходного response_parser.parse_response.
+
+Корпус - ответы ассистента из таблицы messages (по умолчанию DB_PATH из config.py),
+а если базы нет - встроенные образцы ответов в форматах бота. Замеряется разбор
+полных ответов и разбор каждого префикса ответа, как при показе потокового ответа.
+
+Запуск:
+    python bench_response_parser.py [--db bot_data.db] [--limit 2000] [--repeat 5]
+"""
+
+import argparse
+import os
+import re
+import sqlite3
+import time
+
+from response_parser import parse_response
+
+SAMPLES = [
+    "Привет, милый! 😊 Я так скучала по тебе... Как прошёл твой день? Расскажи мне всё-всё!\n\n"
+    "[действия: Рассказать о работе, Спросить как у неё дела]",
+    "Ммм, ты такой внимательный... *улыбается и поправляет волосы* Знаешь, я как раз думала о тебе. "
+    "[image: девушка в красном платье у окна, вечерний свет, улыбается] "
+    "[действия: Сделать комплимент, Пригласить на свидание]",
+    "Конечно! Вот как я выгляжу сегодня утром ☀️\n"
+    "[IMAGE_PROMPT] young woman drinking coffee in a cozy kitchen, morning light, photorealistic|Доброе утро, соня! ☕\n"
+    "Надеюсь, ты хорошо выспался.\n[действия: Пожелать доброго утра, Спросить о планах]",
+    "Ох, это было бы чудесно... Давай прогуляемся по парку вечером?\n"
+    "Действия: Согласиться на прогулку, Предложить кино",
+    "Я приготовила для тебя сюрприз! 🎁\n"
+    "[IMAGE_PROMPT] woman holding a gift box, festive room, warm colors|Это для тебя 💝\n"
+    "[IMAGE_PROMPT] close-up of a handmade card with hearts|А это открытка, которую я сделала сама",
+    "Знаешь, иногда мне кажется, что ты единственный, кто меня понимает. Спасибо, что ты рядом. "
+    "Расскажи, о чём ты мечтаешь? Мне правда интересно узнать тебя лучше. " * 3,
+]
+
+
+def legacy_extract_actions(text):
+    actions = []
+    matches = re.findall(r'\[действия:(.*?)\]', text, re.DOTALL | re.IGNORECASE)
+    if not matches:
+        alt_matches = re.findall(r'(?:^|\n|\r)(?:Варианты\s*)?[Дд]ействия?:?\s*(.*?)(?:\n|$)', text, re.MULTILINE)
+        if alt_matches:
+            matches = alt_matches
+    if matches:
+        actions_text = matches[-1].strip()
+        raw_actions = [action.strip() for action in actions_text.split(',')]
+        cleaned_actions = []
+        for action in raw_actions:
+            cleaned_action = re.sub(
+                r'^(первый|второй|третий|один|два|три)?\s*(вариант|действие)?\s*(продолжени[еяй]|диалога)?(:|\.|\s)*',
+                '', action, flags=re.IGNORECASE
+            ).strip()
+            if cleaned_action:
+                cleaned_actions.append(cleaned_action)
+        actions = cleaned_actions[:2]
+        text = re.sub(r'\[действия:.*?\]', '', text, flags=re.DOTALL | re.IGNORECASE).strip()
+        text = re.sub(r'(?:^|\n|\r)(?:Варианты\s*)?[Дд]ействия?:?\s*.*?(?:\n|$)', '', text, flags=re.MULTILINE).strip()
+    return text, actions
+
+
+def legacy_parse(text):
+    """Прежняя цепочка: extract_actions и разбор изображений обоих видов персонажей"""
+    clean_text, actions = legacy_extract_actions(text)
+    images = re.findall(r'\[image:\s*(.*?)\]', clean_text, re.IGNORECASE)
+    prompts = re.findall(r'\[IMAGE_PROMPT\]\s*(.*?)\|(.*?)(?=\[IMAGE_PROMPT\]|$)', clean_text, re.DOTALL)
+    if images:
+        clean_text = re.sub(r'\[image:.*?\]', '', clean_text).strip()
+    if prompts:
+        clean_text = re.sub(r'\[IMAGE_PROMPT\].*?\|', '', clean_text, flags=re.DOTALL).strip()
+    return clean_text, actions, images, prompts
+
+
+def load_corpus(db_path, limit):
+    if db_path and os.path.exists(db_path):
+        conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+        try:
+            rows = conn.execute(
+                "SELECT content FROM messages WHERE role = 'assistant' AND content IS NOT NULL "
+                "ORDER BY id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        finally:
+            conn.close()
+        corpus = [row[0] for row in rows if row[0]]
+        if corpus:
+            return corpus, f"{db_path} ({len(corpus)} ответов)"
+    return SAMPLES, f"встроенные образцы ({len(SAMPLES)} ответов)"
+
+
+def bench(func, corpus, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for text in corpus:
+            func(text)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def prefixes(corpus, step=16):
+    """Префиксы ответов с шагом step символов - как накапливается потоковый ответ"""
+    return [text[:end] for text in corpus for end in range(step, len(text) + step, step)]
+
+
+def main():
+    try:
+        from config import DB_PATH as default_db
+    except Exception:
+        default_db = 'bot_data.db'
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', default=default_db, help='база с таблицей messages')
+    parser.add_argument('--limit', type=int, default=2000, help='сколько ответов взять из базы')
+    parser.add_argument('--repeat', type=int, default=5, help='повторов замера (берётся лучший)')
+    args = parser.parse_args()
+
+    corpus, source = load_corpus(args.db, args.limit)
+    print(f"Корпус: {source}, {sum(map(len, corpus))} символов")
+
+    differ = sum(1 for text in corpus if legacy_parse(text)[1] != parse_response(text).actions)
+    print(f"Ответов с отличающимися действиями: {differ}")
+
+    for title, texts in (("Полные ответы", corpus), ("Префиксы потока", prefixes(corpus))):
+        legacy = bench(legacy_parse, texts, args.repeat)
+        single = bench(parse_response, texts, args.repeat)
+        per_text = 1e6 / len(texts)
+        print(f"{title} ({len(texts)} текстов): прежний разбор {legacy * per_text:.1f} мкс/текст, "
+              f"однопроходный {single * per_text:.1f} мкс/текст, ускорение x{legacy / single:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,12 @@ import asyncio
 import signal
 import aiosqlite
 import time
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List, Tuple
+from datetime import date, datetime, timedelta
+from typing import Optional, Dict, Any, List, Tuple, NamedTuple
 from contextlib import asynccontextmanager
-from collections import defaultdict
+from pathlib import Path
+from collections import defaultdict, deque
+from itertools import groupby
 import os
 import sys
 try:
@@ -19,6 +21,7 @@ from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command, CommandObject
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo, BufferedInputFile, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, FSInputFile
 from aiogram.enums import ChatAction
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 import aiohttp
@@ -44,6 +47,20 @@ except ImportError:
     logger.warning("⚠️ Модуль admin_commands.py не найден, административные команды недоступны")
     setup_admin_commands = None
 
+from subscription_cache import subscription_cache, parse_expires_at
+from db_maintenance import MaintenanceEngine
+from http_clients import http_clients
+from llm_router import LLMRouter
+from llm_admission import LLMAdmission, LLMOverloaded, llm_lane
+from context_builder import ContextBuilder
+from llm_stream import LLMStream, stream_metrics
+from response_parser import parse_response
+from user_mailbox import UserMailbox
+from telegram_outbound import OutboundScheduler, send_priority
+from broadcasts import BroadcastEngine
+from auto_messages import AutoMessageEngine, OpenerPool, daypart, TIME_CONTEXTS
+from job_scheduler import JobScheduler
+
 # Импорт модуля партнерской системы Flyer
 try:
     from flyer_service import FlyerService, init_flyer_service
@@ -65,6 +82,61 @@ dp = Dispatcher()
 MAX_MESSAGE_LENGTH = 4000
 MAX_PROMPT_LENGTH = 2000
 
+# Показ ответа по мере генерации (правками сообщения-черновика)
+STREAM_REPLIES = globals().get('STREAM_REPLIES', True)
+STREAM_EDIT_INTERVAL = globals().get('STREAM_EDIT_INTERVAL', 1.0)
+
+# Запасная модель другого провайдера на случай деградации основного
+LLM_FAILOVER = globals().get('LLM_FAILOVER', {
+    'groq': ('openai', 'gpt-4o-mini'),
+    'openai': ('groq', 'llama-3.3-70b-versatile'),
+})
+# Страхующий запрос к запасному провайдеру, если первый фрагмент задерживается дольше p95
+LLM_HEDGING = globals().get('LLM_HEDGING', False)
+
+# Адреса API провайдеров LLM
+LLM_API_URLS = {
+    'openai': "https://api.openai.com/v1/chat/completions",
+    'groq': "https://api.groq.com/openai/v1/chat/completions",
+}
+
+# Лимиты провайдеров LLM: одновременные запросы и токены в минуту
+# (пул соединений к хосту провайдера берётся того же размера)
+LLM_PROVIDER_LIMITS = globals().get('LLM_PROVIDER_LIMITS', {
+    'openai': {'concurrency': 40, 'tokens_per_minute': 400000},
+    'groq': {'concurrency': 20, 'tokens_per_minute': 100000},
+})
+
+# Предел очереди сообщений пользователя (пришедшие во время ответа склеиваются в один ход)
+MAILBOX_MAX_PENDING = globals().get('MAILBOX_MAX_PENDING', 5)
+
+# Лимиты исходящих сообщений Telegram: всего в секунду и в один чат
+OUTBOUND_GLOBAL_RATE = globals().get('OUTBOUND_GLOBAL_RATE', 30)
+OUTBOUND_CHAT_RATE = globals().get('OUTBOUND_CHAT_RATE', 1)
+# Сколько слотов в секунду авто-сообщения и рассылки оставляют ответам в диалоге
+OUTBOUND_INTERACTIVE_RESERVE = globals().get('OUTBOUND_INTERACTIVE_RESERVE', 5)
+
+# Автосообщения: период проходов и одновременных генераций/отправок
+AUTO_MESSAGE_INTERVAL = globals().get('AUTO_MESSAGE_INTERVAL', 3600)
+AUTO_MESSAGE_CONCURRENCY = globals().get('AUTO_MESSAGE_CONCURRENCY', 8)
+# Пул готовых первых сообщений: вариантов на (персонаж, время суток) и час обновления
+AUTO_OPENER_POOL_SIZE = globals().get('AUTO_OPENER_POOL_SIZE', 12)
+AUTO_OPENER_REFRESH_HOUR = globals().get('AUTO_OPENER_REFRESH_HOUR', 4)
+
+# Прогрев нового пользователя: (задержка от регистрации в секундах, тип тизера)
+PROMO_TEASER_SCHEDULE = globals().get('PROMO_TEASER_SCHEDULE', (
+    (1800, "photo"),       # через 30 минут
+    (7200, "voice"),       # через 2 часа
+    (86400, "exclusive"),  # на следующий день
+))
+
+# Одновременных отправок в одной рассылке (темп всё равно ограничивает планировщик)
+BROADCAST_CONCURRENCY = globals().get('BROADCAST_CONCURRENCY', 25)
+
+# Бюджет токенов промпта (модель -> токены); старые реплики сворачиваются в конспект
+CONTEXT_TOKEN_BUDGETS = globals().get('CONTEXT_TOKEN_BUDGETS', {})
+CONTEXT_TOKEN_BUDGET = globals().get('CONTEXT_TOKEN_BUDGET', 2500)
+
 def validate_input_length(text: str, max_length: int, input_type: str = "message") -> bool:
     if not text:
         return True
@@ -141,12 +213,255 @@ async def update_last_update_time():
     async with last_update_lock:
         last_update_time = time.time()
 
+def to_epoch(dt: datetime) -> int:
+    """Переводит локальное время в целые секунды Unix (для индексируемых *_at колонок)"""
+    return int(dt.timestamp())
+
+def day_start_epoch(days_ago: int = 0) -> int:
+    """Начало локальных суток days_ago дней назад в секундах Unix"""
+    day = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days_ago)
+    return to_epoch(day)
+
+class WriteBehindQueue:
+    """Ограниченная очередь отложенной записи в БД.
+    
+    Строки копятся в памяти и сбрасываются пачками через executemany в одной
+    транзакции писателя: каждые flush_interval секунд или сразу по накоплении
+    batch_size строк. Порядок операций сохраняется. При переполнении вызывающий
+    ждёт сброса (backpressure), поэтому память ограничена max_pending строками.
+    Неудачная пачка повторяется max_retries раз с растущей паузой, затем пишется
+    построчно - теряются только строки, которые не записываются сами по себе.
+    """
+    
+    def __init__(self, db: 'Database', flush_interval: float = 0.5, batch_size: int = 200, max_pending: int = 10000,
+                 max_retries: int = 3, retry_delay: float = 0.2):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._pending: deque = deque()
+        # Сколько ещё не записанных строк относится к каждому ключу (обычно user_id)
+        self._pending_keys: Dict[Any, int] = defaultdict(int)
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        # Метрики
+        self.rows_flushed = 0
+        self.flush_count = 0
+        self.failed_rows = 0
+        self.retries = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+    
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+    
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Останавливает фоновый сброс и дописывает всё, что осталось в очереди"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        await self.flush()
+    
+    def has_pending(self, key: Any) -> bool:
+        return self._pending_keys.get(key, 0) > 0
+    
+    async def put(self, sql: str, params: tuple, key: Any = None):
+        if len(self._pending) >= self.max_pending:
+            await self.flush()
+        self._pending.append((sql, params, key))
+        if key is not None:
+            self._pending_keys[key] += 1
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+    
+    async def flush(self):
+        """Синхронно сбрасывает всю очередь в БД"""
+        async with self._flush_lock:
+            while self._pending:
+                batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                await self._write(batch)
+    
+    async def _write_batch(self, batch: List[Tuple[str, tuple, Any]]):
+        async with self.db.acquire() as conn:
+            await conn.execute('BEGIN')
+            # Подряд идущие строки с одинаковым SQL пишем одним executemany
+            for sql, group in groupby(batch, key=lambda item: item[0]):
+                await conn.executemany(sql, [params for _, params, _ in group])
+    
+    async def _write_rows(self, batch: List[Tuple[str, tuple, Any]]) -> int:
+        """Пишет строки по одной; возвращает число незаписанных"""
+        failed = 0
+        for sql, params, key in batch:
+            try:
+                async with self.db.acquire() as conn:
+                    await conn.execute(sql, params)
+            except Exception as e:
+                failed += 1
+                logger.error(f"[WRITE-BEHIND] Строка не записана ({key}): {e}")
+        return failed
+    
+    async def _write(self, batch: List[Tuple[str, tuple, Any]]):
+        started = time.perf_counter()
+        failed = 0
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    await self._write_batch(batch)
+                    break
+                except Exception as e:
+                    # Нарушение ограничения повтором не исправить - сразу пишем построчно
+                    if attempt == self.max_retries or isinstance(e, aiosqlite.IntegrityError):
+                        # Пачку не удаётся записать целиком (например, одна строка нарушает ограничение)
+                        logger.error(f"[WRITE-BEHIND] Пачка из {len(batch)} строк не записана, пишем построчно: {e}")
+                        failed = await self._write_rows(batch)
+                        break
+                    self.retries += 1
+                    logger.warning(f"[WRITE-BEHIND] Ошибка записи пачки, повтор {attempt + 1}: {e}")
+                    await asyncio.sleep(self.retry_delay * 2 ** attempt)
+        finally:
+            for _, _, key in batch:
+                if key is not None:
+                    self._pending_keys[key] -= 1
+                    if self._pending_keys[key] <= 0:
+                        del self._pending_keys[key]
+        self.failed_rows += failed
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.rows_flushed += len(batch) - failed
+        self.flush_count += 1
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self._total_flush_ms += elapsed_ms
+    
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                # Отмена при остановке не обрывает запись пачки на середине: stop() дождётся её на _flush_lock
+                await asyncio.shield(self.flush())
+            except Exception as e:
+                logger.error(f"[WRITE-BEHIND] Ошибка фонового сброса: {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'depth': self.depth,
+            'rows_flushed': self.rows_flushed,
+            'flushes': self.flush_count,
+            'failed_rows': self.failed_rows,
+            'retries': self.retries,
+            'last_flush_ms': round(self.last_flush_ms, 1),
+            'avg_flush_ms': round(self._total_flush_ms / self.flush_count, 1) if self.flush_count else 0.0,
+            'max_flush_ms': round(self.max_flush_ms, 1),
+        }
+
+class QuotaLedger:
+    """Счётчики лимитов в памяти процесса: сообщения за день и изображения за месяц.
+    
+    Значение для (пользователь, период) лениво подгружается из БД при первом
+    обращении, дальше проверка и резервирование идут в памяти без await между
+    ними (то есть атомарно для event loop). Приращения уходят в daily_messages /
+    monthly_images через очередь отложенной записи. Ключ содержит день или месяц,
+    поэтому при смене периода счётчики начинаются заново, а старые выбрасываются.
+    """
+    
+    # вид лимита -> (таблица, колонка периода, формат периода)
+    KINDS = {
+        'daily_messages': ('daily_messages', 'date', '%Y-%m-%d'),
+        'monthly_images': ('monthly_images', 'month', '%Y-%m'),
+    }
+    
+    def __init__(self, db: 'Database'):
+        self.db = db
+        self._counts: Dict[Tuple[str, int, str], int] = {}
+        self._periods: Dict[str, str] = {}
+    
+    def period(self, kind: str) -> str:
+        period = datetime.now().strftime(self.KINDS[kind][2])
+        if self._periods.get(kind) != period:
+            # Новый день/месяц: счётчики прошлого периода больше не нужны
+            self._periods[kind] = period
+            self._counts = {key: value for key, value in self._counts.items() if key[0] != kind or key[2] == period}
+        return period
+    
+    async def get(self, kind: str, user_id: int) -> int:
+        return await self._load((kind, user_id, self.period(kind)))
+    
+    async def _load(self, key: Tuple[str, int, str]) -> int:
+        kind, user_id, _ = key
+        if key not in self._counts:
+            table, column, _ = self.KINDS[kind]
+            async with self.db.acquire(readonly=True) as conn:
+                cursor = await conn.execute(f'SELECT count FROM {table} WHERE user_id=? AND {column}=?', (user_id, key[2]))
+                row = await cursor.fetchone()
+            # Если параллельный запрос успел подгрузить и увеличить счётчик, оставляем его значение
+            self._counts.setdefault(key, row['count'] if row else 0)
+        return self._counts[key]
+    
+    async def try_reserve(self, kind: str, user_id: int, limit: Optional[int] = None) -> Tuple[bool, int]:
+        """Проверяет лимит и сразу занимает единицу. Возвращает (разрешено, текущее значение)"""
+        key = (kind, user_id, self.period(kind))
+        count = await self._load(key)
+        if limit is not None and count >= limit:
+            return False, count
+        self._counts[key] = count + 1
+        table, column, _ = self.KINDS[kind]
+        await self.db.write_behind.put(
+            f'INSERT INTO {table} (user_id, {column}, count) VALUES (?, ?, 1) '
+            f'ON CONFLICT(user_id, {column}) DO UPDATE SET count = count + 1',
+            (user_id, key[2])
+        )
+        return True, count + 1
+    
+    def sync(self, kind: str, user_id: int, count: int):
+        """Подтягивает счётчик к значению, записанному в БД в обход очереди"""
+        key = (kind, user_id, self.period(kind))
+        self._counts[key] = max(self._counts.get(key, 0), count)
+
+class Admission(NamedTuple):
+    """Решение о допуске входящего сообщения к LLM"""
+    allowed: bool
+    premium: bool
+    daily_count: int
+
 class Database:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, read_pool_size: int = 4, flush_interval: float = 0.5,
+                 flush_batch_size: int = 200, max_pending_writes: int = 10000,
+                 stats_compact_interval: float = 300):
         self.db_path = db_path
+        self.read_pool_size = read_pool_size
+        # Единственное соединение-писатель: все изменения идут строго через него
         self._connection: Optional[aiosqlite.Connection] = None
+        # Пул read-only соединений для чтения (WAL позволяет читать параллельно с записью)
+        self._reader_connections: List[aiosqlite.Connection] = []
+        self._readers: Optional[asyncio.Queue] = None
         self._lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
         self._initialized = False
+        # Отложенная пакетная запись лога сообщений
+        self.write_behind = WriteBehindQueue(self, flush_interval, flush_batch_size, max_pending_writes)
+        self._backfill_task: Optional[asyncio.Task] = None
+        self.stats_compact_interval = stats_compact_interval
+        self._compactor_task: Optional[asyncio.Task] = None
+        # Фоновое обслуживание (retention, incremental_vacuum, checkpoint); задаётся снаружи
+        self.maintenance: Optional[MaintenanceEngine] = None
+        # Лимиты сообщений и изображений считаются в памяти
+        self.quotas = QuotaLedger(self)
     
     async def initialize(self):
         """Инициализация базы данных"""
@@ -165,6 +480,8 @@ class Database:
                 check_same_thread=False
             )
             
+            # Для новой базы - инкрементальный VACUUM (на существующей действует только после VACUUM)
+            await self._connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
             # Включаем WAL режим для лучшей производительности
             await self._connection.execute('PRAGMA journal_mode=WAL')
             await self._connection.execute('PRAGMA synchronous=NORMAL')
@@ -172,11 +489,95 @@ class Database:
             
             # Инициализируем схему базы данных
             await self._init_db()
+            
+            # Открываем пул читателей только после того, как писатель создал файл и схему
+            await self._open_readers()
             self._initialized = True
+            self.write_behind.start()
+            self._backfill_task = asyncio.create_task(self._run_backfill())
+            self._compactor_task = asyncio.create_task(self._run_rollup_compactor())
+            if self.maintenance:
+                self.maintenance.start()
+    
+    async def _run_backfill(self):
+        try:
+            await self.backfill_epoch_columns()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[BACKFILL] Ошибка заполнения epoch-колонок: {e}")
+    
+    async def _open_readers(self):
+        """Открывает пул read-only соединений (mode=ro + query_only)"""
+        uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+        self._readers = asyncio.Queue()
+        for _ in range(max(self.read_pool_size, 0)):
+            conn = await aiosqlite.connect(
+                uri,
+                uri=True,
+                timeout=30.0,
+                isolation_level=None,
+                check_same_thread=False
+            )
+            await conn.execute('PRAGMA query_only=1')
+            await conn.execute('PRAGMA cache_size=-2000')
+            conn.row_factory = aiosqlite.Row
+            self._reader_connections.append(conn)
+            self._readers.put_nowait(conn)
+    
+    # Версионированные миграции схемы: (версия PRAGMA user_version, описание, метод).
+    # Каждый шаг применяется один раз в своей транзакции; новые шаги добавляются в конец
+    SCHEMA_MIGRATIONS = (
+        (1, 'базовые таблицы', '_migration_base_schema'),
+        (2, 'кольцо контекста context_turns', '_migration_context_turns'),
+        (3, 'epoch-колонки и индексы', '_migration_epoch_columns'),
+        (4, 'таблица conversion_events', '_migration_conversion_events'),
+        (5, 'свёртки статистики', '_migration_stats_rollups'),
+        (6, 'колонки и индексы conversion_events', '_migration_conversion_columns'),
+        (7, 'конспект контекста у пользователя', '_migration_context_summary'),
+        (8, 'кампании рассылок', '_migration_broadcasts'),
+        (9, 'время последнего автосообщения', '_migration_auto_message_at'),
+        (10, 'пул первых сообщений для автосообщений', '_migration_auto_openers'),
+        (11, 'отложенные задачи jobs', '_migration_jobs'),
+    )
     
     async def _init_db(self):
-        """Инициализация структуры базы данных"""
-        await self._connection.execute('''
+        """Инициализация структуры базы данных: применяет недостающие миграции"""
+        conn = self._connection
+        cursor = await conn.execute('PRAGMA user_version')
+        version = (await cursor.fetchone())[0]
+        pending = [m for m in self.SCHEMA_MIGRATIONS if m[0] > version]
+        started = time.perf_counter()
+        for target, description, method in pending:
+            step_started = time.perf_counter()
+            await conn.execute('BEGIN IMMEDIATE')
+            try:
+                await getattr(self, method)(conn)
+                await conn.execute(f'PRAGMA user_version = {int(target)}')
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                logger.error(f"[MIGRATION] Ошибка миграции {target} ({description})")
+                raise
+            logger.info(f"[MIGRATION] {version} -> {target}: {description} за {(time.perf_counter() - step_started) * 1000:.0f} мс")
+            version = target
+        if pending:
+            logger.info(f"[MIGRATION] Схема обновлена до версии {version} за {(time.perf_counter() - started) * 1000:.0f} мс")
+        
+        # Триггер пересоздаётся при каждом старте, чтобы размер кольца следовал конфигу
+        await self._install_context_trigger(conn)
+    
+    @staticmethod
+    async def _add_missing_columns(conn, table: str, columns: Tuple[str, ...]):
+        """Добавляет колонки, которых ещё нет в таблице (для баз, созданных до миграций)"""
+        cursor = await conn.execute(f'PRAGMA table_info({table})')
+        existing = {row[1] for row in await cursor.fetchall()}
+        for column in columns:
+            if column.split()[0] not in existing:
+                await conn.execute(f'ALTER TABLE {table} ADD COLUMN {column}')
+    
+    async def _migration_base_schema(self, conn):
+        await conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 id INTEGER PRIMARY KEY,
                 username TEXT,
@@ -189,28 +590,16 @@ class Database:
                 auto_message BOOLEAN DEFAULT 1
             )
         ''' )
-        # Добавляем колонку auto_message для существующих баз, если её нет
-        try:
-            await self._connection.execute('ALTER TABLE users ADD COLUMN auto_message BOOLEAN DEFAULT 1')
-            # Установим auto_message=1 для всех существующих пользователей
-            await self._connection.execute('UPDATE users SET auto_message = 1 WHERE auto_message IS NULL')
-        except aiosqlite.Error:
-            pass  # колонка уже существует
-        
-        # Добавляем колонку bot_blocked для отслеживания заблокировавших бота пользователей
-        try:
-            await self._connection.execute('ALTER TABLE users ADD COLUMN bot_blocked BOOLEAN DEFAULT 0')
-        except aiosqlite.Error:
-            pass  # колонка уже существует
+        # Колонки, которых не было в старых базах. DEFAULT проставляется и существующим строкам,
+        # поэтому отдельный UPDATE auto_message не нужен
+        await self._add_missing_columns(conn, 'users', (
+            'auto_message BOOLEAN DEFAULT 1',
+            'bot_blocked BOOLEAN DEFAULT 0',
+            'source TEXT',
+        ))
         
-        # В любом случае обновим всех пользователей, у которых не установлено значение
-        try:
-            await self._connection.execute('UPDATE users SET auto_message = 1 WHERE auto_message IS NULL')
-        except aiosqlite.Error:
-            logger.warning("Не удалось обновить значения auto_message по умолчанию")
-            
-        # Новая таблица сообщений
-        await self._connection.execute('''
+        # Таблица сообщений
+        await conn.execute('''
             CREATE TABLE IF NOT EXISTS messages (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER,
@@ -221,29 +610,20 @@ class Database:
                 FOREIGN KEY(user_id) REFERENCES users(id)
             )
         ''')
-        # Добавляем колонки для старых баз, если их нет
-        for col in ('ts TEXT', 'model TEXT', 'role TEXT', 'content TEXT'):
-            try:
-                await self._connection.execute(f'ALTER TABLE messages ADD COLUMN {col}')
-            except aiosqlite.Error:
-                pass
-        await self._connection.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_ts ON messages(user_id, ts)')
-        await self._connection.execute('CREATE INDEX IF NOT EXISTS idx_messages_model_ts ON messages(model, ts)')
+        await self._add_missing_columns(conn, 'messages', ('ts TEXT', 'model TEXT', 'role TEXT', 'content TEXT'))
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_ts ON messages(user_id, ts)')
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_model_ts ON messages(model, ts)')
+        
         # Таблица для UTM статистики
-        await self._connection.execute('''
+        await conn.execute('''
             CREATE TABLE IF NOT EXISTS sources (
                 source TEXT PRIMARY KEY,
                 users_count INTEGER DEFAULT 0,
                 requests_count INTEGER DEFAULT 0
             )
         ''')
-        # Пытаемся добавить колонку source для старых баз (если она уже есть, игнорируем ошибку)
-        try:
-            await self._connection.execute('ALTER TABLE users ADD COLUMN source TEXT')
-        except aiosqlite.Error:
-            pass  # колонка уже существует
         # Таблица подписок
-        await self._connection.execute('''
+        await conn.execute('''
             CREATE TABLE IF NOT EXISTS subscriptions (
                 user_id INTEGER PRIMARY KEY,
                 expires_at TEXT,
@@ -252,7 +632,7 @@ class Database:
         ''')
         
         # Таблица для отслеживания сообщений за сутки
-        await self._connection.execute('''
+        await conn.execute('''
             CREATE TABLE IF NOT EXISTS daily_messages (
                 user_id INTEGER,
                 date TEXT,
@@ -263,7 +643,7 @@ class Database:
         ''')
         
         # Таблица для отслеживания генераций изображений за месяц
-        await self._connection.execute('''
+        await conn.execute('''
             CREATE TABLE IF NOT EXISTS monthly_images (
                 user_id INTEGER,
                 month TEXT,
@@ -273,12 +653,462 @@ class Database:
             )
         ''')
     
-    async def add_message(self, user_id:int, model:str, role:str, content:str):
+    async def _migration_context_turns(self, conn):
+        # Контекст диалога: кольцо из MAX_CONTEXT_MESSAGES последних реплик на пользователя.
+        # Реплика с порядковым номером seq занимает слот seq % MAX_CONTEXT_MESSAGES,
+        # поэтому добавление - это перезапись одной строки, а не всего users.context
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS context_turns (
+                user_id INTEGER NOT NULL,
+                slot INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT,
+                content TEXT,
+                ts TEXT,
+                PRIMARY KEY (user_id, slot)
+            ) WITHOUT ROWID
+        ''')
+        await self._migrate_context_blobs(conn)
+    
+    async def _migration_epoch_columns(self, conn):
+        # Целочисленные epoch-колонки рядом с ISO-строками: по ним работают диапазонные
+        # запросы с индексами вместо date()/datetime() над каждой строкой.
+        # Значения для старых строк заполняет фоновый backfill_epoch_columns
+        await self._add_missing_columns(conn, 'users', ('last_active_at INTEGER', 'join_at INTEGER'))
+        await self._add_missing_columns(conn, 'messages', ('ts_at INTEGER',))
+        await self._add_missing_columns(conn, 'subscriptions', ('expires_at_ts INTEGER',))
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_auto_last_active ON users(auto_message, last_active_at)')
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_last_active_at ON users(last_active_at)')
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_join_at ON users(join_at)')
+        # Покрывающий индекс для статистики сообщений за период по моделям
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_role_ts_at ON messages(role, ts_at, model)')
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_ts_at ON messages(ts_at)')
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_expires_ts ON subscriptions(expires_at_ts)')
+    
+    async def _migration_conversion_events(self, conn):
+        # Раньше таблица создавалась в track_conversion_event при каждом событии
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS conversion_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                event TEXT,
+                details TEXT,
+                timestamp TEXT,
+                FOREIGN KEY(user_id) REFERENCES users(id)
+            )
+        ''')
+    
+    async def _migration_stats_rollups(self, conn):
+        # Свёртки для /stats: небольшие таблицы, которые поддерживаются триггерами при записи
+        # (день -> новые/активные, модель -> пользователи, день+модель -> сообщения)
+        # и фоновым компактором (премиум по источникам зависит от времени истечения подписок)
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS stats_daily (
+                day TEXT PRIMARY KEY,
+                new_users INTEGER NOT NULL DEFAULT 0,
+                active_users INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS stats_model_users (
+                model TEXT PRIMARY KEY,
+                users INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS stats_model_messages (
+                day TEXT NOT NULL,
+                model TEXT NOT NULL,
+                messages INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, model)
+            ) WITHOUT ROWID
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS stats_source_premium (
+                source TEXT PRIMARY KEY,
+                premium_users INTEGER NOT NULL DEFAULT 0,
+                updated_at INTEGER
+            )
+        ''')
+        
+        # Новый пользователь: +1 новый за день регистрации, +1 активный, +1 к модели
+        await conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_rollup_users_insert AFTER INSERT ON users
+            BEGIN
+                INSERT INTO stats_daily (day, new_users)
+                VALUES (date(COALESCE(NEW.join_at, CAST(strftime('%s', 'now') AS INTEGER)), 'unixepoch', 'localtime'), 1)
+                ON CONFLICT(day) DO UPDATE SET new_users = new_users + 1;
+                INSERT INTO stats_daily (day, active_users)
+                SELECT date(NEW.last_active_at, 'unixepoch', 'localtime'), 1 WHERE NEW.last_active_at IS NOT NULL
+                ON CONFLICT(day) DO UPDATE SET active_users = active_users + 1;
+                INSERT INTO stats_model_users (model, users) VALUES (COALESCE(NEW.current_model, ''), 1)
+                ON CONFLICT(model) DO UPDATE SET users = users + 1;
+            END
+        ''')
+        # last_active только растёт, поэтому переход в новый день случается один раз за день:
+        # это и есть отметка "активен сегодня" без хранения пар (день, пользователь)
+        await conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_rollup_users_active AFTER UPDATE OF last_active_at ON users
+            WHEN NEW.last_active_at IS NOT NULL AND (
+                OLD.last_active_at IS NULL
+                OR date(OLD.last_active_at, 'unixepoch', 'localtime') <> date(NEW.last_active_at, 'unixepoch', 'localtime')
+            )
+            BEGIN
+                INSERT INTO stats_daily (day, active_users)
+                VALUES (date(NEW.last_active_at, 'unixepoch', 'localtime'), 1)
+                ON CONFLICT(day) DO UPDATE SET active_users = active_users + 1;
+            END
+        ''')
+        await conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_rollup_users_model AFTER UPDATE OF current_model ON users
+            WHEN OLD.current_model IS NOT NEW.current_model
+            BEGIN
+                UPDATE stats_model_users SET users = users - 1 WHERE model = COALESCE(OLD.current_model, '');
+                INSERT INTO stats_model_users (model, users) VALUES (COALESCE(NEW.current_model, ''), 1)
+                ON CONFLICT(model) DO UPDATE SET users = users + 1;
+            END
+        ''')
+        await conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_rollup_users_delete AFTER DELETE ON users
+            BEGIN
+                UPDATE stats_model_users SET users = users - 1 WHERE model = COALESCE(OLD.current_model, '');
+            END
+        ''')
+        await conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_rollup_messages AFTER INSERT ON messages
+            WHEN NEW.role = 'user'
+            BEGIN
+                INSERT INTO stats_model_messages (day, model, messages)
+                VALUES (
+                    date(COALESCE(NEW.ts_at, CAST(strftime('%s', 'now') AS INTEGER)), 'unixepoch', 'localtime'),
+                    COALESCE(NEW.model, ''), 1
+                )
+                ON CONFLICT(day, model) DO UPDATE SET messages = messages + 1;
+            END
+        ''')
+        await self._rebuild_rollups(conn)
+    
+    async def _migration_conversion_columns(self, conn):
+        # Группа цены и время события - отдельными колонками вместо json_extract/ISO-строк.
+        # ts для старых строк заполняет фоновый backfill_epoch_columns
+        await self._add_missing_columns(conn, 'conversion_events', ('price_group TEXT', 'ts INTEGER'))
+        await conn.execute('''
+            UPDATE conversion_events SET price_group = json_extract(details, '$.group')
+            WHERE price_group IS NULL AND json_extract(details, '$.group') IS NOT NULL
+        ''')
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_conversion_event_user ON conversion_events(event, user_id)')
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_conversion_user_ts ON conversion_events(user_id, ts)')
+        # Покрывающий индекс для A/B-отчёта: только строки с группой цены
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_conversion_group_user ON conversion_events(price_group, user_id, event)
+            WHERE price_group IS NOT NULL
+        ''')
+    
+    async def _migration_context_summary(self, conn):
+        # Краткое содержание свёрнутых реплик и seq последней из них (0 - конспекта нет)
+        await self._add_missing_columns(conn, 'users', ('context_summary TEXT', 'context_summary_seq INTEGER DEFAULT 0'))
+    
+    async def _migration_broadcasts(self, conn):
+        # Кампания со счётчиками и курсором (последний взятый user_id) и снимок её аудитории
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT NOT NULL,
+                admin_chat_id INTEGER,
+                progress_message_id INTEGER,
+                status TEXT NOT NULL,
+                total INTEGER DEFAULT 0,
+                cursor INTEGER DEFAULT -1,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                blocked INTEGER DEFAULT 0,
+                interrupted INTEGER DEFAULT 0,
+                created_at INTEGER,
+                started_at INTEGER,
+                finished_at INTEGER
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                broadcast_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                status INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (broadcast_id, user_id)
+            ) WITHOUT ROWID
+        ''')
+    
+    async def _migration_auto_message_at(self, conn):
+        # Кандидаты выбираются по idx_users_auto_last_active, колонка только отсекает недавних
+        await self._add_missing_columns(conn, 'users', ('last_auto_message_at INTEGER',))
+    
+    async def _migration_auto_openers(self, conn):
+        # Готовые первые сообщения по (персонаж, время суток) и кому какое уже показано
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS auto_openers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                model TEXT NOT NULL,
+                daypart TEXT NOT NULL,
+                text TEXT NOT NULL,
+                uses INTEGER DEFAULT 0,
+                created_at INTEGER
+            )
+        ''')
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_auto_openers_pool ON auto_openers(model, daypart, uses)')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS auto_opener_uses (
+                user_id INTEGER NOT NULL,
+                opener_id INTEGER NOT NULL,
+                used_at INTEGER,
+                PRIMARY KEY (user_id, opener_id)
+            ) WITHOUT ROWID
+        ''')
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_auto_opener_uses_opener ON auto_opener_uses(opener_id)')
+    
+    async def _migration_jobs(self, conn):
+        # Отложенные задачи по пользователям (прогрев и т.п.); выполненные удаляются
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                job_type TEXT NOT NULL,
+                payload TEXT,
+                due_at INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                claimed_at INTEGER,
+                last_error TEXT
+            )
+        ''')
+        # Диспетчер ищет ближайшую ожидающую задачу - индекс только по ним
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_pending_due ON jobs(due_at) WHERE status = 'pending'")
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs(user_id, job_type)')
+    
+    @staticmethod
+    async def _install_context_trigger(conn):
+        """Каждая записанная в messages реплика попадает в кольцо тем же INSERT-ом"""
+        await conn.execute('DROP TRIGGER IF EXISTS trg_messages_context')
+        await conn.execute(f'''
+            CREATE TRIGGER trg_messages_context AFTER INSERT ON messages
+            BEGIN
+                INSERT OR REPLACE INTO context_turns (user_id, slot, seq, role, content, ts)
+                SELECT NEW.user_id, next_seq % {int(MAX_CONTEXT_MESSAGES)}, next_seq, NEW.role, NEW.content, NEW.ts
+                FROM (SELECT COALESCE(MAX(seq), 0) + 1 AS next_seq FROM context_turns WHERE user_id = NEW.user_id);
+            END
+        ''')
+    
+    @staticmethod
+    async def _rebuild_rollups(conn):
+        """Пересчитывает свёртки статистики из исходных таблиц (в транзакции вызывающего).
+        
+        Активность считается только для строк с last_active_at: остальные досчитает
+        триггер, когда фоновый backfill заполнит колонку. Активность прошлых дней
+        восстанавливается лишь по последнему визиту, сегодняшняя - точно.
+        """
+        await conn.execute('DELETE FROM stats_daily')
+        await conn.execute('DELETE FROM stats_model_users')
+        await conn.execute('DELETE FROM stats_model_messages')
+        await conn.execute('''
+            INSERT INTO stats_daily (day, new_users)
+            SELECT day, COUNT(*) FROM (
+                SELECT COALESCE(date(join_at, 'unixepoch', 'localtime'), date(join_date)) AS day FROM users
+            )
+            WHERE day IS NOT NULL
+            GROUP BY day
+        ''')
+        await conn.execute('''
+            INSERT INTO stats_daily (day, active_users)
+            SELECT date(last_active_at, 'unixepoch', 'localtime') AS day, COUNT(*)
+            FROM users
+            WHERE last_active_at IS NOT NULL
+            GROUP BY day
+            ON CONFLICT(day) DO UPDATE SET active_users = excluded.active_users
+        ''')
+        await conn.execute('''
+            INSERT INTO stats_model_users (model, users)
+            SELECT COALESCE(current_model, ''), COUNT(*) FROM users GROUP BY 1
+        ''')
+        await conn.execute('''
+            INSERT INTO stats_model_messages (day, model, messages)
+            SELECT day, model, COUNT(*) FROM (
+                SELECT COALESCE(date(ts_at, 'unixepoch', 'localtime'), date(ts)) AS day,
+                       COALESCE(model, '') AS model
+                FROM messages
+                WHERE role = 'user'
+            )
+            WHERE day IS NOT NULL
+            GROUP BY day, model
+        ''')
+        await Database._refresh_premium_rollup(conn)
+    
+    @staticmethod
+    async def _refresh_premium_rollup(conn):
+        """Пересчитывает премиум-пользователей по источникам (только активные подписки, по индексу)"""
+        now = to_epoch(datetime.now())
+        await conn.execute('DELETE FROM stats_source_premium')
+        await conn.execute('''
+            INSERT INTO stats_source_premium (source, premium_users, updated_at)
+            SELECT u.source, COUNT(*), ?
+            FROM subscriptions sub
+            JOIN users u ON u.id = sub.user_id
+            WHERE sub.expires_at_ts > ? AND u.source IS NOT NULL AND u.source <> ''
+            GROUP BY u.source
+        ''', (now, now))
+    
+    async def rebuild_rollups(self) -> float:
+        """Полный пересчёт свёрток статистики, возвращает длительность в секундах"""
+        started = time.perf_counter()
+        await self.write_behind.flush()
         async with self.acquire() as conn:
-            await conn.execute(
-                'INSERT INTO messages (user_id, model, role, content, ts) VALUES (?,?,?,?,?)',
-                (user_id, model, role, content, datetime.now().isoformat())
+            await conn.execute('BEGIN IMMEDIATE')
+            await self._rebuild_rollups(conn)
+        elapsed = time.perf_counter() - started
+        logger.info(f"[ROLLUP] Свёртки статистики пересчитаны за {elapsed * 1000:.0f} мс")
+        return elapsed
+    
+    async def _run_rollup_compactor(self):
+        """Фоновое обновление свёрток, которые не выражаются триггерами"""
+        while True:
+            try:
+                async with self.acquire() as conn:
+                    await conn.execute('BEGIN')
+                    await self._refresh_premium_rollup(conn)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[ROLLUP] Ошибка обновления свёрток: {e}")
+            await asyncio.sleep(self.stats_compact_interval)
+    
+    # (таблица, ISO-колонка, epoch-колонка) для фонового заполнения
+    EPOCH_BACKFILL_COLUMNS = (
+        ('users', 'last_active', 'last_active_at'),
+        ('users', 'join_date', 'join_at'),
+        ('subscriptions', 'expires_at', 'expires_at_ts'),
+        ('messages', 'ts', 'ts_at'),
+        ('conversion_events', 'timestamp', 'ts'),
+    )
+    
+    async def backfill_epoch_columns(self, chunk_size: int = 1000, pause: float = 0.05):
+        """Онлайн-заполнение epoch-колонок для строк, записанных до их появления.
+        
+        Идёт по индексу epoch-колонки (NULL-ы в нём упорядочены по rowid) небольшими
+        пачками и отпускает писателя между ними, поэтому бот продолжает работать.
+        """
+        for table, iso_column, epoch_column in self.EPOCH_BACKFILL_COLUMNS:
+            last_rowid = 0
+            filled = 0
+            while True:
+                async with self.acquire(readonly=True) as conn:
+                    cursor = await conn.execute(
+                        f'SELECT rowid, {iso_column} FROM {table} '
+                        f'WHERE {epoch_column} IS NULL AND rowid > ? ORDER BY rowid LIMIT ?',
+                        (last_rowid, chunk_size)
+                    )
+                    rows = await cursor.fetchall()
+                if not rows:
+                    break
+                last_rowid = rows[-1][0]
+                updates = []
+                for rowid, iso_value in rows:
+                    try:
+                        updates.append((to_epoch(datetime.fromisoformat(iso_value)), rowid))
+                    except (TypeError, ValueError):
+                        continue  # пустые и битые значения пропускаем
+                if updates:
+                    async with self.acquire() as conn:
+                        await conn.execute('BEGIN')
+                        await conn.executemany(
+                            f'UPDATE {table} SET {epoch_column} = ? WHERE rowid = ? AND {epoch_column} IS NULL',
+                            updates
+                        )
+                    filled += len(updates)
+                await asyncio.sleep(pause)
+            if filled:
+                logger.info(f"[BACKFILL] {table}.{epoch_column}: заполнено {filled} строк")
+    
+    @staticmethod
+    async def _migrate_context_blobs(conn, chunk_size: int = 500):
+        """Переносит старые JSON-контексты из users.context в кольцо context_turns
+        (выполняется внутри транзакции миграции, пачками по chunk_size пользователей)"""
+        migrated = 0
+        last_id = -1
+        while True:
+            cursor = await conn.execute(
+                "SELECT id, context FROM users "
+                "WHERE id > ? AND context IS NOT NULL AND context NOT IN ('', '[]') "
+                "ORDER BY id LIMIT ?",
+                (last_id, chunk_size)
             )
+            rows = await cursor.fetchall()
+            if not rows:
+                break
+            turns = []
+            for user_id, raw in rows:
+                try:
+                    context = json.loads(raw)[-MAX_CONTEXT_MESSAGES:]
+                except (TypeError, ValueError):
+                    context = []
+                for seq, msg in enumerate(context, start=1):
+                    turns.append((
+                        user_id, seq % MAX_CONTEXT_MESSAGES, seq,
+                        msg.get('role', 'user'), msg.get('content', ''), msg.get('timestamp')
+                    ))
+            await conn.executemany(
+                'INSERT OR REPLACE INTO context_turns (user_id, slot, seq, role, content, ts) VALUES (?, ?, ?, ?, ?, ?)',
+                turns
+            )
+            await conn.executemany(
+                'UPDATE users SET context = NULL WHERE id = ?',
+                [(row[0],) for row in rows]
+            )
+            migrated += len(rows)
+            last_id = rows[-1][0]
+        if migrated:
+            logger.info(f"Перенесены контексты {migrated} пользователей в context_turns")
+    
+    async def add_message(self, user_id:int, model:str, role:str, content:str):
+        """Ставит сообщение в очередь отложенной записи (без отдельного коммита).
+        Триггер trg_messages_context добавляет его и в кольцо контекста."""
+        now = datetime.now()
+        await self.write_behind.put(
+            'INSERT INTO messages (user_id, model, role, content, ts, ts_at) VALUES (?,?,?,?,?,?)',
+            (user_id, model, role, content, now.isoformat(), to_epoch(now)),
+            key=user_id
+        )
+    
+    async def clear_context(self, user_id: int):
+        """Очищает кольцо контекста и конспект (через ту же очередь, чтобы не обогнать добавления).
+        Нумерация seq после очистки начинается заново, поэтому сбрасывается и context_summary_seq"""
+        await self.write_behind.put('DELETE FROM context_turns WHERE user_id = ?', (user_id,), key=user_id)
+        await self.write_behind.put(
+            'UPDATE users SET context_summary = NULL, context_summary_seq = 0 WHERE id = ?',
+            (user_id,), key=user_id
+        )
+    
+    async def save_context_summary(self, user_id: int, summary: str, seq: int):
+        """Сохраняет конспект реплик до seq включительно"""
+        await self.write_behind.put(
+            'UPDATE users SET context_summary = ?, context_summary_seq = ? WHERE id = ?',
+            (summary, seq, user_id), key=user_id
+        )
+    
+    async def get_context(self, user_id: int, limit: int = MAX_CONTEXT_MESSAGES) -> List[Dict[str, Any]]:
+        """Последние limit реплик пользователя в хронологическом порядке"""
+        if self.write_behind.has_pending(user_id):
+            await self.write_behind.flush()
+        async with self.acquire(readonly=True) as conn:
+            return await self._fetch_context(conn, user_id, limit)
+    
+    @staticmethod
+    async def _fetch_context(conn: aiosqlite.Connection, user_id: int, limit: int = MAX_CONTEXT_MESSAGES) -> List[Dict[str, Any]]:
+        cursor = await conn.execute(
+            'SELECT seq, role, content, ts FROM context_turns WHERE user_id = ? ORDER BY seq DESC LIMIT ?',
+            (user_id, limit)
+        )
+        rows = await cursor.fetchall()
+        return [
+            {'seq': row['seq'], 'role': row['role'], 'content': row['content'], 'timestamp': row['ts']}
+            for row in reversed(rows)
+        ]
 
     async def increment_source_user(self, source: str):
         if not source:
@@ -301,107 +1131,160 @@ class Database:
             )
     
     async def get_source_stats(self) -> List[Tuple[str, int, int, int]]:
-        """Получает статистику по источникам с учетом покупок"""
-        async with self.acquire() as conn:
-            # Получаем базовую статистику источников
+        """Получает статистику по источникам с учетом покупок (премиум - из свёртки компактора)"""
+        async with self.acquire(readonly=True) as conn:
             cursor = await conn.execute('''
                 SELECT 
                     s.source,
                     s.users_count,
                     s.requests_count,
-                    COUNT(DISTINCT CASE WHEN sub.user_id IS NOT NULL THEN u.id END) as premium_count
+                    COALESCE(p.premium_users, 0) as premium_count
                 FROM sources s
-                LEFT JOIN users u ON u.source = s.source
-                LEFT JOIN subscriptions sub ON sub.user_id = u.id 
-                    AND datetime(sub.expires_at) > datetime('now')
-                GROUP BY s.source
+                LEFT JOIN stats_source_premium p ON p.source = s.source
                 ORDER BY s.users_count DESC
             ''')
             return [tuple(row) async for row in cursor]
     
     async def save_subscription(self, user_id: int, expires_at: datetime):
         async with self.acquire() as conn:
-            await conn.execute('REPLACE INTO subscriptions (user_id, expires_at) VALUES (?,?)',
-                               (user_id, expires_at.isoformat()))
+            await conn.execute('REPLACE INTO subscriptions (user_id, expires_at, expires_at_ts) VALUES (?,?,?)',
+                               (user_id, expires_at.isoformat(), to_epoch(expires_at)))
+        subscription_cache.invalidate(user_id)
 
     async def has_active_subscription(self, user_id: int) -> bool:
-        async with self.acquire() as conn:
+        cached = subscription_cache.lookup(user_id)
+        if cached is not None:
+            return cached
+        async with self.acquire(readonly=True) as conn:
             cursor = await conn.execute('SELECT expires_at FROM subscriptions WHERE user_id=?', (user_id,))
             row = await cursor.fetchone()
-            if not row or not row['expires_at']:
-                return False
-            try:
-                return datetime.fromisoformat(row['expires_at']) >= datetime.now()
-            except Exception:
-                return False
+        return subscription_cache.store(user_id, parse_expires_at(row['expires_at'] if row else None))
+    
+    async def admit_message(self, user_id: int, source: str, limit: int) -> Admission:
+        """Допуск сообщения одной транзакцией писателя: снятие отметки о блокировке,
+        проверка подписки (из кэша или в той же транзакции), проверка лимита и приращение
+        счётчика одним UPSERT ... RETURNING, учёт запроса по источнику"""
+        period = self.quotas.period('daily_messages')
+        premium = subscription_cache.lookup(user_id)
+        async with self.acquire() as conn:
+            await conn.execute('BEGIN IMMEDIATE')
+            await conn.execute('UPDATE users SET bot_blocked = 0 WHERE id = ? AND bot_blocked = 1', (user_id,))
+            if premium is None:
+                cursor = await conn.execute('SELECT expires_at FROM subscriptions WHERE user_id=?', (user_id,))
+                row = await cursor.fetchone()
+                premium = subscription_cache.store(user_id, parse_expires_at(row['expires_at'] if row else None))
+            # Подписчикам счётчик увеличивается всегда, остальным - только пока он меньше лимита
+            cursor = await conn.execute(
+                'INSERT INTO daily_messages (user_id, date, count) VALUES (?, ?, 1) '
+                'ON CONFLICT(user_id, date) DO UPDATE SET count = count + 1 WHERE ? OR count < ? '
+                'RETURNING count',
+                (user_id, period, premium, limit)
+            )
+            rows = await cursor.fetchall()
+            if rows:
+                allowed, count = True, rows[0]['count']
+                if source:
+                    await conn.execute(
+                        'INSERT INTO sources (source, users_count, requests_count) VALUES (?, 0, 1) '
+                        'ON CONFLICT(source) DO UPDATE SET requests_count = requests_count + 1',
+                        (source,)
+                    )
+            else:
+                # Лимит исчерпан, UPSERT ничего не изменил
+                cursor = await conn.execute('SELECT count FROM daily_messages WHERE user_id=? AND date=?', (user_id, period))
+                row = await cursor.fetchone()
+                allowed, count = False, row['count'] if row else limit
+        self.quotas.sync('daily_messages', user_id, count)
+        return Admission(allowed, premium, count)
     
     async def get_daily_message_count(self, user_id: int) -> int:
         """Получает количество сообщений пользователя за сегодня"""
-        today = datetime.now().date().isoformat()
-        async with self.acquire() as conn:
-            cursor = await conn.execute('SELECT count FROM daily_messages WHERE user_id=? AND date=?', (user_id, today))
-            row = await cursor.fetchone()
-            return row['count'] if row else 0
+        return await self.quotas.get('daily_messages', user_id)
     
     async def increment_daily_message_count(self, user_id: int) -> int:
         """Увеличивает счетчик сообщений за сегодня и возвращает новое значение"""
-        today = datetime.now().date().isoformat()
-        async with self.acquire() as conn:
-            await conn.execute(
-                'INSERT INTO daily_messages (user_id, date, count) VALUES (?, ?, 1) '
-                'ON CONFLICT(user_id, date) DO UPDATE SET count = count + 1',
-                (user_id, today)
-            )
-            cursor = await conn.execute('SELECT count FROM daily_messages WHERE user_id=? AND date=?', (user_id, today))
-            row = await cursor.fetchone()
-            return row['count'] if row else 0
+        _, count = await self.quotas.try_reserve('daily_messages', user_id)
+        return count
     
     async def get_monthly_image_count(self, user_id: int) -> int:
         """Получает количество сгенерированных изображений за текущий месяц"""
-        current_month = datetime.now().strftime('%Y-%m')
-        async with self.acquire() as conn:
-            cursor = await conn.execute('SELECT count FROM monthly_images WHERE user_id=? AND month=?', (user_id, current_month))
-            row = await cursor.fetchone()
-            return row['count'] if row else 0
+        return await self.quotas.get('monthly_images', user_id)
     
     async def increment_monthly_image_count(self, user_id: int) -> int:
         """Увеличивает счетчик генераций изображений за месяц и возвращает новое значение"""
-        current_month = datetime.now().strftime('%Y-%m')
-        async with self.acquire() as conn:
-            await conn.execute(
-                'INSERT INTO monthly_images (user_id, month, count) VALUES (?, ?, 1) '
-                'ON CONFLICT(user_id, month) DO UPDATE SET count = count + 1',
-                (user_id, current_month)
-            )
-            cursor = await conn.execute('SELECT count FROM monthly_images WHERE user_id=? AND month=?', (user_id, current_month))
-            row = await cursor.fetchone()
-            return row['count'] if row else 0
+        _, count = await self.quotas.try_reserve('monthly_images', user_id)
+        return count
 
     @asynccontextmanager
-    async def acquire(self):
-        """Контекстный менеджер для работы с соединением"""
-        if not self._connection:
+    async def acquire(self, readonly: bool = False):
+        """Контекстный менеджер для работы с соединением.
+        
+        readonly=True выдаёт соединение из пула читателей: весь блок выполняется
+        в одной читающей транзакции, то есть видит согласованный снимок WAL и
+        не ждёт писателя. Без флага выдаётся единственное соединение-писатель,
+        доступ к которому сериализован.
+        """
+        if not self._initialized:
             await self.initialize()
-            
-        try:
-            self._connection.row_factory = aiosqlite.Row
-            yield self._connection
-            await self._connection.commit()
-        except Exception as e:
-            if self._connection:
-                await self._connection.rollback()
-            raise
+        
+        if readonly and self._reader_connections:
+            conn = await self._readers.get()
+            try:
+                await conn.execute('BEGIN')
+                try:
+                    yield conn
+                finally:
+                    await conn.rollback()
+            finally:
+                self._readers.put_nowait(conn)
+            return
+        
+        async with self._write_lock:
+            try:
+                self._connection.row_factory = aiosqlite.Row
+                yield self._connection
+                await self._connection.commit()
+            except BaseException:
+                # В том числе при отмене задачи: иначе начатая BEGIN IMMEDIATE транзакция осталась бы
+                # открытой на общем соединении, и её закоммитила бы чужая следующая запись
+                if self._connection:
+                    await asyncio.shield(self._connection.rollback())
+                raise
     
     async def close(self):
-        """Закрытие соединения с базой данных"""
+        """Закрытие соединений с базой данных"""
+        for task in (self._backfill_task, self._compactor_task):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._backfill_task = None
+        self._compactor_task = None
+        if self.maintenance:
+            await self.maintenance.stop()
+        if self._initialized:
+            # Дописываем очередь до закрытия писателя
+            await self.write_behind.stop()
+        for conn in self._reader_connections:
+            try:
+                await conn.close()
+            except Exception as e:
+                logger.warning(f"Ошибка при закрытии читающего соединения: {e}")
+        self._reader_connections = []
+        self._readers = None
         if self._connection:
             await self._connection.close()
             self._connection = None
-            self._initialized = False
+        self._initialized = False
     
     async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получение данных пользователя по ID"""
-        async with self.acquire() as conn:
+        # Сначала дописываем ещё не сброшенные реплики, чтобы контекст был полным
+        if self.write_behind.has_pending(user_id):
+            await self.write_behind.flush()
+        async with self.acquire(readonly=True) as conn:
             cursor = await conn.execute('SELECT * FROM users WHERE id = ?', (user_id,))
             row = await cursor.fetchone()
             
@@ -413,25 +1296,75 @@ class Database:
                     'join_date': datetime.fromisoformat(row['join_date']) if row['join_date'] else datetime.now(),
                     'last_active': datetime.fromisoformat(row['last_active']) if row['last_active'] else datetime.now(),
                     'current_model': row['current_model'],
-                    'context': json.loads(row['context']) if row['context'] else [],
-                    'source': row['source']
+                    'context': await self._fetch_context(conn, user_id),
+                    'context_summary': row['context_summary'],
+                    'context_summary_seq': row['context_summary_seq'] or 0,
+                    'source': row['source'],
+                    'auto_message': bool(row['auto_message']),
+                    'bot_blocked': bool(row['bot_blocked'])
                 }
             return None
     
+    # Поле записи пользователя -> колонки users (для дат рядом пишется epoch-колонка)
+    USER_FIELD_COLUMNS = {
+        'username': ('username',),
+        'name': ('name',),
+        'join_date': ('join_date', 'join_at'),
+        'last_active': ('last_active', 'last_active_at'),
+        'current_model': ('current_model',),
+        'source': ('source',),
+        'auto_message': ('auto_message',),
+        'bot_blocked': ('bot_blocked',),
+    }
+    
+    async def update_user_fields(self, user_id: int, fields: Dict[str, Any]) -> None:
+        """Точечный UPDATE только изменённых полей через очередь отложенной записи.
+        Одинаковые наборы полей (обычно last_active) сбрасываются одним executemany"""
+        if not fields:
+            return
+        assignments = []
+        params = []
+        for field in sorted(fields):
+            value = fields[field]
+            columns = self.USER_FIELD_COLUMNS[field]
+            assignments.extend(f'{column} = ?' for column in columns)
+            if len(columns) == 2:
+                params.extend((value.isoformat(), to_epoch(value)))
+            else:
+                params.append(value)
+        await self.write_behind.put(
+            f'UPDATE users SET {", ".join(assignments)} WHERE id = ?',
+            (*params, user_id),
+            key=user_id
+        )
+    
     async def save_user(self, user_data: Dict[str, Any]) -> None:
-        """Сохранение данных пользователя"""
+        """Сохранение данных пользователя.
+        UPSERT вместо INSERT OR REPLACE: существующая строка обновляется на месте,
+        поэтому триггеры свёрток видят вставку только для новых пользователей"""
         async with self.acquire() as conn:
             await conn.execute('''
-                INSERT OR REPLACE INTO users (id, username, name, join_date, last_active, current_model, context, source, auto_message)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                INSERT INTO users (id, username, name, join_date, last_active, join_at, last_active_at, current_model, source, auto_message)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    username = excluded.username,
+                    name = excluded.name,
+                    join_date = excluded.join_date,
+                    last_active = excluded.last_active,
+                    join_at = excluded.join_at,
+                    last_active_at = excluded.last_active_at,
+                    current_model = excluded.current_model,
+                    source = excluded.source,
+                    auto_message = excluded.auto_message
             ''', (
                 user_data['id'],
                 user_data['username'],
                 user_data['name'],
                 user_data['join_date'].isoformat(),
                 user_data['last_active'].isoformat(),
+                to_epoch(user_data['join_date']),
+                to_epoch(user_data['last_active']),
                 user_data['current_model'],
-                json.dumps(user_data['context'], ensure_ascii=False),
                 user_data.get('source', ''),
                 user_data.get('auto_message', False)
             ))
@@ -449,26 +1382,6 @@ class Database:
             await conn.execute('UPDATE users SET auto_message = ? WHERE id = ?', (new_value, user_id))
             return new_value
 
-    async def get_users_for_auto_message(self) -> List[Dict[str, Any]]:
-        """Получает список пользователей с включенными автосообщениями, которые не были активны более суток"""
-        async with self.acquire() as conn:
-            cursor = await conn.execute('''
-                SELECT * FROM users 
-                WHERE auto_message = 1 
-                AND datetime(last_active) <= datetime('now', '-1 day')
-                AND (bot_blocked IS NULL OR bot_blocked = 0)
-            ''')
-            users = []
-            async for row in cursor:
-                users.append({
-                    'id': row['id'],
-                    'username': row['username'],
-                    'name': row['name'],
-                    'current_model': row['current_model'],
-                    'context': json.loads(row['context']) if row['context'] else [],
-                })
-            return users
-    
     async def mark_user_blocked(self, user_id: int) -> None:
         """Отмечает пользователя как заблокировавшего бота"""
         async with self.acquire() as conn:
@@ -480,65 +1393,58 @@ class Database:
             await conn.execute('UPDATE users SET bot_blocked = 0 WHERE id = ?', (user_id,))
 
     async def get_stats(self) -> Tuple[int, int, List[Tuple[str, int]]]:
-        """Получение статистики по пользователям"""
-        async with self.acquire() as conn:
-            cursor = await conn.execute('SELECT COUNT(*) as count FROM users')
-            total_users = (await cursor.fetchone())['count']
-            
-            cursor = await conn.execute('SELECT COUNT(*) as count FROM users WHERE date(last_active) = date("now")')
-            active_today = (await cursor.fetchone())['count']
-            
-            cursor = await conn.execute('SELECT current_model, COUNT(*) as count FROM users GROUP BY current_model')
+        """Получение статистики по пользователям (из свёрток)"""
+        async with self.acquire(readonly=True) as conn:
+            cursor = await conn.execute('SELECT model, users FROM stats_model_users WHERE users > 0 ORDER BY model')
             model_stats = []
+            total_users = 0
             async for row in cursor:
-                model_stats.append((row['current_model'], row['count']))
+                model_stats.append((row['model'] or None, row['users']))
+                total_users += row['users']
+            
+            cursor = await conn.execute('SELECT active_users FROM stats_daily WHERE day = ?', (date.today().isoformat(),))
+            row = await cursor.fetchone()
+            active_today = row['active_users'] if row else 0
             
             return total_users, active_today, model_stats
     
     async def get_today_message_stats(self) -> Tuple[int, Dict[str, int]]:
-        """Возвращает количество сообщений за сегодня и по моделям"""
-        async with self.acquire() as conn:
-            cursor = await conn.execute("""
-                SELECT model, COUNT(*) as cnt
-                FROM messages
-                WHERE role='user' AND date(ts)=date('now')
-                GROUP BY model
-            """)
+        """Возвращает количество сообщений за сегодня и по моделям (из свёрток)"""
+        async with self.acquire(readonly=True) as conn:
+            cursor = await conn.execute(
+                'SELECT model, messages FROM stats_model_messages WHERE day = ?',
+                (date.today().isoformat(),)
+            )
             total = 0
             model_counts: Dict[str,int] = {}
             async for row in cursor:
-                model_counts[row['model']] = row['cnt']
-                total += row['cnt']
+                model_counts[row['model'] or None] = row['messages']
+                total += row['messages']
             return total, model_counts
 
     async def get_new_users_stats(self) -> Tuple[int, int]:
-        """Получение статистики новых пользователей за сегодня и неделю"""
-        async with self.acquire() as conn:
-            cursor = await conn.execute("""
-                SELECT COUNT(*) as count 
-                FROM users 
-                WHERE date(join_date) = date('now')
-            """)
-            new_today = (await cursor.fetchone())['count']
-            
-            cursor = await conn.execute("""
-                SELECT COUNT(*) as count 
-                FROM users 
-                WHERE date(join_date) >= date('now', '-7 days')
-            """)
-            new_week = (await cursor.fetchone())['count']
-            
-            return new_today, new_week
+        """Получение статистики новых пользователей за сегодня и неделю (из свёрток)"""
+        today = date.today()
+        async with self.acquire(readonly=True) as conn:
+            cursor = await conn.execute(
+                'SELECT day, new_users FROM stats_daily WHERE day >= ?',
+                ((today - timedelta(days=7)).isoformat(),)
+            )
+            rows = await cursor.fetchall()
+        new_today = sum(row['new_users'] for row in rows if row['day'] == today.isoformat())
+        new_week = sum(row['new_users'] for row in rows)
+        return new_today, new_week
 
     async def get_all_user_ids(self) -> List[int]:
         """Получение списка всех ID пользователей"""
-        async with self.acquire() as conn:
+        async with self.acquire(readonly=True) as conn:
             cursor = await conn.execute('SELECT id FROM users')
             return [row['id'] async for row in cursor]
 
 class UserManager:
-    def __init__(self, db):
+    def __init__(self, db, context_builder=None):
         self.db = db
+        self.context_builder = context_builder
     
     def create_user(self, user_id, username, name, source=""):
         return {
@@ -549,16 +1455,15 @@ class UserManager:
             'last_active': datetime.now(),
             'current_model': 'Подруга',
             'context': [],
+            'context_summary': None,
+            'context_summary_seq': 0,
             'source': source,
             'auto_message': True  # По умолчанию включаем автосообщения
         }
     
-    def add_to_context(self, user_data, role, content):
-# Асинхронно пишем в messages
-        try:
-            asyncio.create_task(db.add_message(user_data['id'], user_data['current_model'], role, content))
-        except RuntimeError:
-            pass
+    async def add_to_context(self, user_data, role, content):
+        # Пишем в messages через очередь отложенной записи
+        await self.db.add_message(user_data['id'], user_data['current_model'], role, content)
         user_data['context'].append({
             'role': role,
             'content': content,
@@ -569,95 +1474,167 @@ class UserManager:
         if len(user_data['context']) > MAX_CONTEXT_MESSAGES:
             user_data['context'] = user_data['context'][-MAX_CONTEXT_MESSAGES:]
     
-    def clear_context(self, user_data):
+    async def clear_context(self, user_data):
         user_data['context'] = []
+        user_data['context_summary'] = None
+        user_data['context_summary_seq'] = 0
+        if self.context_builder:
+            self.context_builder.reset(user_data['id'])
+        await self.db.clear_context(user_data['id'])
     
     def update_activity(self, user_data):
         user_data['last_active'] = datetime.now()
 
+class UserSession(dict):
+    """Запись пользователя на время обработки одного апдейта.
+    
+    Загружается один раз, передаётся в MessageProcessor и обработчики ответов и
+    запоминает, какие сохраняемые поля изменились. В конце апдейта flush() пишет
+    один UPDATE только с этими полями (для нового пользователя - полную вставку).
+    Изменения отслеживаются через присваивание по ключу: session['field'] = value.
+    """
+    
+    def __init__(self, db: 'Database', data: Dict[str, Any], is_new: bool = False):
+        super().__init__(data)
+        self.db = db
+        self.is_new = is_new
+        self.dirty: set = set()
+    
+    @classmethod
+    async def load(cls, db: 'Database', user_id: int) -> Optional['UserSession']:
+        data = await db.get_user(user_id)
+        return cls(db, data) if data else None
+    
+    def __setitem__(self, key, value):
+        if key in Database.USER_FIELD_COLUMNS and (key not in self or self[key] != value):
+            self.dirty.add(key)
+        super().__setitem__(key, value)
+    
+    def synced(self, key, value):
+        """Обновляет поле, которое уже записано в БД в обход сессии"""
+        super().__setitem__(key, value)
+        self.dirty.discard(key)
+    
+    async def flush(self):
+        if self.is_new:
+            await self.db.save_user(self)
+            self.is_new = False
+        elif self.dirty:
+            await self.db.update_user_fields(self['id'], {field: self[field] for field in self.dirty})
+        self.dirty.clear()
+
 class AIService:
     @staticmethod
-    async def call_openai_api(messages, model="gpt-4o-mini"):
-        url = "https://api.openai.com/v1/chat/completions"
+    def stream_completion(url, api_key, payload, provider) -> LLMStream:
+        """Потоковый запрос к OpenAI-совместимому API: async for по фрагментам или await за полным текстом"""
         headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
+            "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
-        
-        data = {
-            "model": model,
-            "messages": messages,
-            "max_tokens": 1024,
-            "temperature": 0.7,
-            "stream": True
-        }
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=data) as response:
-                if response.status != 200:
-                    raise Exception(f"OpenAI API error: {response.status}")
-                
-                content = ""
-                async for line in response.content:
-                    if line.startswith(b'data: '):
-                        json_line = line[6:].strip()
-                        if json_line == b'[DONE]':
-                            break
-                        try:
-                            chunk = json.loads(json_line)
-                            if 'content' in chunk['choices'][0]['delta']:
-                                content += chunk['choices'][0]['delta']['content']
-                        except (json.JSONDecodeError, KeyError, IndexError) as e:
-                            logger.warning(f"Skipping malformed API chunk: {e}")
-                            continue
-                return content
+        session = http_clients.session(url)
+        return LLMStream(
+            lambda: session.post(url, headers=headers, json={**payload, "stream": True}),
+            provider
+        )
+    
+    @staticmethod
+    def stream_openai_api(messages, model="gpt-4o-mini"):
+        return AIService.stream_completion(
+            LLM_API_URLS['openai'],
+            OPENAI_API_KEY,
+            {"model": model, "messages": messages, "max_tokens": 1024, "temperature": 0.7},
+            "OpenAI"
+        )
+    
+    @staticmethod
+    def stream_groq_api(messages, model="llama-3.3-70b-versatile"):
+        return AIService.stream_completion(
+            LLM_API_URLS['groq'],
+            GROQ_API_KEY,
+            {"model": model, "messages": messages, "max_tokens": 1024, "temperature": 0.9},
+            "Groq"
+        )
+    
+    @staticmethod
+    async def call_openai_api(messages, model="gpt-4o-mini"):
+        return await AIService.stream_openai_api(messages, model)
     
     @staticmethod
     async def call_groq_api(messages, model="llama-3.3-70b-versatile"):
-        url = "https://api.groq.com/openai/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {GROQ_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "model": model,
-            "messages": messages,
-            "max_tokens": 1024,
-            "temperature": 0.9,
-            "stream": True
-        }
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=data) as response:
-                if response.status != 200:
-                    raise Exception(f"Groq API error: {response.status}")
-                
-                content = ""
-                async for line in response.content:
-                    if line.startswith(b'data: '):
-                        json_line = line[6:].strip()
-                        if json_line == b'[DONE]':
-                            break
-                        try:
-                            chunk = json.loads(json_line)
-                            if 'content' in chunk['choices'][0]['delta']:
-                                content += chunk['choices'][0]['delta']['content']
-                        except (json.JSONDecodeError, KeyError, IndexError) as e:
-                            logger.warning(f"Skipping malformed API chunk: {e}")
-                            continue
-                return content
-
-async def check_daily_message_limit(user_id: int) -> bool:
-    """Проверяет, не превышен ли лимит сообщений в день"""
-    # Проверяем подписку
-    has_subscription = await db.has_active_subscription(user_id)
-    if has_subscription:
-        return True  # Подписчики могут отправлять неограниченное количество сообщений
+        return await AIService.stream_groq_api(messages, model)
+
+class StreamingReply:
+    """Показывает ответ LLM по мере генерации правками одного сообщения-черновика.
+    
+    Черновик отправляется, как только в видимом тексте появляется конец предложения,
+    дальше редактируется не чаще раза в edit_interval секунд (правка идёт в фоне и не
+    задерживает чтение потока). Служебные теги [действия: ...], [image: ...] и
+    [IMAGE_PROMPT] вырезаются на лету, незакрытый тег в хвосте не показывается.
+    Reply-клавиатуру нельзя прикрепить правкой, поэтому финальный ответ отправляется
+    обработчиком заново, а черновик удаляется через discard().
+    """
+    
+    _SENTENCE_END_RE = re.compile(r'[.!?…](?:\s|$)|\n')
+    
+    def __init__(self, message: types.Message, edit_interval: float = 1.0):
+        self.message = message
+        self.edit_interval = edit_interval
+        self.parts: List[str] = []
+        self.draft: Optional[types.Message] = None
+        self._shown = ""
+        self._last_edit = 0.0
+        self._task: Optional[asyncio.Task] = None
+    
+    @classmethod
+    def visible_text(cls, text: str) -> str:
+        text = parse_response(text).text
+        # Промпт изображения без закрывающего "|" ещё не дописан
+        prompt_start = text.find('[IMAGE_PROMPT]')
+        if prompt_start >= 0:
+            text = text[:prompt_start]
+        # Незакрытый тег в хвосте
+        last_open = text.rfind('[')
+        if last_open > text.rfind(']'):
+            text = text[:last_open]
+        return text.strip()[:4096]
+    
+    async def feed(self, delta: str):
+        self.parts.append(delta)
+        if self._task and not self._task.done():
+            return
+        if self.draft is not None and time.monotonic() - self._last_edit < self.edit_interval:
+            return
+        text = self.visible_text(''.join(self.parts))
+        if not text or text == self._shown:
+            return
+        if self.draft is None and not self._SENTENCE_END_RE.search(text):
+            return
+        self._task = asyncio.create_task(self._show(text))
+    
+    async def _show(self, text: str):
+        self._last_edit = time.monotonic()
+        try:
+            if self.draft is None:
+                self.draft = await self.message.answer(text)
+            else:
+                await self.draft.edit_text(text)
+            self._shown = text
+        except TelegramRetryAfter as e:
+            # Откладываем следующую правку на время, которое попросил Telegram
+            self._last_edit = time.monotonic() + e.retry_after
+        except Exception as e:
+            logger.debug(f"Не удалось обновить черновик ответа: {e}")
     
-    # Проверяем лимит для бесплатных пользователей
-    daily_count = await db.get_daily_message_count(user_id)
-    return daily_count < DAILY_MESSAGE_LIMIT
+    async def discard(self):
+        """Дожидается текущей правки и удаляет черновик"""
+        if self._task and not self._task.done():
+            await self._task
+        if self.draft is not None:
+            try:
+                await self.draft.delete()
+            except Exception as e:
+                logger.debug(f"Не удалось удалить черновик ответа: {e}")
+            self.draft = None
 
 async def check_monthly_image_limit(user_id: int) -> bool:
     """Проверяет, не превышен ли лимит генераций изображений в месяц"""
@@ -695,21 +1672,21 @@ class ImageGenerator:
             "num_steps": 40,
             "guidance_scale": 7.5,
         }
-        async with aiohttp.ClientSession() as session:
-            url = f"{CLOUDFLARE_API_URL}@cf/black-forest-labs/flux-1-schnell"
-            try:
-                async with session.post(url, headers=headers, json=data) as response:
-                    try:
-                        async with asyncio.timeout(30.0):
-                            if response.status == 200:
-                                result = await response.json()
-                                image_base64 = result.get("result", {}).get("image")
-                                if image_base64:
-                                    return base64.b64decode(image_base64)
-                    except asyncio.TimeoutError:
-                        logger.error("Cloudflare image generation timed out after 30 seconds")
-            except Exception as e:
-                logger.error(f"Cloudflare image generation timeout/error: {e}")
+        url = f"{CLOUDFLARE_API_URL}@cf/black-forest-labs/flux-1-schnell"
+        session = http_clients.session(url)
+        try:
+            async with session.post(url, headers=headers, json=data) as response:
+                try:
+                    async with asyncio.timeout(30.0):
+                        if response.status == 200:
+                            result = await response.json()
+                            image_base64 = result.get("result", {}).get("image")
+                            if image_base64:
+                                return base64.b64decode(image_base64)
+                except asyncio.TimeoutError:
+                    logger.error("Cloudflare image generation timed out after 30 seconds")
+        except Exception as e:
+            logger.error(f"Cloudflare image generation timeout/error: {e}")
         return None
     
     @staticmethod
@@ -846,51 +1823,21 @@ class KeyboardManager:
         )
 
 class MessageProcessor:
-    def __init__(self, user_manager, ai_service, image_generator):
+    def __init__(self, user_manager, ai_service, image_generator, llm_router, context_builder):
         self.user_manager = user_manager
         self.ai_service = ai_service
         self.image_generator = image_generator
+        self.llm_router = llm_router
+        self.context_builder = context_builder
         # Кэш для хранения действий пользователей
         self.user_actions = {}
     
-    def extract_actions(self, text):
-        """Извлекает предложенные действия из текста ответа"""
-        actions = []
-        
-        # Ищем правильный формат [действия: ]
-        matches = re.findall(r'\[действия:(.*?)\]', text, re.DOTALL | re.IGNORECASE)
-        
-        if not matches:
-            # Альтернативные форматы
-            alt_matches = re.findall(r'(?:^|\n|\r)(?:Варианты\s*)?[Дд]ействия?:?\s*(.*?)(?:\n|$)', text, re.MULTILINE)
-            if alt_matches:
-                matches = alt_matches
-        
-        if matches:
-            actions_text = matches[-1].strip()
-            raw_actions = [action.strip() for action in actions_text.split(',')]
-            
-            cleaned_actions = []
-            for action in raw_actions:
-                cleaned_action = re.sub(
-                    r'^(первый|второй|третий|один|два|три)?\s*(вариант|действие)?\s*(продолжени[еяй]|диалога)?(:|\.|\s)*', 
-                    '', 
-                    action, 
-                    flags=re.IGNORECASE
-                ).strip()
-                
-                if cleaned_action:
-                    cleaned_actions.append(cleaned_action)
-            
-            actions = cleaned_actions[:2]
-            
-            # Удаляем упоминание действий из текста
-            text = re.sub(r'\[действия:.*?\]', '', text, flags=re.DOTALL | re.IGNORECASE).strip()
-            text = re.sub(r'(?:^|\n|\r)(?:Варианты\s*)?[Дд]ействия?:?\s*.*?(?:\n|$)', '', text, flags=re.MULTILINE).strip()
-        
-        return text, actions
+    async def _complete(self, model_info, messages, on_delta=None):
+        """Запрос к LLM через маршрутизатор; с on_delta фрагменты ответа передаются по мере прихода"""
+        provider = 'groq' if model_info.get('api') == 'groq' else 'openai'
+        return await self.llm_router.complete(provider, model_info['model'], messages, on_delta)
     
-    async def process_message(self, user_data, message_text):
+    async def process_message(self, user_data, message_text, on_delta=None):
         response = None
         try:
             # Получаем настройки модели
@@ -902,40 +1849,27 @@ class MessageProcessor:
                 model_info["prompt"]
             ).format(name=user_data['name'])
             
-            messages = [{"role": "system", "content": system_prompt}]
-            
-            # Добавляем контекст
-            for msg in user_data.get('context', []):
-                messages.append({
-                    "role": msg.get('role', 'user'),
-                    "content": msg.get('content', '')
-                })
-            
-            # Добавляем текущее сообщение
-            messages.append({"role": "user", "content": str(message_text)})
+            # Системный промпт с конспектом, последние реплики в бюджете токенов модели и текущее сообщение
+            messages = self.context_builder.build(user_data, system_prompt, str(message_text), model_info['model'])
             
             # Добавляем в контекст
-            self.user_manager.add_to_context(user_data, "user", str(message_text))
+            await self.user_manager.add_to_context(user_data, "user", str(message_text))
             
-            # Устанавливаем таймаут для API-запроса (30 секунд)
+            # Таймауты (не больше 30 секунд) и переключение провайдеров - на стороне маршрутизатора
             try:
-                if model_info.get('api') == 'groq':
-                    response = await asyncio.wait_for(
-                        self.ai_service.call_groq_api(messages, model_info['model']),
-                        timeout=30.0
-                    )
-                else:
-                    response = await asyncio.wait_for(
-                        self.ai_service.call_openai_api(messages, model_info['model']),
-                        timeout=30.0
-                    )
+                response = await self._complete(model_info, messages, on_delta)
                 
                 # Добавляем ответ в контекст, если он есть
                 if response:
-                    self.user_manager.add_to_context(user_data, "assistant", response)
+                    await self.user_manager.add_to_context(user_data, "assistant", response)
                 
                 return response
                 
+            except LLMOverloaded as e:
+                # Сброс нагрузки - ожидаемая ситуация, алерт админу не нужен
+                logger.warning(f"LLM request shed for user {user_data.get('id')}: {e}")
+                raise Exception("Сейчас очень много запросов. Пожалуйста, попробуйте через минуту.") from e
+                
             except asyncio.TimeoutError as e:
                 error_msg = f"API request timed out for user {user_data.get('id')}"
                 logger.error(error_msg)
@@ -966,14 +1900,19 @@ class MessageProcessor:
             logger.error(error_msg, exc_info=True)
             raise Exception("Произошла непредвиденная ошибка. Пожалуйста, попробуйте позже.") from e
     
-    async def handle_lovistnica_response(self, message, response_text):
+    async def handle_lovistnica_response(self, message, response_text, user_data=None, reply=None):
         user_id = message.from_user.id
-        user_data = await db.get_user(user_id)
-        clean_text, actions = self.extract_actions(response_text)
+        if user_data is None:
+            user_data = await db.get_user(user_id)
+        parsed = parse_response(response_text)
+        clean_text, actions = parsed.text, parsed.actions
         if actions:
             self.user_actions[user_id] = actions
-        image_prompts = re.findall(r'\[image:\s*(.*?)\]', clean_text, re.IGNORECASE)
+        image_prompts = parsed.images
         keyboard = KeyboardManager.create_dynamic_keyboard(actions) if actions else KeyboardManager.create_quick_replies("Любовница", user_data)
+        if reply:
+            # Финальный ответ уходит новым сообщением с клавиатурой вместо черновика
+            await reply.discard()
         if image_prompts:
             # Проверяем лимиты генерации изображений
             if not await check_monthly_image_limit(user_id):
@@ -988,7 +1927,6 @@ class MessageProcessor:
                 return
             
             await bot.send_chat_action(message.chat.id, ChatAction.UPLOAD_PHOTO)
-            clean_text = re.sub(r'\[image:.*?\]', '', clean_text).strip()
             if clean_text:
                 try:
                     await message.answer(clean_text, parse_mode="Markdown", reply_markup=keyboard)
@@ -1022,14 +1960,19 @@ class MessageProcessor:
                 logger.warning(f"Markdown parsing failed in lovistnica final: {e}, sending as plain text")
                 await message.answer(clean_text, reply_markup=keyboard)
     
-    async def handle_regular_response(self, message, response_text, model_name):
+    async def handle_regular_response(self, message, response_text, model_name, user_data=None, reply=None):
         user_id = message.from_user.id
-        user_data = await db.get_user(user_id)
-        clean_text, actions = self.extract_actions(response_text)
+        if user_data is None:
+            user_data = await db.get_user(user_id)
+        parsed = parse_response(response_text)
+        clean_text, actions = parsed.text, parsed.actions
         if actions:
             self.user_actions[user_id] = actions
-        image_prompts = re.findall(r'\[IMAGE_PROMPT\]\s*(.*?)\|(.*?)(?=\[IMAGE_PROMPT\]|$)', clean_text, re.DOTALL)
+        image_prompts = parsed.prompts
         keyboard = KeyboardManager.create_dynamic_keyboard(actions) if actions else KeyboardManager.create_quick_replies(model_name, user_data)
+        if reply:
+            # Финальный ответ уходит новым сообщением с клавиатурой вместо черновика
+            await reply.discard()
         if image_prompts:
             # Проверяем лимиты генерации изображений
             if not await check_monthly_image_limit(user_id):
@@ -1044,7 +1987,6 @@ class MessageProcessor:
                 return
             
             await bot.send_chat_action(message.chat.id, ChatAction.UPLOAD_PHOTO)
-            clean_text = re.sub(r'\[IMAGE_PROMPT\].*?\|', '', clean_text, flags=re.DOTALL).strip()
             if clean_text:
                 try:
                     await message.answer(clean_text, parse_mode="Markdown", reply_markup=keyboard)
@@ -1089,11 +2031,65 @@ DAILY_MESSAGE_LIMIT = 20  # Лимит сообщений в день для б
 MONTHLY_IMAGE_LIMIT = 150  # Лимит генераций изображений для подписчиков
 
 # Инициализация сервисов
-db = Database(DB_PATH)
-user_manager = UserManager(db)
+db = Database(
+    DB_PATH,
+    read_pool_size=globals().get('DB_READ_POOL_SIZE', 4),
+    flush_interval=globals().get('DB_FLUSH_INTERVAL_MS', 500) / 1000,
+    flush_batch_size=globals().get('DB_FLUSH_BATCH_SIZE', 200),
+    max_pending_writes=globals().get('DB_MAX_PENDING_WRITES', 10000),
+    stats_compact_interval=globals().get('STATS_COMPACT_INTERVAL', 300)
+)
+db.maintenance = MaintenanceEngine(
+    db,
+    max_hold_ms=globals().get('DB_MAINTENANCE_MAX_HOLD_MS', 50),
+    message_retention_days=globals().get('MESSAGE_RETENTION_DAYS', 7)
+)
 ai_service = AIService()
 image_generator = ImageGenerator()
-message_processor = MessageProcessor(user_manager, ai_service, image_generator)
+
+async def alert_llm_circuit_open(key, reason):
+    await error_monitor.log_critical_error("LLM_CIRCUIT_OPEN", f"{key} отключён: {reason}")
+
+llm_admission = LLMAdmission(LLM_PROVIDER_LIMITS)
+# Пул соединений не меньше допуска: иначе допущенные запросы ждали бы соединение в aiohttp
+for provider, limit in LLM_PROVIDER_LIMITS.items():
+    if provider in LLM_API_URLS:
+        http_clients.set_host_limit(LLM_API_URLS[provider], limit.get('concurrency', 10))
+llm_router = LLMRouter(
+    {'groq': ai_service.stream_groq_api, 'openai': ai_service.stream_openai_api},
+    failover=LLM_FAILOVER,
+    hedging=LLM_HEDGING,
+    on_circuit_open=alert_llm_circuit_open,
+    admission=llm_admission
+)
+
+async def summarize_context(messages):
+    # Конспект - фоновая работа, не должен отнимать LLM у ответов пользователям
+    llm_lane.set('background')
+    return await llm_router.complete('openai', 'gpt-4o-mini', messages)
+
+context_builder = ContextBuilder(
+    summarize_context,
+    db.save_context_summary,
+    budgets=CONTEXT_TOKEN_BUDGETS,
+    default_budget=CONTEXT_TOKEN_BUDGET,
+    ring_size=MAX_CONTEXT_MESSAGES
+)
+user_manager = UserManager(db, context_builder)
+message_processor = MessageProcessor(user_manager, ai_service, image_generator, llm_router, context_builder)
+
+async def mark_blocked_chat(chat_id: int):
+    await db.mark_user_blocked(chat_id)
+    logger.info(f"Пользователь {chat_id} заблокировал бота, отмечаем в базе")
+
+# Все запросы бота идут через планировщик: подключается к сессии в main()
+outbound = OutboundScheduler(
+    global_rate=OUTBOUND_GLOBAL_RATE,
+    chat_rate=OUTBOUND_CHAT_RATE,
+    interactive_reserve=OUTBOUND_INTERACTIVE_RESERVE,
+    on_blocked=mark_blocked_chat
+)
+broadcasts = BroadcastEngine(db, concurrency=BROADCAST_CONCURRENCY)
 
 # ---- Функции монетизации и прогрева ----
 
@@ -1148,39 +2144,31 @@ async def send_teaser_message(user_id: int, teaser_type: str = "photo"):
         logger.error(f"Ошибка отправки тизера: {e}")
 
 async def track_conversion_event(user_id: int, event: str, details: dict = None):
-    """Отслеживает события конверсии для аналитики"""
+    """Отслеживает события конверсии для аналитики (запись пачками через очередь отложенной записи)"""
     try:
-        async with db.acquire() as conn:
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS conversion_events (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    event TEXT,
-                    details TEXT,
-                    timestamp TEXT,
-                    FOREIGN KEY(user_id) REFERENCES users(id)
-                )
-            ''')
-            
-            await conn.execute(
-                'INSERT INTO conversion_events (user_id, event, details, timestamp) VALUES (?, ?, ?, ?)',
-                (user_id, event, json.dumps(details or {}, ensure_ascii=False), datetime.now().isoformat())
-            )
-            
-            # Логируем важные события
-            if event in ['limit_reached', 'payment_screen_shown', 'payment_completed']:
-                logger.info(f"[CONVERSION] User {user_id}: {event} - {details}")
+        details = details or {}
+        now = datetime.now()
+        await db.write_behind.put(
+            'INSERT INTO conversion_events (user_id, event, price_group, details, timestamp, ts) VALUES (?, ?, ?, ?, ?, ?)',
+            (user_id, event, details.get('group'), json.dumps(details, ensure_ascii=False), now.isoformat(), to_epoch(now))
+        )
+        
+        # Логируем важные события
+        if event in ['limit_reached', 'payment_screen_shown', 'payment_completed']:
+            logger.info(f"[CONVERSION] User {user_id}: {event} - {details}")
     except Exception as e:
         logger.error(f"Ошибка трекинга конверсии: {e}")
 
 async def get_conversion_funnel(user_id: int) -> dict:
     """Получает воронку конверсии пользователя"""
     try:
-        async with db.acquire() as conn:
+        # События пишутся через очередь - дописываем её, чтобы воронка была полной
+        await db.write_behind.flush()
+        async with db.acquire(readonly=True) as conn:
             cursor = await conn.execute('''
                 SELECT event, timestamp FROM conversion_events 
                 WHERE user_id = ? 
-                ORDER BY timestamp
+                ORDER BY ts
             ''', (user_id,))
             
             events = []
@@ -1199,22 +2187,22 @@ async def get_conversion_funnel(user_id: int) -> dict:
         return {'user_id': user_id, 'events': [], 'converted': False}
 
 async def schedule_promo_messages(user_id: int):
-    """Планирует отправку промо-сообщений для прогрева"""
+    """Планирует отправку промо-сообщений для прогрева (задачи в БД, переживают перезапуск)"""
     try:
-        # Отправляем тизер через 30 минут после регистрации
-        await asyncio.sleep(1800)  # 30 минут
-        await send_teaser_message(user_id, "photo")
-        
-        # Второй тизер через 2 часа
-        await asyncio.sleep(5400)  # 1.5 часа после первого
-        await send_teaser_message(user_id, "voice")
-        
-        # Третий тизер на следующий день
-        await asyncio.sleep(79200)  # 22 часа после второго
-        await send_teaser_message(user_id, "exclusive")
+        await job_scheduler.schedule_many(
+            (user_id, 'promo_teaser', delay, teaser_type) for delay, teaser_type in PROMO_TEASER_SCHEDULE
+        )
     except Exception as e:
         logger.error(f"Ошибка в schedule_promo: {e}")
 
+async def run_promo_teaser(user_id: int, teaser_type: Optional[str]):
+    # Промо уступает слоты отправки ответам пользователям
+    send_priority.set('auto')
+    await send_teaser_message(user_id, teaser_type or "photo")
+
+job_scheduler = JobScheduler(db)
+job_scheduler.register('promo_teaser', run_promo_teaser)
+
 # Обязательные каналы для подписки (можно задать в config.py как REQUIRED_CHANNELS)
 _DEFAULT_REQUIRED_CHANNELS: Dict[str, str] = {
     "-1002286305253": "🔞 ANORA"
@@ -1260,6 +2248,18 @@ async def log_diagnostics(polling_task, stop_event):
             async with last_update_lock:
                 since = time.time() - last_update_time
             logger.info(f"[DIAG] С момента последнего апдейта: {since:.0f} сек")
+            logger.info(f"[DIAG] Очередь отложенной записи: {db.write_behind.stats()}")
+            logger.info(f"[DIAG] Обслуживание БД: {db.maintenance.stats()}")
+            logger.info(f"[DIAG] HTTP-пулы: {http_clients.stats()}")
+            logger.info(f"[DIAG] LLM-провайдеры: {llm_router.stats()}")
+            logger.info(f"[DIAG] Потоки LLM (TTFT, токенов/с): {stream_metrics.stats()}")
+            logger.info(f"[DIAG] Допуск к LLM: {llm_admission.stats()}")
+            logger.info(f"[DIAG] Контекст: {context_builder.stats()}")
+            logger.info(f"[DIAG] Очереди пользователей: {user_mailbox.stats()}")
+            logger.info(f"[DIAG] Исходящие сообщения: {outbound.stats()}")
+            logger.info(f"[DIAG] Рассылки: {broadcasts.stats()}")
+            logger.info(f"[DIAG] Отложенные задачи: {job_scheduler.stats()}")
+            logger.info(f"[DIAG] Автосообщения: {auto_messages.stats()}, пул первых сообщений: {opener_pool.stats()}")
             
             # Проверяем, не слишком ли долго нет обновлений
             # Диагностика: если совсем нет апдейтов очень долго (6 часов) — это подозрительно.
@@ -1353,7 +2353,7 @@ async def handle_web_app_data(message: types.Message):
                 await db.save_user(user_data)
             # Обновляем модель и очищаем контекст
             user_data['current_model'] = model_name
-            user_manager.clear_context(user_data)
+            await user_manager.clear_context(user_data)
             await db.save_user(user_data)
             # Создаем клавиатуру для новой модели
             keyboard = KeyboardManager.create_quick_replies(model_name, user_data)
@@ -1372,6 +2372,7 @@ async def handle_web_app_data(message: types.Message):
         logger.warning("[WEBAPP] Неизвестное действие: %s · data=%s", action, data)
 
 async def create_stars_invoice(message: types.Message, data):
+    send_priority.set('payment')
     try:
         logger.info("[PAYMENT] Creating invoice for user %s", message.from_user.id)
         
@@ -1401,12 +2402,15 @@ async def create_stars_invoice(message: types.Message, data):
 
 @dp.pre_checkout_query()
 async def pre_checkout_query_handler(pre_checkout_q: PreCheckoutQuery):
+    send_priority.set('payment')
     await bot.answer_pre_checkout_query(pre_checkout_q.id, ok=True)
 
 @dp.message(F.successful_payment)
 async def successful_payment_handler(message: types.Message):
+    send_priority.set('payment')
     user_id = message.from_user.id
     expires_at = datetime.now() + timedelta(days=30)
+    # save_subscription сбрасывает кэш подписки, новый статус виден сразу
     await db.save_subscription(user_id, expires_at)
     
     # Трекинг успешной оплаты
@@ -1453,7 +2457,7 @@ async def start_command(message: types.Message, command: CommandObject):
         await track_conversion_event(user_id, 'user_registered', {'source': source_tag})
         
         # Запускаем прогрев нового пользователя
-        asyncio.create_task(schedule_promo_messages(user_id))
+        await schedule_promo_messages(user_id)
     elif source_tag:
         if not user_data.get('source'):
             # Сохраняем источник для старого пользователя
@@ -1629,7 +2633,7 @@ async def clear_command(message: types.Message):
     user_data = await db.get_user(user_id)
     
     if user_data:
-        user_manager.clear_context(user_data)
+        await user_manager.clear_context(user_data)
         await db.save_user(user_data)
         keyboard = KeyboardManager.create_quick_replies(user_data['current_model'])
         await message.answer("🧡 Отлично! Я очистила нашу историю разговоров как лист бумаги! 📜 Теперь можно начать совершенно новую главу нашего общения! О чём поговорим? ✨", reply_markup=keyboard)
@@ -1648,8 +2652,9 @@ async def analytics_command(message: types.Message):
         return
     
     try:
-        # Получаем статистику конверсии
-        async with db.acquire() as conn:
+        # Дописываем очередь событий, затем считаем статистику по индексам
+        await db.write_behind.flush()
+        async with db.acquire(readonly=True) as conn:
             # Общее количество пользователей
             cursor = await conn.execute('SELECT COUNT(DISTINCT user_id) FROM conversion_events')
             row = await cursor.fetchone()
@@ -1679,11 +2684,11 @@ async def analytics_command(message: types.Message):
             # A/B тест результаты
             cursor = await conn.execute("""
                 SELECT 
-                    json_extract(details, '$.group') as price_group,
+                    price_group,
                     COUNT(DISTINCT user_id) as users,
                     COUNT(DISTINCT CASE WHEN event = 'payment_completed' THEN user_id END) as converted
                 FROM conversion_events
-                WHERE json_extract(details, '$.group') IS NOT NULL
+                WHERE price_group IS NOT NULL
                 GROUP BY price_group
             """)
             
@@ -1731,11 +2736,13 @@ async def buy_command(message: types.Message):
     # Проверяем, есть ли уже активная подписка
     has_sub = await db.has_active_subscription(message.from_user.id)
     if has_sub:
-        # Получаем дату окончания подписки
-        async with db.acquire() as conn:
-            cursor = await conn.execute('SELECT expires_at FROM subscriptions WHERE user_id=?', (message.from_user.id,))
-            row = await cursor.fetchone()
-            expires_at = datetime.fromisoformat(row['expires_at']) if row and row['expires_at'] else None
+        # Получаем дату окончания подписки (после has_active_subscription она уже в кэше)
+        expires_at = subscription_cache.expires_at(message.from_user.id)
+        if expires_at is None:
+            async with db.acquire(readonly=True) as conn:
+                cursor = await conn.execute('SELECT expires_at FROM subscriptions WHERE user_id=?', (message.from_user.id,))
+                row = await cursor.fetchone()
+                expires_at = parse_expires_at(row['expires_at'] if row else None)
         
         expires_text = expires_at.strftime('%d.%m.%Y в %H:%M') if expires_at else "неизвестно"
         days_left = (expires_at - datetime.now()).days if expires_at else 0
@@ -1778,6 +2785,7 @@ async def buy_command(message: types.Message):
     await track_conversion_event(user_id, 'buy_command_used', {'price': price_amount, 'group': price_group})
     
     # Создаем счет на оплату
+    send_priority.set('payment')
     prices = [types.LabeledPrice(label="Месячная подписка", amount=price_amount)]
     await bot.send_invoice(
         chat_id=message.chat.id,
@@ -1866,22 +2874,30 @@ async def broadcast_command(message: types.Message):
     if not broadcast_text:
         return await message.answer("❌ Укажите текст рассылки после команды /broadcast")
     
-    # Получаем всех пользователей
-    user_ids = await db.get_all_user_ids()
-    
-    # Отправляем сообщение всем пользователям
-    success = 0
-    failed = 0
-    
-    for user_id in user_ids:
-        try:
-            await bot.send_message(user_id, f"📢 Рассылка от администратора:\n\n{broadcast_text}")
-            success += 1
-        except Exception as e:
-            logger.error(f"Failed to send broadcast to {user_id}: {e}")
-            failed += 1
+    # Кампания сохраняется в БД и рассылается фоновым воркером; прогресс обновляется в сообщении
+    campaign_id = await broadcasts.create(f"📢 Рассылка от администратора:\n\n{broadcast_text}", message.chat.id)
+    logger.info(f"[BROADCAST] Создана рассылка #{campaign_id}")
+
+@dp.message(Command("broadcast_cancel"))
+async def broadcast_cancel_command(message: types.Message, command: CommandObject):
+    logger.info(f"[EVENT] Получен /broadcast_cancel от {message.from_user.id}")
+    await update_last_update_time()
+    if message.from_user.id != ADMIN_ID:
+        return await message.answer("❌ У вас нет прав на выполнение этой команды.")
     
-    await message.answer(f"✅ Рассылка завершена!\nУспешно: {success}\nНе удалось: {failed}")
+    active = await broadcasts.active()
+    if not command.args:
+        if not active:
+            return await message.answer("Активных рассылок нет.")
+        listing = "\n".join(f"#{c['id']}: {c['sent']} из {c['total']}" for c in active)
+        return await message.answer(f"Активные рассылки:\n{listing}\n\nОтмена: /broadcast_cancel <номер>")
+    if not command.args.strip().lstrip('#').isdigit():
+        return await message.answer("❌ Укажите номер рассылки: /broadcast_cancel <номер>")
+    
+    if await broadcasts.cancel(int(command.args.strip().lstrip('#'))):
+        await message.answer("✅ Рассылка отменена")
+    else:
+        await message.answer("❌ Рассылка не найдена или уже завершена")
 
 # Словарь для хранения кастомных промптов
 custom_prompts = {}
@@ -1962,7 +2978,7 @@ async def select_model_callback(callback: types.CallbackQuery):
     user_data = await db.get_user(user_id)
     if user_data:
         user_data['current_model'] = model_name
-        user_manager.clear_context(user_data)
+        await user_manager.clear_context(user_data)
         await db.save_user(user_data)
         
         keyboard = KeyboardManager.create_quick_replies(model_name)
@@ -2155,12 +3171,81 @@ async def handle_text_message(message: types.Message):
         )
         return
     
-    # Если пользователь написал - значит он не заблокировал бота
-    await db.mark_user_unblocked(user_id)
+    # Сообщения одного пользователя обрабатываются по очереди, пришедшие во время ответа - одним ходом
+    await user_mailbox.submit(user_id, message)
+
+# Кнопки, которые обрабатываются отдельно и не склеиваются с текстом
+STANDALONE_TEXTS = {"🧹 Очистить диалог", "🔄 Сменить модель"}
+
+def can_merge_messages(batch: List[types.Message], message: types.Message) -> bool:
+    if message.text in STANDALONE_TEXTS or batch[-1].text in STANDALONE_TEXTS:
+        return False
+    return sum(len(m.text) + 1 for m in batch) + len(message.text) <= MAX_MESSAGE_LENGTH
+
+async def process_user_messages(user_id: int, messages: List[types.Message]):
+    """Один ход диалога для пачки сообщений пользователя из его почтового ящика"""
+    message = messages[-1]
+    text = '\n'.join(m.text for m in messages)
+    if len(messages) > 1:
+        logger.info(f"[MAILBOX] Склеено {len(messages)} сообщений пользователя {user_id}")
+    
+    # Загружаем пользователя один раз на весь ход, изменения пишутся в конце одним UPDATE
+    user_data = await UserSession.load(db, user_id)
+    if not user_data:
+        logger.error(f"Пользователь {user_id} не найден в базе данных")
+        return
+    try:
+        await process_text_message(message, user_data, text)
+    finally:
+        await user_data.flush()
+
+async def notify_mailbox_overflow(user_id: int, message: types.Message):
+    try:
+        await message.answer("⏳ Я ещё отвечаю на твои прошлые сообщения, подожди немного 💭")
+    except Exception as e:
+        logger.debug(f"Не удалось предупредить о переполнении очереди {user_id}: {e}")
+
+user_mailbox = UserMailbox(
+    process_user_messages,
+    max_pending=MAILBOX_MAX_PENDING,
+    can_merge=can_merge_messages,
+    on_overflow=notify_mailbox_overflow
+)
+
+async def process_text_message(message: types.Message, user_data: UserSession, text: str = None):
+    user_id = user_data['id']
+    if text is None:
+        text = message.text
+    
+    # Кнопки клавиатуры - не сообщения диалога: не расходуют дневной лимит и не считаются запросами источника
+    if text == "🧹 Очистить диалог":
+        await user_manager.clear_context(user_data)
+        keyboard = KeyboardManager.create_quick_replies(user_data['current_model'])
+        await message.answer("🧹 Контекст диалога успешно очищен! История общения забыта, можно начинать с чистого листа.", reply_markup=keyboard)
+        return
+    
+    if text == "🔄 Сменить модель":
+        # Открываем WebApp для выбора модели
+        builder = InlineKeyboardBuilder()
+        builder.add(InlineKeyboardButton(
+            text="🌐 Открыть каталог моделей", 
+            web_app=WebAppInfo(url=f"{MODEL_SELECTOR_URL}?user_id={user_id}")
+        ))
+        await message.answer(
+            "🎨 Откройте каталог моделей для выбора:",
+            reply_markup=builder.as_markup()
+        )
+        return
     
-    # Проверяем лимит сообщений в день
-    if not await check_daily_message_limit(user_id):
-        daily_count = await db.get_daily_message_count(user_id)
+    # Одна транзакция до вызова LLM: снимаем отметку о блокировке (раз пользователь написал,
+    # он не заблокировал бота), проверяем подписку и дневной лимит, засчитываем сообщение
+    # и запрос по источнику
+    admission = await db.admit_message(user_id, user_data.get('source', ''), DAILY_MESSAGE_LIMIT)
+    user_data.synced('bot_blocked', False)
+    daily_count = admission.daily_count
+    # Подписчики обслуживаются LLM в первую очередь
+    llm_lane.set('premium' if admission.premium else 'interactive')
+    if not admission.allowed:
         
         # Трекинг достижения лимита
         await track_conversion_event(user_id, 'limit_reached', {
@@ -2190,17 +3275,8 @@ async def handle_text_message(message: types.Message):
         )
         return
     
-    user_data = await db.get_user(user_id)
-    if not user_data:
-        logger.error(f"Пользователь {user_id} не найден в базе данных")
-        return
-        
     # Обновляем last_active при каждом сообщении
     user_data['last_active'] = datetime.now()
-    await db.save_user(user_data)
-    
-    # Увеличиваем счетчик сообщений
-    await db.increment_daily_message_count(user_id)
     
     # Context-aware messaging: добавляем время-зависимые приветствия
     current_hour = datetime.now().hour
@@ -2218,60 +3294,26 @@ async def handle_text_message(message: types.Message):
     time_since_last = datetime.now() - user_data.get('last_active', datetime.now())
     is_returning_user = time_since_last.total_seconds() > 43200  # 12 часов
     
-    try:
-        user_data = await db.get_user(user_id)
-    except Exception as e:
-        logger.error(f"Ошибка при получении данных пользователя: {e}", exc_info=True)
-        await message.answer("❌ Произошла ошибка при получении данных пользователя. Пожалуйста, попробуйте еще раз.")
-        return
-    
-    if not user_data:
-        user_data = user_manager.create_user(user_id, message.from_user.username, message.from_user.full_name)
-        await db.save_user(user_data)
-    
-    # Обновляем активность
-    user_manager.update_activity(user_data)
-    
-    # Обработка специальных сообщений
-    if message.text == "🧹 Очистить диалог":
-        user_manager.clear_context(user_data)
-        await db.save_user(user_data)
-        keyboard = KeyboardManager.create_quick_replies(user_data['current_model'])
-        await message.answer("🧹 Контекст диалога успешно очищен! История общения забыта, можно начинать с чистого листа.", reply_markup=keyboard)
-        return
-    
-    if message.text == "🔄 Сменить модель":
-        # Открываем WebApp для выбора модели
-        builder = InlineKeyboardBuilder()
-        builder.add(InlineKeyboardButton(
-            text="🌐 Открыть каталог моделей", 
-            web_app=WebAppInfo(url=f"{MODEL_SELECTOR_URL}?user_id={user_id}")
-        ))
-        await message.answer(
-            "🎨 Откройте каталог моделей для выбора:",
-            reply_markup=builder.as_markup()
-        )
-        return
-    
+    reply = None
     try:
         # Показываем статус "печатает"
         await bot.send_chat_action(message.chat.id, ChatAction.TYPING)
         
-        # Обрабатываем сообщение
-        response = await message_processor.process_message(user_data, message.text)
-        
-        # Сохраняем пользователя
-        await db.save_user(user_data)
+        # Обрабатываем сообщение, показывая ответ по мере генерации
+        reply = StreamingReply(message, STREAM_EDIT_INTERVAL) if STREAM_REPLIES else None
+        response = await message_processor.process_message(user_data, text, on_delta=reply.feed if reply else None)
         
         # Обрабатываем ответ в зависимости от модели
         adult_models = ["Любовница", "Порноактриса", "BDSM Госпожа", "МИЛФ", "Аниме-тян", "Секретарша", "Медсестра"]
         if user_data['current_model'] in adult_models:
-            await message_processor.handle_lovistnica_response(message, response)
+            await message_processor.handle_lovistnica_response(message, response, user_data, reply)
         else:
-            await message_processor.handle_regular_response(message, response, user_data['current_model'])
+            await message_processor.handle_regular_response(message, response, user_data['current_model'], user_data, reply)
             
     except Exception as e:
         logger.error(f"Критическая ошибка при обработке сообщения: {e}", exc_info=True)
+        if reply:
+            await reply.discard()
         try:
             await message.answer("😅 Ой, у меня что-то заглючило! Давай попробуем ещё раз? Если проблема повторится, напиши /help - я помогу разобраться! 💫")
         except Exception as send_error:
@@ -2285,9 +3327,6 @@ async def handle_text_message(message: types.Message):
             # Вызовет перезапуск в основном цикле
             raise
 
-    # Считаем запросы по источнику
-    await db.increment_source_request(user_data.get('source', ''))
-
 # Обработчик ошибок
 @dp.errors()
 async def error_handler(event: types.ErrorEvent):
@@ -2389,70 +3428,56 @@ async def send_model_greeting(message: types.Message, model_name: str, keyboard)
             parse_mode="Markdown"
         )
 
-# Функция для отправки автоматических сообщений
-async def send_auto_messages():
-    while True:
-        try:
-            # Получаем пользователей с включенными автосообщениями
-            users = await db.get_users_for_auto_message()
-            for user in users:
-                try:
-                    # Добавляем контекст о времени суток и последней активности
-                    current_hour = datetime.now().hour
-                    time_context = ""
-                    if 6 <= current_hour < 12:
-                        time_context = "сейчас утро"
-                    elif 12 <= current_hour < 18:
-                        time_context = "сейчас день"
-                    elif 18 <= current_hour < 22:
-                        time_context = "сейчас вечер"
-                    else:
-                        time_context = "сейчас ночь"
-                    
-                    # Формируем контекст разговора с учетом времени
-                    system_prompt = (f"Ты {user['current_model']}. Пользователь не писал сутки, а {time_context}. "
-                                   f"Отправь ему короткое завлекающее сообщение, чтобы вернуть в диалог. "
-                                   f"Пиши от первого лица, лично и эмоционально. Максимум 2-3 предложения.")
-                    messages = [{"role": "system", "content": system_prompt}]
-                    
-                    # Получаем ответ от модели
-                    response = await ai_service.call_openai_api(messages, "gpt-3.5-turbo")
-                    
-                    # Отправляем сообщение пользователю
-                    keyboard = KeyboardManager.create_quick_replies(user['current_model'], user)
-                    await bot.send_message(
-                        user['id'],
-                        response,
-                        reply_markup=keyboard,
-                        parse_mode="Markdown"
-                    )
-                    
-                    # Обновляем контекст пользователя
-                    user['context'] = [
-                        {"role": "assistant", "content": response}
-                    ]
-                    await db.save_user(user)
-                    
-                    logger.info(f"Отправлено автоматическое сообщение пользователю {user['id']}")
-                    
-                except Exception as e:
-                    error_msg = str(e)
-                    # Проверяем, заблокировал ли пользователь бота
-                    if "bot was blocked by the user" in error_msg or "user is deactivated" in error_msg:
-                        await db.mark_user_blocked(user['id'])
-                        logger.info(f"Пользователь {user['id']} заблокировал бота, отмечаем в базе")
-                    else:
-                        logger.error(f"Ошибка при отправке автоматического сообщения пользователю {user['id']}: {e}")
-                    continue
-                    
-                # Небольшая пауза между сообщениями разным пользователям
-                await asyncio.sleep(1)
-                
-        except Exception as e:
-            logger.error(f"Ошибка в цикле отправки автоматических сообщений: {e}")
-        
-        # Проверяем раз в час
-        await asyncio.sleep(3600)
+# Автоматические сообщения: текст и доставка для AutoMessageEngine
+async def generate_openers(model: str, time_context: str, count: int) -> str:
+    """Один запрос к LLM на count разных первых сообщений для пула"""
+    system_prompt = (f"Ты {model}. Пользователь не писал сутки, а {time_context}. "
+                     f"Придумай {count} разных коротких завлекающих сообщений, чтобы вернуть его в диалог. "
+                     f"Пиши от первого лица, лично и эмоционально, каждое - максимум 2-3 предложения. "
+                     f"Каждое сообщение - с новой строки, без нумерации и пояснений.")
+    messages = [{"role": "system", "content": system_prompt}]
+    return await llm_router.complete('openai', "gpt-3.5-turbo", messages)
+
+async def generate_auto_message(user) -> str:
+    part = daypart()
+    if user['current_model']:
+        opener = await opener_pool.draw(user['current_model'], part, user['id'])
+        if opener:
+            return opener
+    # Пул исчерпан для пользователя (или модель не выбрана) - генерируем сообщение отдельно
+    system_prompt = (f"Ты {user['current_model']}. Пользователь не писал сутки, а {TIME_CONTEXTS[part]}. "
+                     f"Отправь ему короткое завлекающее сообщение, чтобы вернуть в диалог. "
+                     f"Пиши от первого лица, лично и эмоционально. Максимум 2-3 предложения.")
+    messages = [{"role": "system", "content": system_prompt}]
+    return await llm_router.complete('openai', "gpt-3.5-turbo", messages)
+
+async def deliver_auto_message(user, text: str):
+    keyboard = KeyboardManager.create_quick_replies(user['current_model'], user)
+    await bot.send_message(
+        user['id'],
+        text,
+        reply_markup=keyboard,
+        parse_mode="Markdown"
+    )
+    # Начинаем контекст пользователя заново с автосообщения
+    await user_manager.clear_context(user)
+    await user_manager.add_to_context(user, "assistant", text)
+    logger.info(f"Отправлено автоматическое сообщение пользователю {user['id']}")
+
+opener_pool = OpenerPool(
+    db,
+    generate_openers,
+    size=AUTO_OPENER_POOL_SIZE,
+    refresh_hour=AUTO_OPENER_REFRESH_HOUR
+)
+auto_messages = AutoMessageEngine(
+    db,
+    generate_auto_message,
+    deliver_auto_message,
+    interval=AUTO_MESSAGE_INTERVAL,
+    concurrency=AUTO_MESSAGE_CONCURRENCY,
+    is_busy=user_mailbox.busy
+)
 
 # Основная функция
 async def main():
@@ -2465,9 +3490,19 @@ async def main():
         except Exception:
             pass
     bot = Bot(token=API_TOKEN)
+    bot.session.middleware(outbound)
     # Инициализация базы данных
     await db.initialize()
     
+    # Продолжаем рассылки, прерванные перезапуском
+    broadcasts.start(bot)
+    
+    # Заранее открываем соединения к API моделей и генерации изображений
+    asyncio.create_task(http_clients.prewarm([
+        *LLM_API_URLS.values(),
+        CLOUDFLARE_API_URL,
+    ]))
+    
     # Инициализация Flyer Service если включена партнерская система
     if globals().get('USE_FLYER_PARTNER_SYSTEM', False) and globals().get('FLYER_API_KEY'):
         if init_flyer_service:
@@ -2482,7 +3517,6 @@ async def main():
     loop = asyncio.get_running_loop()
     stop_event = asyncio.Event()
     polling_task = None
-    auto_message_task = None  # Задача для автоматических сообщений
     is_shutting_down = False
     exit_code = 0  # Код завершения по умолчанию
     
@@ -2501,19 +3535,19 @@ async def main():
             except (asyncio.CancelledError, asyncio.TimeoutError):
                 pass
                 
-        if auto_message_task and not auto_message_task.done():
-            logger.info(f"[SHUTDOWN] auto_message_task отменяется: {auto_message_task}")
-            auto_message_task.cancel()
-            try:
-                await asyncio.wait_for(auto_message_task, timeout=5.0)
-            except (asyncio.CancelledError, asyncio.TimeoutError):
-                pass
+        await auto_messages.stop()
+        await opener_pool.stop()
+        await job_scheduler.stop()
+        # Рассылки останавливаем до закрытия БД; они продолжатся со своего курсора
+        await broadcasts.stop()
         if hasattr(db, 'close'):
             try:
                 await db.close()
                 logger.info("[SHUTDOWN] Соединение с БД закрыто")
             except Exception as e:
                 logger.error(f"[SHUTDOWN] Ошибка при закрытии БД: {e}")
+        await http_clients.close()
+        logger.info("[SHUTDOWN] HTTP-сессии закрыты")
         pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
         for task in pending:
             if not task.done():
@@ -2772,7 +3806,9 @@ async def main():
         # Запускаем диагностику и фоновые задачи
         asyncio.create_task(log_diagnostics(polling_task, stop_event))
         asyncio.create_task(watchdog())
-        auto_message_task = asyncio.create_task(send_auto_messages())
+        auto_messages.start()
+        opener_pool.start()
+        job_scheduler.start()
         # Основной цикл
         connection_failures = 0
         while not stop_event.is_set():
@@ -0,0 +1,347 @@
+"""
+Рассылки администратора как сохраняемые кампании.
+Кампания хранится в таблице broadcasts вместе со счётчиками и курсором, её аудитория -
+снимок незаблокировавших бота пользователей в broadcast_recipients со статусом на
+каждого получателя. Фоновый воркер забирает получателей пачками по курсору и шлёт
+с ограниченной параллельностью; темп задаёт планировщик исходящих сообщений
+(класс 'broadcast'). Получатель помечается взятым до отправки, поэтому после
+перезапуска кампания продолжается с курсора и никому не приходит дважды: взятые,
+но не подтверждённые отправки считаются прерванными и не повторяются.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Optional, Dict, Any, List, Tuple
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+
+from telegram_outbound import send_priority
+
+logger = logging.getLogger(__name__)
+
+# Статусы получателя в broadcast_recipients.status
+PENDING, CLAIMED, SENT, FAILED, BLOCKED, INTERRUPTED = range(6)
+
+# Кампании, которые воркер продолжает после перезапуска
+ACTIVE_STATES = ('preparing', 'running')
+
+
+class BroadcastEngine:
+    """Кампании рассылки: снимок аудитории, воркер с курсором и живой прогресс у админа"""
+
+    def __init__(self, db, concurrency: int = 25,
+                 snapshot_chunk: int = 20000, progress_interval: float = 5.0):
+        """
+        Args:
+            db: экземпляр Database (acquire() отдаёт писателя или читателя)
+            concurrency: одновременных отправок в одной кампании; столько же получателей
+                забирается за раз, чтобы взятыми считались только отправки в полёте
+            snapshot_chunk: сколько пользователей копируется в снимок за одну транзакцию
+            progress_interval: как часто обновлять сообщение с прогрессом у админа
+        """
+        self.db = db
+        self.concurrency = concurrency
+        self.snapshot_chunk = snapshot_chunk
+        self.progress_interval = progress_interval
+        self.bot = None
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._run_sent: Dict[int, Tuple[float, int]] = {}
+
+    def start(self, bot):
+        """Запоминает бота и продолжает кампании, прерванные перезапуском"""
+        self.bot = bot
+        asyncio.create_task(self._resume())
+
+    async def stop(self):
+        """Останавливает воркеры, не меняя статус кампаний - они продолжатся при следующем старте"""
+        tasks = [task for task in self._tasks.values() if not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _resume(self):
+        try:
+            async with self.db.acquire(readonly=True) as conn:
+                cursor = await conn.execute(
+                    f"SELECT id FROM broadcasts WHERE status IN ({', '.join('?' * len(ACTIVE_STATES))}) ORDER BY id",
+                    ACTIVE_STATES
+                )
+                campaign_ids = [row['id'] async for row in cursor]
+        except Exception as e:
+            logger.error(f"[BROADCAST] Не удалось загрузить незавершённые рассылки: {e}")
+            return
+        for campaign_id in campaign_ids:
+            logger.info(f"[BROADCAST] Продолжаем рассылку #{campaign_id} после перезапуска")
+            self._launch(campaign_id)
+
+    def _launch(self, campaign_id: int):
+        task = self._tasks.get(campaign_id)
+        if task is None or task.done():
+            self._tasks[campaign_id] = asyncio.create_task(self._run(campaign_id))
+
+    async def create(self, text: str, admin_chat_id: int) -> int:
+        """Создаёт кампанию, присылает админу сообщение с прогрессом и запускает воркер"""
+        async with self.db.acquire() as conn:
+            cursor = await conn.execute(
+                "INSERT INTO broadcasts (text, admin_chat_id, status, created_at) VALUES (?, ?, 'preparing', ?)",
+                (text, admin_chat_id, int(time.time()))
+            )
+            campaign_id = cursor.lastrowid
+        try:
+            progress = await self.bot.send_message(admin_chat_id, f"📢 Рассылка #{campaign_id}: собираем получателей...")
+            async with self.db.acquire() as conn:
+                await conn.execute(
+                    'UPDATE broadcasts SET progress_message_id = ? WHERE id = ?',
+                    (progress.message_id, campaign_id)
+                )
+        except Exception as e:
+            logger.warning(f"[BROADCAST] Не удалось отправить прогресс рассылки #{campaign_id}: {e}")
+        self._launch(campaign_id)
+        return campaign_id
+
+    async def cancel(self, campaign_id: int) -> bool:
+        """Отменяет кампанию; уже взятые в работу отправки считаются прерванными"""
+        async with self.db.acquire() as conn:
+            cursor = await conn.execute(
+                f"UPDATE broadcasts SET status = 'cancelled', finished_at = ? "
+                f"WHERE id = ? AND status IN ({', '.join('?' * len(ACTIVE_STATES))})",
+                (int(time.time()), campaign_id, *ACTIVE_STATES)
+            )
+            if not cursor.rowcount:
+                return False
+        task = self._tasks.pop(campaign_id, None)
+        if task and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await self._close_claims(campaign_id)
+        await self._show_progress(await self._load(campaign_id))
+        return True
+
+    async def active(self) -> List[Dict[str, Any]]:
+        async with self.db.acquire(readonly=True) as conn:
+            cursor = await conn.execute(
+                f"SELECT * FROM broadcasts WHERE status IN ({', '.join('?' * len(ACTIVE_STATES))}) ORDER BY id",
+                ACTIVE_STATES
+            )
+            return [dict(row) async for row in cursor]
+
+    async def _load(self, campaign_id: int) -> Dict[str, Any]:
+        async with self.db.acquire(readonly=True) as conn:
+            cursor = await conn.execute('SELECT * FROM broadcasts WHERE id = ?', (campaign_id,))
+            return dict(await cursor.fetchone())
+
+    # --- Снимок аудитории ---
+
+    async def _snapshot(self, campaign_id: int) -> int:
+        """Копирует незаблокировавших бота пользователей в получатели короткими транзакциями.
+
+        Продолжается с последнего скопированного id, поэтому переживает перезапуск.
+        """
+        while True:
+            async with self.db.acquire() as conn:
+                await conn.execute('BEGIN IMMEDIATE')
+                cursor = await conn.execute(
+                    'SELECT COALESCE(MAX(user_id), -1) FROM broadcast_recipients WHERE broadcast_id = ?',
+                    (campaign_id,)
+                )
+                last_user_id = (await cursor.fetchone())[0]
+                cursor = await conn.execute(
+                    'INSERT INTO broadcast_recipients (broadcast_id, user_id) '
+                    'SELECT ?, id FROM users WHERE id > ? AND (bot_blocked IS NULL OR bot_blocked = 0) '
+                    'ORDER BY id LIMIT ?',
+                    (campaign_id, last_user_id, self.snapshot_chunk)
+                )
+                copied = cursor.rowcount
+                if copied < self.snapshot_chunk:
+                    cursor = await conn.execute(
+                        'SELECT COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ?', (campaign_id,)
+                    )
+                    total = (await cursor.fetchone())[0]
+                    await conn.execute(
+                        "UPDATE broadcasts SET status = 'running', total = ?, started_at = ? WHERE id = ?",
+                        (total, int(time.time()), campaign_id)
+                    )
+                    return total
+            await asyncio.sleep(0)
+
+    # --- Воркер ---
+
+    async def _close_claims(self, campaign_id: int):
+        """Взятые, но не подтверждённые отправки (воркер прервался) больше не повторяются"""
+        async with self.db.acquire() as conn:
+            cursor = await conn.execute(
+                'UPDATE broadcast_recipients SET status = ? WHERE broadcast_id = ? AND status = ?',
+                (INTERRUPTED, campaign_id, CLAIMED)
+            )
+            if cursor.rowcount:
+                await conn.execute(
+                    'UPDATE broadcasts SET interrupted = interrupted + ? WHERE id = ?',
+                    (cursor.rowcount, campaign_id)
+                )
+                logger.warning(f"[BROADCAST] #{campaign_id}: {cursor.rowcount} отправок прервано, не повторяем")
+
+    async def _claim(self, campaign_id: int) -> List[int]:
+        """Забирает следующие concurrency получателей после курсора и помечает их взятыми"""
+        async with self.db.acquire() as conn:
+            await conn.execute('BEGIN IMMEDIATE')
+            cursor = await conn.execute('SELECT cursor, status FROM broadcasts WHERE id = ?', (campaign_id,))
+            row = await cursor.fetchone()
+            if row['status'] != 'running':
+                return []
+            cursor = await conn.execute(
+                'SELECT user_id FROM broadcast_recipients WHERE broadcast_id = ? AND user_id > ? '
+                'ORDER BY user_id LIMIT ?',
+                (campaign_id, row['cursor'], self.concurrency)
+            )
+            user_ids = [r['user_id'] async for r in cursor]
+            if user_ids:
+                await conn.execute(
+                    'UPDATE broadcast_recipients SET status = ? '
+                    'WHERE broadcast_id = ? AND user_id > ? AND user_id <= ?',
+                    (CLAIMED, campaign_id, row['cursor'], user_ids[-1])
+                )
+                await conn.execute('UPDATE broadcasts SET cursor = ? WHERE id = ?', (user_ids[-1], campaign_id))
+            return user_ids
+
+    async def _record(self, campaign_id: int, results: List[Tuple[int, int]]):
+        if not results:
+            return
+        counts = {SENT: 0, FAILED: 0, BLOCKED: 0}
+        for status, _ in results:
+            counts[status] += 1
+        async with self.db.acquire() as conn:
+            # Статусы и счётчики - одной транзакцией
+            await conn.execute('BEGIN IMMEDIATE')
+            await conn.executemany(
+                'UPDATE broadcast_recipients SET status = ? WHERE broadcast_id = ? AND user_id = ?',
+                [(status, campaign_id, user_id) for status, user_id in results]
+            )
+            await conn.execute(
+                'UPDATE broadcasts SET sent = sent + ?, failed = failed + ?, blocked = blocked + ? WHERE id = ?',
+                (counts[SENT], counts[FAILED], counts[BLOCKED], campaign_id)
+            )
+
+    async def _send(self, user_id: int, text: str) -> int:
+        try:
+            await self.bot.send_message(user_id, text)
+            return SENT
+        except TelegramForbiddenError:
+            # bot_blocked уже отметил планировщик исходящих сообщений
+            return BLOCKED
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug(f"[BROADCAST] Не доставлено {user_id}: {e}")
+            return FAILED
+
+    async def _send_batch(self, campaign: Dict[str, Any], user_ids: List[int]):
+        """Отправляет пачку и записывает результаты; при отмене записывает уже завершённые отправки"""
+        results: List[Tuple[int, int]] = []
+
+        async def send(user_id):
+            results.append((await self._send(user_id, campaign['text']), user_id))
+
+        try:
+            await asyncio.gather(*(send(user_id) for user_id in user_ids))
+        except asyncio.CancelledError:
+            # Прерванными останутся только отправки, которые были в полёте
+            await self._record(campaign['id'], results)
+            raise
+        await self._record(campaign['id'], results)
+
+    async def _run(self, campaign_id: int):
+        # Рассылка уступает слоты отправки ответам пользователям
+        send_priority.set('broadcast')
+        try:
+            campaign = await self._load(campaign_id)
+            if campaign['status'] == 'preparing':
+                total = await self._snapshot(campaign_id)
+                logger.info(f"[BROADCAST] #{campaign_id}: {total} получателей")
+            await self._close_claims(campaign_id)
+            campaign = await self._load(campaign_id)
+            self._run_sent[campaign_id] = (time.monotonic(), campaign['sent'])
+            last_progress = 0.0
+            while True:
+                user_ids = await self._claim(campaign_id)
+                if not user_ids:
+                    break
+                await self._send_batch(campaign, user_ids)
+                if time.monotonic() - last_progress >= self.progress_interval:
+                    last_progress = time.monotonic()
+                    await self._show_progress(await self._load(campaign_id))
+            async with self.db.acquire() as conn:
+                await conn.execute(
+                    "UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id = ? AND status = 'running'",
+                    (int(time.time()), campaign_id)
+                )
+            campaign = await self._load(campaign_id)
+            await self._show_progress(campaign)
+            logger.info(f"[BROADCAST] #{campaign_id} завершена: {self._counters(campaign)}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[BROADCAST] Ошибка рассылки #{campaign_id}: {e}")
+        finally:
+            self._run_sent.pop(campaign_id, None)
+            if self._tasks.get(campaign_id) is asyncio.current_task():
+                del self._tasks[campaign_id]
+
+    # --- Прогресс ---
+
+    @staticmethod
+    def _counters(campaign: Dict[str, Any]) -> str:
+        return (f"отправлено {campaign['sent']}, заблокировали {campaign['blocked']}, "
+                f"ошибок {campaign['failed']}, прервано {campaign['interrupted']}")
+
+    def _rate(self, campaign: Dict[str, Any]) -> Optional[float]:
+        """Сообщений в секунду с запуска воркера (после перезапуска считается заново)"""
+        run = self._run_sent.get(campaign['id'])
+        if not run:
+            return None
+        elapsed = time.monotonic() - run[0]
+        return (campaign['sent'] - run[1]) / elapsed if elapsed > 0 else None
+
+    def progress_text(self, campaign: Dict[str, Any]) -> str:
+        titles = {
+            'preparing': 'собираем получателей', 'running': 'идёт',
+            'done': 'завершена ✅', 'cancelled': 'отменена',
+        }
+        processed = campaign['sent'] + campaign['failed'] + campaign['blocked'] + campaign['interrupted']
+        total = campaign['total'] or 0
+        lines = [
+            f"📢 Рассылка #{campaign['id']}: {titles.get(campaign['status'], campaign['status'])}",
+            f"Обработано: {processed} из {total}",
+            f"Отправлено: {campaign['sent']}",
+            f"Заблокировали бота: {campaign['blocked']}",
+            f"Ошибки: {campaign['failed']}",
+        ]
+        if campaign['interrupted']:
+            lines.append(f"Прервано перезапуском: {campaign['interrupted']}")
+        rate = self._rate(campaign)
+        if campaign['status'] == 'running' and rate:
+            lines.append(f"Скорость: {rate:.1f} сообщ/с, осталось ~{(total - processed) / rate / 60:.0f} мин")
+        return "\n".join(lines)
+
+    async def _show_progress(self, campaign: Dict[str, Any]):
+        if not campaign.get('progress_message_id'):
+            return
+        # Прогресс админу - обычный ответ, не ждёт в очереди рассылки
+        priority = send_priority.set('interactive')
+        try:
+            await self.bot.edit_message_text(
+                self.progress_text(campaign),
+                chat_id=campaign['admin_chat_id'],
+                message_id=campaign['progress_message_id']
+            )
+        except TelegramBadRequest as e:
+            # "message is not modified" и удалённое сообщение прогресса
+            logger.debug(f"[BROADCAST] Прогресс #{campaign['id']} не обновлён: {e}")
+        except Exception as e:
+            logger.warning(f"[BROADCAST] Прогресс #{campaign['id']} не обновлён: {e}")
+        finally:
+            send_priority.reset(priority)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'running': sorted(campaign_id for campaign_id, task in self._tasks.items() if not task.done())}
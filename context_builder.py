@@ -0,0 +1,171 @@
+"""
+Сборка промпта диалога в пределах бюджета токенов модели.
+Реплики берутся от новых к старым, пока помещаются в бюджет; всё, что старше,
+сворачивается в краткое содержание разговора. Содержание пересчитывается в фоне
+(не на пути ответа), хранится у пользователя (users.context_summary) вместе с seq
+последней свёрнутой реплики и подставляется в системный промпт.
+"""
+
+import asyncio
+import logging
+from typing import Optional, Dict, Any, List, Callable, Awaitable
+
+logger = logging.getLogger(__name__)
+
+# Служебные токены разметки одного сообщения чата
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_text_tokens(text: str) -> int:
+    """Быстрая оценка числа токенов с учётом кириллицы.
+
+    Латиница в BPE-словарях занимает ~4 символа на токен, кириллица - ~2.5.
+    Число не-ASCII символов берём как разницу длины в байтах UTF-8 и в символах
+    (кириллица занимает 2 байта), это считается в C без прохода по строке в Python.
+    """
+    if not text:
+        return 0
+    chars = len(text)
+    non_ascii = len(text.encode('utf-8')) - chars
+    return int((chars - non_ascii) / 4 + non_ascii / 2.5) + 1
+
+
+def estimate_message_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(estimate_text_tokens(m.get('content') or '') + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+SUMMARY_PROMPT = (
+    "Ты ведёшь краткий конспект ролевого диалога пользователя с персонажем. "
+    "Обнови конспект с учётом новых реплик: сохрани имена, факты о пользователе, "
+    "его предпочтения, договорённости, настроение и сюжет. Пиши по-русски, "
+    "от третьего лица, не больше 120 слов, без вступлений."
+)
+
+
+class ContextBuilder:
+    """Промпт в бюджете токенов модели и фоновое сворачивание старых реплик"""
+
+    def __init__(self, summarize: Callable[[List[Dict[str, str]]], Awaitable[str]],
+                 store: Callable[[int, Optional[str], int], Awaitable[None]],
+                 budgets: Dict[str, int] = None, default_budget: int = 2500,
+                 ring_size: int = 20, keep_recent: int = 4, min_turns: int = 2,
+                 max_summary_chars: int = 1500):
+        """
+        Args:
+            summarize: корутина (messages) -> текст, запрос к LLM для конспекта
+            store: корутина (user_id, summary, seq) - сохраняет конспект у пользователя
+            budgets: модель -> бюджет токенов промпта (системный промпт, конспект, реплики, сообщение)
+            default_budget: бюджет для моделей без своего значения
+            ring_size: размер кольца реплик в БД; реплики сворачиваются до того, как вытеснятся
+            keep_recent: сколько последних реплик остаются дословно после сворачивания
+            min_turns: сколько последних реплик попадают в промпт даже сверх бюджета
+            max_summary_chars: предельная длина конспекта
+        """
+        self.summarize = summarize
+        self.store = store
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.ring_size = ring_size
+        self.keep_recent = keep_recent
+        self.min_turns = min_turns
+        self.max_summary_chars = max_summary_chars
+        # user_id -> задача сворачивания; reset() отвязывает задачу, и её результат отбрасывается
+        self._inflight: Dict[int, asyncio.Task] = {}
+        # Метрики
+        self.builds = 0
+        self.trimmed_turns = 0
+        self.summaries = 0
+        self.summary_errors = 0
+
+    def budget(self, model: str) -> int:
+        return self.budgets.get(model, self.default_budget)
+
+    @staticmethod
+    def system_content(system_prompt: str, summary: Optional[str]) -> str:
+        if not summary:
+            return system_prompt
+        return f"{system_prompt}\n\nКраткое содержание предыдущего разговора:\n{summary}"
+
+    def build(self, user_data: Dict[str, Any], system_prompt: str, message_text: str,
+              model: str) -> List[Dict[str, str]]:
+        """Сообщения для LLM: системный промпт с конспектом, поместившиеся реплики и новое сообщение"""
+        self.builds += 1
+        summary = user_data.get('context_summary')
+        summary_seq = user_data.get('context_summary_seq') or 0
+        system = {"role": "system", "content": self.system_content(system_prompt, summary)}
+        current = {"role": "user", "content": message_text}
+        used = estimate_message_tokens([system, current])
+        budget = self.budget(model)
+
+        # Свёрнутые в конспект реплики дословно не отправляем
+        turns = [t for t in user_data.get('context', []) if (t.get('seq') or summary_seq + 1) > summary_seq]
+        included: List[Dict[str, str]] = []
+        for turn in reversed(turns):
+            cost = estimate_text_tokens(turn.get('content') or '') + MESSAGE_OVERHEAD_TOKENS
+            if used + cost > budget and len(included) >= self.min_turns:
+                break
+            used += cost
+            included.append({"role": turn.get('role', 'user'), "content": turn.get('content', '')})
+        included.reverse()
+
+        trimmed = len(turns) - len(included)
+        self.trimmed_turns += trimmed
+        # Сворачиваем, если реплики не влезли в бюджет или вытеснятся из кольца без конспекта
+        if trimmed > 0 or self._evicts_unsummarized(user_data.get('context', []), turns):
+            self._schedule(user_data, turns)
+        return [system, *included, current]
+
+    def _evicts_unsummarized(self, context: List[Dict[str, Any]], turns: List[Dict[str, Any]]) -> bool:
+        """Вытеснит ли пара реплик этого обмена из кольца ещё не свёрнутые реплики"""
+        evicted = len(context) + 2 - self.ring_size
+        # Несвёрнутые реплики - хвост контекста, перед ними len(context) - len(turns) свёрнутых
+        return evicted > len(context) - len(turns)
+
+    def _schedule(self, user_data: Dict[str, Any], turns: List[Dict[str, Any]]):
+        user_id = user_data['id']
+        older = turns[:-self.keep_recent] if self.keep_recent else turns
+        fold = [t for t in older if t.get('seq')]
+        if not fold or user_id in self._inflight:
+            return
+        task = asyncio.create_task(self._fold(user_id, user_data.get('context_summary'), fold))
+        self._inflight[user_id] = task
+
+    async def _fold(self, user_id: int, summary: Optional[str], fold: List[Dict[str, Any]]):
+        task = asyncio.current_task()
+        try:
+            dialogue = "\n".join(
+                f"{'Пользователь' if t.get('role') == 'user' else 'Персонаж'}: {t.get('content', '')}"
+                for t in fold
+            )
+            messages = [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"Текущий конспект:\n{summary or '(пусто)'}\n\nНовые реплики:\n{dialogue}"},
+            ]
+            new_summary = (await self.summarize(messages)).strip()[:self.max_summary_chars]
+            if not new_summary:
+                return
+            if self._inflight.get(user_id) is not task:
+                # Контекст очищен, пока считался конспект
+                return
+            await self.store(user_id, new_summary, fold[-1]['seq'])
+            self.summaries += 1
+            logger.debug(f"[CONTEXT] Свёрнуто {len(fold)} реплик пользователя {user_id}")
+        except Exception as e:
+            self.summary_errors += 1
+            logger.warning(f"[CONTEXT] Не удалось обновить конспект пользователя {user_id}: {e}")
+        finally:
+            if self._inflight.get(user_id) is task:
+                del self._inflight[user_id]
+
+    def reset(self, user_id: int):
+        """Вызывается при очистке контекста: результат текущего сворачивания отбрасывается"""
+        self._inflight.pop(user_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'builds': self.builds,
+            'trimmed_turns': self.trimmed_turns,
+            'summaries': self.summaries,
+            'summary_errors': self.summary_errors,
+            'inflight': len(self._inflight),
+        }
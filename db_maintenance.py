@@ -0,0 +1,305 @@
+"""
+Фоновое обслуживание SQLite для бота Anora.
+Удаление старых данных небольшими пачками по ключу, инкрементальный VACUUM,
+контрольные точки WAL и обновление статистики планировщика. Каждая операция
+подстраивает размер пачки так, чтобы держать соединение-писатель не дольше
+max_hold_ms, и отпускает его между пачками - бот продолжает отвечать.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, Callable, Awaitable, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Колбэк прогресса: (этап, обработано строк)
+ProgressCallback = Optional[Callable[[str, int], Awaitable[None]]]
+
+# Значение PRAGMA auto_vacuum для режима INCREMENTAL
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+class MaintenanceEngine:
+    """Планировщик обслуживания БД: retention, incremental_vacuum, checkpoint, optimize"""
+
+    def __init__(self, db, max_hold_ms: float = 50, chunk_size: int = 500, pause: float = 0.02,
+                 message_retention_days: int = 7, daily_retention_days: int = 30,
+                 image_retention_months: int = 3, retention_interval: float = 6 * 3600,
+                 checkpoint_interval: float = 300, optimize_interval: float = 6 * 3600,
+                 vacuum_pages: int = 256, analysis_limit: int = 400, tick: float = 30):
+        """
+        Args:
+            db: экземпляр Database (acquire() отдаёт писателя или читателя)
+            max_hold_ms: целевое максимальное время удержания писателя одной пачкой
+            chunk_size: начальный размер пачки удаления
+            pause: пауза между пачками, чтобы пропустить запросы бота
+            retention_interval, checkpoint_interval, optimize_interval: периоды задач в секундах
+        """
+        self.db = db
+        self.max_hold_ms = max_hold_ms
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.message_retention_days = message_retention_days
+        self.daily_retention_days = daily_retention_days
+        self.image_retention_months = image_retention_months
+        self.intervals = {
+            'checkpoint': checkpoint_interval,
+            'retention': retention_interval,
+            'optimize': optimize_interval,
+        }
+        self.vacuum_pages = vacuum_pages
+        self.analysis_limit = analysis_limit
+        self.tick = tick
+        self._task: Optional[asyncio.Task] = None
+        # Одновременно выполняется только одна задача обслуживания
+        self._job_lock = asyncio.Lock()
+        self._last_run: Dict[str, float] = {}
+        # Метрики
+        self.reports: Dict[str, Dict[str, Any]] = {}
+        self.max_hold_seen_ms = 0.0
+
+    def start(self):
+        if self._task is None or self._task.done():
+            now = time.monotonic()
+            # Тяжёлые задачи - не сразу после старта, checkpoint - на первом тике
+            self._last_run = {'retention': now, 'optimize': now}
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            for job, interval in self.intervals.items():
+                if not interval or time.monotonic() - self._last_run.get(job, 0) < interval:
+                    continue
+                try:
+                    if job == 'checkpoint':
+                        await self.checkpoint()
+                    elif job == 'retention':
+                        await self.run_retention()
+                        await self.incremental_vacuum()
+                    else:
+                        await self.optimize()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"[MAINTENANCE] Ошибка задачи {job}: {e}")
+                self._last_run[job] = time.monotonic()
+
+    # --- Удержание писателя ---
+
+    def _record_hold(self, started: float) -> float:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.max_hold_seen_ms = max(self.max_hold_seen_ms, elapsed_ms)
+        return elapsed_ms
+
+    def _next_chunk(self, chunk: int, elapsed_ms: float) -> int:
+        """Подстраивает размер следующей пачки под max_hold_ms"""
+        if elapsed_ms > self.max_hold_ms:
+            return max(10, int(chunk * self.max_hold_ms / elapsed_ms * 0.8))
+        if elapsed_ms < self.max_hold_ms / 2:
+            return min(chunk * 2, 50000)
+        return chunk
+
+    async def _chunked(self, stage: str, step: Callable, progress: ProgressCallback = None) -> int:
+        """Повторяет step(conn, chunk) -> (закончено, обработано) короткими транзакциями писателя"""
+        chunk = self.chunk_size
+        total = 0
+        while True:
+            async with self.db.acquire() as conn:
+                started = time.perf_counter()
+                await conn.execute('BEGIN IMMEDIATE')
+                done, affected = await step(conn, chunk)
+            elapsed_ms = self._record_hold(started)
+            total += affected
+            if progress and affected:
+                await progress(stage, total)
+            if done:
+                return total
+            chunk = self._next_chunk(chunk, elapsed_ms)
+            await asyncio.sleep(self.pause)
+
+    # --- Retention ---
+
+    async def _delete_old_messages(self, cutoff: int, progress: ProgressCallback) -> int:
+        async def step(conn, chunk):
+            # Ключ - индекс idx_messages_ts_at: каждая пачка начинается с самых старых строк
+            cursor = await conn.execute(
+                'DELETE FROM messages WHERE id IN ('
+                'SELECT id FROM messages WHERE ts_at < ? ORDER BY ts_at, id LIMIT ?)',
+                (cutoff, chunk)
+            )
+            return cursor.rowcount < chunk, cursor.rowcount
+        return await self._chunked('messages', step, progress)
+
+    async def _delete_by_rowid(self, table: str, condition: str, params: Tuple, progress: ProgressCallback) -> int:
+        """Проходит таблицу окнами по rowid и удаляет строки, подходящие под condition"""
+        last_rowid = 0
+
+        async def step(conn, chunk):
+            nonlocal last_rowid
+            cursor = await conn.execute(
+                f'SELECT MAX(rowid) FROM (SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?)',
+                (last_rowid, chunk)
+            )
+            upper = (await cursor.fetchone())[0]
+            if upper is None:
+                return True, 0
+            cursor = await conn.execute(
+                f'DELETE FROM {table} WHERE rowid > ? AND rowid <= ? AND {condition}',
+                (last_rowid, upper, *params)
+            )
+            last_rowid = upper
+            return False, cursor.rowcount
+        return await self._chunked(table, step, progress)
+
+    async def clear_contexts(self, progress: ProgressCallback = None) -> int:
+        """Очищает кольца контекста и конспекты всех пользователей, возвращает число пользователей"""
+        last_user_id = -1
+
+        async def step(conn, chunk):
+            nonlocal last_user_id
+            cursor = await conn.execute(
+                'SELECT COUNT(*), MAX(user_id) FROM ('
+                'SELECT DISTINCT user_id FROM context_turns WHERE user_id > ? ORDER BY user_id LIMIT ?)',
+                (last_user_id, chunk)
+            )
+            users, upper = await cursor.fetchone()
+            if not users:
+                return True, 0
+            await conn.execute(
+                'DELETE FROM context_turns WHERE user_id > ? AND user_id <= ?',
+                (last_user_id, upper)
+            )
+            # Вместе с репликами сбрасываем и их конспект
+            await conn.execute(
+                'UPDATE users SET context_summary = NULL, context_summary_seq = 0 '
+                'WHERE id > ? AND id <= ? AND context_summary_seq > 0',
+                (last_user_id, upper)
+            )
+            last_user_id = upper
+            return False, users
+        return await self._chunked('contexts', step, progress)
+
+    async def run_retention(self, progress: ProgressCallback = None) -> Dict[str, int]:
+        """Удаляет сообщения, дневные и месячные счётчики старше сроков хранения"""
+        async with self._job_lock:
+            started = time.perf_counter()
+            # Границы хранения считаем в Python, чтобы запросы шли по индексам
+            now = datetime.now()
+            messages_cutoff = int((now - timedelta(days=self.message_retention_days)).timestamp())
+            daily_cutoff = (now - timedelta(days=self.daily_retention_days)).date().isoformat()
+            cutoff_year, cutoff_month = divmod(now.year * 12 + now.month - self.image_retention_months, 12)
+            months_cutoff = f"{cutoff_year:04d}-{cutoff_month + 1:02d}"
+
+            report = {
+                'messages': await self._delete_old_messages(messages_cutoff, progress),
+                'daily_messages': await self._delete_by_rowid('daily_messages', 'date < ?', (daily_cutoff,), progress),
+                'monthly_images': await self._delete_by_rowid('monthly_images', 'month < ?', (months_cutoff,), progress),
+            }
+            report['elapsed_ms'] = round((time.perf_counter() - started) * 1000)
+            self.reports['retention'] = report
+            logger.info(f"[MAINTENANCE] Retention: {report}")
+            return report
+
+    # --- VACUUM / checkpoint / optimize ---
+
+    async def auto_vacuum_mode(self) -> int:
+        async with self.db.acquire(readonly=True) as conn:
+            cursor = await conn.execute('PRAGMA auto_vacuum')
+            return (await cursor.fetchone())[0]
+
+    async def incremental_vacuum(self, max_pages: Optional[int] = None, progress: ProgressCallback = None) -> int:
+        """Возвращает свободные страницы файлу порциями по vacuum_pages (нужен auto_vacuum=INCREMENTAL)"""
+        if await self.auto_vacuum_mode() != AUTO_VACUUM_INCREMENTAL:
+            logger.debug("[MAINTENANCE] auto_vacuum не INCREMENTAL, incremental_vacuum пропущен")
+            return 0
+        async with self._job_lock:
+            pages = self.vacuum_pages
+            freed = 0
+            while max_pages is None or freed < max_pages:
+                async with self.db.acquire() as conn:
+                    started = time.perf_counter()
+                    cursor = await conn.execute('PRAGMA freelist_count')
+                    free = (await cursor.fetchone())[0]
+                    step = min(pages, free, max_pages - freed if max_pages is not None else free)
+                    if step > 0:
+                        # execute() делает один шаг оператора = одну страницу; executescript доводит до конца
+                        await conn.executescript(f'PRAGMA incremental_vacuum({int(step)})')
+                        cursor = await conn.execute('PRAGMA freelist_count')
+                        step = free - (await cursor.fetchone())[0]
+                elapsed_ms = self._record_hold(started)
+                if step <= 0:
+                    break
+                freed += step
+                if progress:
+                    await progress('vacuum', freed)
+                pages = self._next_chunk(pages, elapsed_ms)
+                await asyncio.sleep(self.pause)
+            self.reports['vacuum'] = {'freed_pages': freed}
+            return freed
+
+    async def checkpoint(self) -> Tuple[int, int, int]:
+        """PASSIVE checkpoint: переносит WAL в файл БД, не дожидаясь читателей"""
+        async with self._job_lock:
+            async with self.db.acquire() as conn:
+                started = time.perf_counter()
+                cursor = await conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+                busy, log_pages, checkpointed = await cursor.fetchone()
+            elapsed_ms = self._record_hold(started)
+            self.reports['checkpoint'] = {
+                'busy': busy, 'wal_pages': log_pages, 'checkpointed': checkpointed,
+                'elapsed_ms': round(elapsed_ms, 1),
+            }
+            return busy, log_pages, checkpointed
+
+    async def optimize(self) -> float:
+        """PRAGMA optimize с ограничением analysis_limit, которое подстраивается под max_hold_ms"""
+        async with self._job_lock:
+            async with self.db.acquire() as conn:
+                started = time.perf_counter()
+                await conn.execute(f'PRAGMA analysis_limit={int(self.analysis_limit)}')
+                await conn.execute('PRAGMA optimize')
+            elapsed_ms = self._record_hold(started)
+            if elapsed_ms > self.max_hold_ms:
+                self.analysis_limit = max(100, self.analysis_limit // 2)
+            elif elapsed_ms < self.max_hold_ms / 2:
+                self.analysis_limit = min(self.analysis_limit * 2, 10000)
+            self.reports['optimize'] = {'elapsed_ms': round(elapsed_ms, 1), 'analysis_limit': self.analysis_limit}
+            return elapsed_ms
+
+    async def full_vacuum(self) -> float:
+        """Полный VACUUM с переводом базы в auto_vacuum=INCREMENTAL.
+        Блокирует писателя на всё время работы, поэтому выполняется только по явной команде."""
+        async with self._job_lock:
+            await self.db.write_behind.flush()
+            async with self.db.acquire() as conn:
+                started = time.perf_counter()
+                await conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                await conn.execute('VACUUM')
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            logger.info(f"[MAINTENANCE] Полный VACUUM за {elapsed_ms:.0f} мс")
+            return elapsed_ms
+
+    async def database_size(self) -> int:
+        async with self.db.acquire(readonly=True) as conn:
+            cursor = await conn.execute(
+                'SELECT page_count * page_size FROM pragma_page_count(), pragma_page_size()'
+            )
+            return (await cursor.fetchone())[0]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'max_hold_ms': round(self.max_hold_seen_ms, 1),
+            **self.reports,
+        }
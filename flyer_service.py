@@ -12,6 +12,8 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 import aiohttp
 import json
 
+from http_clients import http_clients
+
 logger = logging.getLogger(__name__)
 
 class FlyerService:
@@ -305,21 +307,21 @@ class FlyerService:
             logger.info(f"Регистрация вебхука: {url}")
             
             # Примерный код регистрации (нужно уточнить по документации API)
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    "https://api.flyerservice.io/webhook/register",
-                    json={
-                        "api_key": self.api_key,
-                        "url": url,
-                        "events": ["access_granted", "task_completed"]
-                    }
-                ) as response:
-                    if response.status == 200:
-                        logger.info("Вебхук успешно зарегистрирован")
-                        return True
-                    else:
-                        logger.error(f"Ошибка регистрации вебхука: {response.status}")
-                        return False
+            register_url = "https://api.flyerservice.io/webhook/register"
+            async with http_clients.session(register_url).post(
+                register_url,
+                json={
+                    "api_key": self.api_key,
+                    "url": url,
+                    "events": ["access_granted", "task_completed"]
+                }
+            ) as response:
+                if response.status == 200:
+                    logger.info("Вебхук успешно зарегистрирован")
+                    return True
+                else:
+                    logger.error(f"Ошибка регистрации вебхука: {response.status}")
+                    return False
                         
         except Exception as e:
             logger.error(f"Ошибка при регистрации вебхука: {e}")
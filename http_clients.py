@@ -0,0 +1,108 @@
+"""
+Общие HTTP-сессии aiohttp для внешних API (LLM, генерация изображений, Flyer).
+Одна долгоживущая сессия на хост: keep-alive пул соединений с лимитом на хост
+и кэшем DNS, поэтому DNS, TCP и TLS оплачиваются один раз, а не на каждый запрос.
+Сессии создаются лениво внутри работающего event loop и закрываются при shutdown.
+"""
+
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Dict, Any, Iterable
+from urllib.parse import urlsplit
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class HttpClients:
+    """Реестр сессий aiohttp: по одной на хост"""
+
+    def __init__(self, limit_per_host: int = 20, dns_ttl: int = 300, keepalive_timeout: float = 60,
+                 connect_timeout: float = 10, read_timeout: float = 60):
+        """
+        Args:
+            limit_per_host: максимум одновременных соединений к одному хосту
+            dns_ttl: время жизни записей в кэше DNS, секунд
+            keepalive_timeout: сколько держать простаивающее соединение открытым
+            connect_timeout, read_timeout: таймауты соединения и чтения сокета
+                (общий таймаут запроса задают вызывающие, например через asyncio.wait_for)
+        """
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        # Свои лимиты соединений для отдельных хостов (например, по допуску запросов к провайдеру)
+        self._host_limits: Dict[str, int] = {}
+        # Метрики
+        self.requests: Dict[str, int] = defaultdict(int)
+
+    @staticmethod
+    def _host(url: str) -> str:
+        return urlsplit(url).netloc or url
+
+    def set_host_limit(self, url: str, limit: int):
+        """Лимит соединений к хосту из url; действует для сессий, созданных после вызова"""
+        self._host_limits[self._host(url)] = limit
+
+    def host_limit(self, host: str) -> int:
+        return self._host_limits.get(host, self.limit_per_host)
+
+    def session(self, url: str) -> aiohttp.ClientSession:
+        """Сессия для хоста из url; закрывать её не нужно"""
+        host = self._host(url)
+        session = self._sessions.get(host)
+        if session is None or session.closed:
+            limit = self.host_limit(host)
+            connector = aiohttp.TCPConnector(
+                limit=limit,
+                limit_per_host=limit,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._sessions[host] = session
+        self.requests[host] += 1
+        return session
+
+    async def prewarm(self, urls: Iterable[str], timeout: float = 5.0):
+        """Заранее открывает соединения (DNS + TCP + TLS), чтобы первый запрос не ждал рукопожатия"""
+        async def warm(url: str):
+            parts = urlsplit(url)
+            origin = f"{parts.scheme}://{parts.netloc}/"
+            try:
+                async with self.session(url).head(origin, timeout=aiohttp.ClientTimeout(total=timeout)):
+                    pass
+            except Exception as e:
+                logger.debug(f"[HTTP] Не удалось прогреть {origin}: {e}")
+
+        await asyncio.gather(*(warm(url) for url in urls if url))
+
+    async def close(self):
+        sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            try:
+                await session.close()
+            except Exception as e:
+                logger.warning(f"[HTTP] Ошибка при закрытии сессии: {e}")
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Использование пулов по хостам: запросы, занятые и свободные соединения"""
+        result = {}
+        for host, session in self._sessions.items():
+            connector = session.connector
+            in_use = len(getattr(connector, '_acquired', ()))
+            idle = sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+            result[host] = {
+                'requests': self.requests[host],
+                'in_use': in_use,
+                'idle': idle,
+                'limit': self.host_limit(host),
+            }
+        return result
+
+
+# Экземпляр на процесс
+http_clients = HttpClients()
@@ -0,0 +1,218 @@
+"""
+Отложенные задачи по пользователям, переживающие перезапуск.
+Задача - строка в таблице jobs (пользователь, тип, due_at, payload). Один диспетчер
+спит до ближайшего due_at (берётся по частичному индексу ожидающих задач), забирает
+наступившие задачи пачками и передаёт их ограниченному числу воркеров. Память и число
+asyncio-задач не зависят от того, сколько задач ждёт в таблице. Взятая задача
+(status = 'running') возвращается в ожидание только при старте диспетчера - это
+задачи, прерванные перезапуском; пока процесс жив, повторно она не выдаётся.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Optional, Dict, Any, List, Callable, Awaitable, Iterable, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Обработчик задачи: (user_id, payload)
+JobHandler = Callable[[int, Optional[str]], Awaitable[None]]
+
+
+class JobScheduler:
+    """Диспетчер таблицы jobs: ожидание ближайшей задачи, пачки наступивших, пул воркеров"""
+
+    def __init__(self, db, batch_size: int = 100, concurrency: int = 8, max_sleep: float = 60,
+                 max_attempts: int = 3, retry_delay: float = 300):
+        """
+        Args:
+            db: экземпляр Database (acquire() отдаёт писателя или читателя)
+            batch_size: сколько наступивших задач забирается за раз
+            concurrency: одновременно выполняемых задач
+            max_sleep: дольше этого диспетчер не спит, даже если задач нет
+            max_attempts: попыток до статуса failed
+            retry_delay: задержка повтора после ошибки (растёт с номером попытки)
+        """
+        self.db = db
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_sleep = max_sleep
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.handlers: Dict[str, JobHandler] = {}
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=batch_size)
+        self._wakeup = asyncio.Event()
+        self._next_due: Optional[int] = None
+        self._tasks: List[asyncio.Task] = []
+        # Метрики
+        self.done = 0
+        self.retried = 0
+        self.failed = 0
+
+    def register(self, job_type: str, handler: JobHandler):
+        self.handlers[job_type] = handler
+
+    # --- Постановка задач ---
+
+    async def schedule_many(self, jobs: Iterable[Tuple[int, str, float, Optional[str]]]):
+        """Ставит задачи (user_id, job_type, задержка в секундах, payload) одной транзакцией"""
+        now = int(time.time())
+        rows = [(user_id, job_type, now + int(delay), payload) for user_id, job_type, delay, payload in jobs]
+        if not rows:
+            return
+        async with self.db.acquire() as conn:
+            await conn.executemany(
+                'INSERT INTO jobs (user_id, job_type, due_at, payload) VALUES (?, ?, ?, ?)', rows
+            )
+        earliest = min(row[2] for row in rows)
+        if self._next_due is None or earliest < self._next_due:
+            # Новая задача раньше той, до которой спит диспетчер
+            self._wakeup.set()
+
+    async def schedule(self, user_id: int, job_type: str, delay: float, payload: Optional[str] = None):
+        await self.schedule_many([(user_id, job_type, delay, payload)])
+
+    async def cancel(self, user_id: int, job_type: Optional[str] = None) -> int:
+        """Снимает ожидающие задачи пользователя (всех типов или одного)"""
+        async with self.db.acquire() as conn:
+            cursor = await conn.execute(
+                "DELETE FROM jobs WHERE user_id = ? AND status = 'pending' AND (? IS NULL OR job_type = ?)",
+                (user_id, job_type, job_type)
+            )
+            return cursor.rowcount
+
+    # --- Диспетчер ---
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._dispatch())]
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Взятые, но не начатые задачи возвращаем в ожидание: иначе после повторного start()
+        # их выполнили бы и воркеры из старой очереди, и диспетчер после сброса running
+        queued = []
+        while not self._queue.empty():
+            queued.append(self._queue.get_nowait()['id'])
+        if queued:
+            try:
+                async with self.db.acquire() as conn:
+                    await conn.executemany(
+                        "UPDATE jobs SET status = 'pending' WHERE id = ? AND status = 'running'",
+                        [(job_id,) for job_id in queued]
+                    )
+            except Exception as e:
+                logger.error(f"[JOBS] Не удалось вернуть {len(queued)} задач в ожидание: {e}")
+
+    async def _claim(self) -> List[Dict[str, Any]]:
+        """Забирает пачку наступивших задач и помечает их взятыми"""
+        now = int(time.time())
+        async with self.db.acquire() as conn:
+            await conn.execute('BEGIN IMMEDIATE')
+            cursor = await conn.execute(
+                "SELECT id, user_id, job_type, payload, attempts FROM jobs "
+                "WHERE status = 'pending' AND due_at <= ? ORDER BY due_at LIMIT ?",
+                (now, self.batch_size)
+            )
+            jobs = [dict(row) for row in await cursor.fetchall()]
+            if jobs:
+                await conn.executemany(
+                    "UPDATE jobs SET status = 'running', claimed_at = ? WHERE id = ?",
+                    [(now, job['id']) for job in jobs]
+                )
+            return jobs
+
+    async def _nearest_due(self) -> Optional[int]:
+        async with self.db.acquire(readonly=True) as conn:
+            cursor = await conn.execute("SELECT MIN(due_at) FROM jobs WHERE status = 'pending'")
+            return (await cursor.fetchone())[0]
+
+    async def _dispatch(self):
+        try:
+            # Задачи, взятые до перезапуска, выполняем заново. Больше взятые задачи не возвращаются:
+            # задача может ждать воркера в очереди или выполняться сколько угодно долго,
+            # и повторная выдача прислала бы пользователю дубль
+            async with self.db.acquire() as conn:
+                await conn.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+        except Exception as e:
+            logger.error(f"[JOBS] Не удалось вернуть прерванные задачи: {e}")
+        while True:
+            # Сбрасываем до чтения таблицы: задача, поставленная во время чтения, снова разбудит
+            self._wakeup.clear()
+            try:
+                jobs = await self._claim()
+                for job in jobs:
+                    await self._queue.put(job)
+                if len(jobs) == self.batch_size:
+                    # Наступивших задач может быть больше - сразу следующая пачка
+                    continue
+                self._next_due = await self._nearest_due()
+                delay = self.max_sleep if self._next_due is None else self._next_due - time.time()
+                delay = min(max(delay, 0.05), self.max_sleep)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[JOBS] Ошибка диспетчера: {e}")
+                delay = self.max_sleep
+            # asyncio.wait, а не wait_for: в 3.11 wait_for теряет отмену, если событие пришло одновременно с ней
+            waiter = asyncio.ensure_future(self._wakeup.wait())
+            try:
+                await asyncio.wait({waiter}, timeout=delay)
+            finally:
+                waiter.cancel()
+
+    # --- Воркеры ---
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._execute(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[JOBS] Ошибка учёта задачи {job['id']}: {e}")
+
+    async def _execute(self, job: Dict[str, Any]):
+        handler = self.handlers.get(job['job_type'])
+        try:
+            if handler is None:
+                raise LookupError(f"нет обработчика для {job['job_type']}")
+            # Отдельная задача - изменения contextvars обработчиком не переходят к следующим задачам
+            await asyncio.create_task(handler(job['user_id'], job['payload']))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            attempts = job['attempts'] + 1
+            async with self.db.acquire() as conn:
+                if attempts >= self.max_attempts or handler is None:
+                    self.failed += 1
+                    await conn.execute(
+                        "UPDATE jobs SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                        (attempts, str(e)[:500], job['id'])
+                    )
+                    logger.error(f"[JOBS] Задача {job['job_type']} пользователя {job['user_id']} не выполнена: {e}")
+                else:
+                    self.retried += 1
+                    await conn.execute(
+                        "UPDATE jobs SET status = 'pending', attempts = ?, last_error = ?, due_at = ? WHERE id = ?",
+                        (attempts, str(e)[:500], int(time.time() + self.retry_delay * attempts), job['id'])
+                    )
+            return
+        self.done += 1
+        async with self.db.acquire() as conn:
+            await conn.execute('DELETE FROM jobs WHERE id = ?', (job['id'],))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'done': self.done,
+            'retried': self.retried,
+            'failed': self.failed,
+            'queued': self._queue.qsize(),
+            'next_due_in': round(self._next_due - time.time()) if self._next_due else None,
+        }
@@ -0,0 +1,228 @@
+"""
+Контроль допуска запросов к LLM.
+На каждого провайдера - предел одновременных запросов и бюджет токенов в минуту
+(token bucket). Ожидающие запросы стоят в очередях по приоритету: платные подписчики,
+затем интерактивные бесплатные пользователи, затем фоновые задачи (автосообщения).
+При переполнении очереди или слишком долгом ожидании запрос отклоняется, время
+ожидания в очереди собирается в метрики.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Optional, Dict, Any, List
+
+from context_builder import estimate_message_tokens
+
+logger = logging.getLogger(__name__)
+
+# Полосы в порядке приоритета
+LANES = ('premium', 'interactive', 'background')
+
+# Полоса текущего запроса: выставляется обработчиком и наследуется задачами, созданными из него
+llm_lane: ContextVar[str] = ContextVar('llm_lane', default='interactive')
+
+
+class LLMOverloaded(Exception):
+    """Запрос отклонён контролем допуска (очередь переполнена или ожидание слишком долгое)"""
+
+
+def estimate_tokens(messages: List[Dict[str, str]], completion_tokens: int = 400) -> int:
+    """Оценка расхода токенов запроса: промпт плюс ожидаемый ответ"""
+    return estimate_message_tokens(messages) + completion_tokens
+
+
+class AdmissionTicket:
+    """Занятый слот провайдера; release() можно вызывать повторно"""
+
+    __slots__ = ('_gate', '_released')
+
+    def __init__(self, gate: Optional['_ProviderGate']):
+        self._gate = gate
+        self._released = gate is None
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._gate.in_flight -= 1
+            self._gate.dispatch()
+
+
+class _Waiter:
+    __slots__ = ('future', 'tokens', 'enqueued')
+
+    def __init__(self, future: asyncio.Future, tokens: int):
+        self.future = future
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+
+
+class _ProviderGate:
+    """Слоты и бюджет токенов одного провайдера с очередями по полосам"""
+
+    def __init__(self, concurrency: int, tokens_per_minute: int):
+        self.concurrency = concurrency
+        self.capacity = float(tokens_per_minute)
+        self.rate = tokens_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.queues: Dict[str, deque] = {lane: deque() for lane in LANES}
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, tokens: int) -> bool:
+        if self.in_flight >= self.concurrency:
+            return False
+        self._refill()
+        tokens = min(tokens, self.capacity)
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        self.in_flight += 1
+        return True
+
+    def queued_ahead(self, lane: str) -> bool:
+        """Есть ли ожидающие в этой полосе или в более приоритетных"""
+        return any(self.queues[name] for name in LANES[:LANES.index(lane) + 1])
+
+    def dispatch(self):
+        """Выдаёт слоты ожидающим строго по приоритету полос"""
+        for lane in LANES:
+            queue = self.queues[lane]
+            while queue:
+                waiter = queue[0]
+                if waiter.future.done():
+                    # Ожидание отменено или истекло
+                    queue.popleft()
+                    continue
+                if not self.try_take(waiter.tokens):
+                    self._schedule_retry(waiter.tokens)
+                    return
+                queue.popleft()
+                waiter.future.set_result(AdmissionTicket(self))
+
+    def _schedule_retry(self, tokens: int):
+        """Если мешает нехватка токенов (а не слотов), повторяем раздачу после пополнения"""
+        if self.in_flight >= self.concurrency or self._timer is not None:
+            return
+        deficit = min(tokens, self.capacity) - self.tokens
+        delay = max(0.05, deficit / self.rate) if self.rate > 0 else 1.0
+
+        def retry():
+            self._timer = None
+            self.dispatch()
+
+        self._timer = asyncio.get_running_loop().call_later(delay, retry)
+
+
+class LLMAdmission:
+    """Допуск запросов к провайдерам LLM с приоритетными очередями и сбросом нагрузки"""
+
+    def __init__(self, limits: Dict[str, Dict[str, int]], max_queue: Dict[str, int] = None,
+                 max_wait: Dict[str, float] = None):
+        """
+        Args:
+            limits: провайдер -> {'concurrency': ..., 'tokens_per_minute': ...};
+                провайдеры без лимитов пропускаются без ожидания
+            max_queue: полоса -> сколько запросов может ждать, сверх - отказ сразу
+            max_wait: полоса -> сколько секунд запрос может ждать слот
+        """
+        self._gates = {
+            provider: _ProviderGate(limit.get('concurrency', 10), limit.get('tokens_per_minute', 100000))
+            for provider, limit in limits.items()
+        }
+        self.max_queue = {'premium': 200, 'interactive': 200, 'background': 20, **(max_queue or {})}
+        self.max_wait = {'premium': 20.0, 'interactive': 15.0, 'background': 60.0, **(max_wait or {})}
+        # Метрики по полосам
+        self.waits: Dict[str, deque] = {lane: deque(maxlen=500) for lane in LANES}
+        self.admitted: Dict[str, int] = {lane: 0 for lane in LANES}
+        self.shed: Dict[str, int] = {lane: 0 for lane in LANES}
+
+    def _lane(self, lane: Optional[str]) -> str:
+        lane = lane or llm_lane.get()
+        return lane if lane in LANES else 'interactive'
+
+    def _admit(self, lane: str, waited: float):
+        self.admitted[lane] += 1
+        self.waits[lane].append(waited)
+
+    def try_acquire(self, provider: str, tokens: int, lane: str = None) -> Optional[AdmissionTicket]:
+        """Слот без ожидания или None (для необязательных запросов, например hedge)"""
+        gate = self._gates.get(provider)
+        if gate is None:
+            return AdmissionTicket(None)
+        lane = self._lane(lane)
+        if gate.queued_ahead(lane) or not gate.try_take(tokens):
+            return None
+        self._admit(lane, 0.0)
+        return AdmissionTicket(gate)
+
+    async def acquire(self, provider: str, tokens: int, lane: str = None) -> AdmissionTicket:
+        """Ждёт слот провайдера в очереди своей полосы; LLMOverloaded при перегрузке"""
+        gate = self._gates.get(provider)
+        if gate is None:
+            return AdmissionTicket(None)
+        lane = self._lane(lane)
+        if not gate.queued_ahead(lane) and gate.try_take(tokens):
+            self._admit(lane, 0.0)
+            return AdmissionTicket(gate)
+
+        queue = gate.queues[lane]
+        if len(queue) >= self.max_queue[lane]:
+            self.shed[lane] += 1
+            raise LLMOverloaded(f"Очередь {provider}/{lane} переполнена ({len(queue)})")
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), tokens)
+        queue.append(waiter)
+        gate.dispatch()
+        try:
+            async with asyncio.timeout(self.max_wait[lane]):
+                ticket = await waiter.future
+        except (TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Слот выдан в момент отмены - возвращаем его
+                waiter.future.result().release()
+            elif waiter in queue:
+                queue.remove(waiter)
+            if isinstance(e, TimeoutError):
+                self.shed[lane] += 1
+                raise LLMOverloaded(f"Нет свободного слота {provider}/{lane} за {self.max_wait[lane]:.0f} сек") from None
+            raise
+        self._admit(lane, time.monotonic() - waiter.enqueued)
+        return ticket
+
+    @staticmethod
+    def _percentile(values, q: float) -> Optional[float]:
+        if not values:
+            return None
+        ordered = sorted(values)
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))], 3)
+
+    def stats(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {
+            'lanes': {
+                lane: {
+                    'admitted': self.admitted[lane],
+                    'shed': self.shed[lane],
+                    'wait_p50': self._percentile(self.waits[lane], 0.5),
+                    'wait_p95': self._percentile(self.waits[lane], 0.95),
+                }
+                for lane in LANES
+            }
+        }
+        for provider, gate in self._gates.items():
+            gate._refill()
+            result[provider] = {
+                'in_flight': gate.in_flight,
+                'concurrency': gate.concurrency,
+                'tokens': int(gate.tokens),
+                'queued': {lane: len(gate.queues[lane]) for lane in LANES},
+            }
+        return result
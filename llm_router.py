@@ -0,0 +1,399 @@
+"""
+Маршрутизатор запросов к LLM с учётом задержек провайдеров.
+Ведёт скользящую статистику TTFT/латентности/ошибок по каждой паре (провайдер, модель),
+размыкает цепь при всплеске ошибок и переключается на эквивалентную модель другого
+провайдера. Таймауты подстраиваются под p95 модели, опционально после p95 TTFT
+запускается страхующий (hedge) запрос к запасному провайдеру - побеждает тот,
+кто первым прислал первый фрагмент.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Optional, Dict, Any, List, Tuple, Callable, Awaitable, AsyncIterator
+
+from llm_admission import LLMAdmission, LLMOverloaded, AdmissionTicket, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Провайдер: (messages, model) -> асинхронный итератор фрагментов ответа
+StreamFactory = Callable[[List[Dict[str, str]], str], AsyncIterator[str]]
+Target = Tuple[str, str]
+
+
+class LLMUnavailable(Exception):
+    """Ни один из провайдеров не смог ответить"""
+
+
+class RollingStats:
+    """Скользящее окно последних запросов к одной модели"""
+
+    def __init__(self, window: int = 200, horizon: float = 600.0):
+        self.horizon = horizon
+        # (время, успех, ttft, латентность)
+        self.samples: deque = deque(maxlen=window)
+
+    def record(self, ok: bool, ttft: Optional[float] = None, latency: Optional[float] = None):
+        self.samples.append((time.monotonic(), ok, ttft, latency))
+
+    def _recent(self):
+        border = time.monotonic() - self.horizon
+        return [s for s in self.samples if s[0] >= border]
+
+    @staticmethod
+    def _percentile(values: List[float], q: float) -> Optional[float]:
+        if not values:
+            return None
+        values.sort()
+        return values[min(len(values) - 1, int(len(values) * q))]
+
+    def percentile(self, field: str, q: float = 0.95, min_samples: int = 10) -> Optional[float]:
+        """Перцентиль ttft или latency по успешным запросам (None, пока данных мало)"""
+        index = 2 if field == 'ttft' else 3
+        values = [s[index] for s in self._recent() if s[1] and s[index] is not None]
+        if len(values) < min_samples:
+            return None
+        return self._percentile(values, q)
+
+    def error_rate(self) -> Tuple[float, int]:
+        recent = self._recent()
+        if not recent:
+            return 0.0, 0
+        return sum(1 for s in recent if not s[1]) / len(recent), len(recent)
+
+
+class CircuitBreaker:
+    """closed -> open при всплеске ошибок -> half_open после паузы -> closed после удачной пробы"""
+
+    def __init__(self, failure_threshold: int = 5, error_rate: float = 0.5, min_requests: int = 10,
+                 cooldown: float = 30.0, max_cooldown: float = 300.0):
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate
+        self.min_requests = min_requests
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = 'closed'
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = 'half_open'
+            self._probe_in_flight = False
+        if self.state == 'half_open' and not self._probe_in_flight:
+            # Пропускаем один пробный запрос
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def release(self):
+        """Снимает отметку пробы, если пробный запрос отменён без результата"""
+        self._probe_in_flight = False
+
+    def on_success(self) -> bool:
+        """Возвращает True, если цепь замкнулась после пробы"""
+        self.consecutive_failures = 0
+        if self.state != 'closed':
+            self.state = 'closed'
+            self.cooldown = self.base_cooldown
+            self._probe_in_flight = False
+            return True
+        return False
+
+    def on_failure(self, stats: RollingStats) -> bool:
+        """Возвращает True, если цепь только что разомкнулась"""
+        self.consecutive_failures += 1
+        if self.state == 'half_open':
+            # Проба не удалась - ждём дольше
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            self._open()
+            return True
+        if self.state == 'closed':
+            rate, count = stats.error_rate()
+            if (self.consecutive_failures >= self.failure_threshold or
+                    (count >= self.min_requests and rate >= self.error_rate_threshold)):
+                self._open()
+                return True
+        return False
+
+    def _open(self):
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+        self._probe_in_flight = False
+
+
+class LLMRouter:
+    """Выбор провайдера, адаптивные таймауты, failover и hedging для потоковых запросов к LLM"""
+
+    def __init__(self, providers: Dict[str, StreamFactory], failover: Dict[str, Target] = None,
+                 timeout: float = 30.0, min_ttft_timeout: float = 5.0, ttft_factor: float = 3.0,
+                 min_total_timeout: float = 10.0, total_factor: float = 2.5,
+                 hedging: bool = False, hedge_delay: float = 4.0,
+                 on_circuit_open: Callable[[str, str], Awaitable[None]] = None,
+                 admission: LLMAdmission = None):
+        """
+        Args:
+            providers: имя провайдера -> фабрика потока ответа
+            failover: модель (или имя провайдера) -> запасная пара (провайдер, модель)
+            timeout: верхняя граница ожидания, как и раньше 30 секунд
+            min_ttft_timeout, ttft_factor: таймаут первого фрагмента = max(min, p95 TTFT * factor)
+            min_total_timeout, total_factor: таймаут всего ответа = max(min, p95 латентности * factor)
+            hedging: запускать ли страхующий запрос после hedge-задержки (p95 TTFT)
+            hedge_delay: hedge-задержка, пока по модели мало статистики
+            on_circuit_open: корутина (ключ, причина) для алерта при размыкании цепи
+            admission: контроль допуска; время в его очереди не входит в таймауты и статистику провайдера
+        """
+        self.providers = providers
+        self.failover = failover or {}
+        self.timeout = timeout
+        self.min_ttft_timeout = min_ttft_timeout
+        self.ttft_factor = ttft_factor
+        self.min_total_timeout = min_total_timeout
+        self.total_factor = total_factor
+        self.hedging = hedging
+        self.hedge_delay_default = hedge_delay
+        self.on_circuit_open = on_circuit_open
+        self.admission = admission
+        self._stats: Dict[str, RollingStats] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        # Метрики
+        self.failovers = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @staticmethod
+    def _key(target: Target) -> str:
+        return f"{target[0]}:{target[1]}"
+
+    def _stats_for(self, target: Target) -> RollingStats:
+        key = self._key(target)
+        if key not in self._stats:
+            self._stats[key] = RollingStats()
+        return self._stats[key]
+
+    def _breaker(self, target: Target) -> CircuitBreaker:
+        key = self._key(target)
+        if key not in self._breakers:
+            self._breakers[key] = CircuitBreaker()
+        return self._breakers[key]
+
+    def ttft_timeout(self, target: Target) -> float:
+        p95 = self._stats_for(target).percentile('ttft')
+        if p95 is None:
+            return self.timeout
+        return min(self.timeout, max(self.min_ttft_timeout, p95 * self.ttft_factor))
+
+    def total_timeout(self, target: Target) -> float:
+        p95 = self._stats_for(target).percentile('latency')
+        if p95 is None:
+            return self.timeout
+        return min(self.timeout, max(self.min_total_timeout, p95 * self.total_factor))
+
+    def hedge_delay(self, target: Target) -> float:
+        p95 = self._stats_for(target).percentile('ttft')
+        return p95 if p95 is not None else self.hedge_delay_default
+
+    def candidates(self, provider: str, model: str) -> List[Target]:
+        """Основная пара (провайдер, модель) и запасная из карты failover"""
+        primary = (provider, model)
+        result = [primary]
+        fallback = self.failover.get(model) or self.failover.get(provider)
+        if fallback and tuple(fallback) != primary and fallback[0] in self.providers:
+            result.append(tuple(fallback))
+        return result
+
+    def _record_success(self, target: Target, ttft: float, latency: float):
+        self._stats_for(target).record(True, ttft, latency)
+        if self._breaker(target).on_success():
+            logger.info(f"[LLM] Цепь {self._key(target)} снова замкнута")
+
+    def _record_failure(self, target: Target, error: BaseException):
+        stats = self._stats_for(target)
+        stats.record(False)
+        if self._breaker(target).on_failure(stats):
+            key = self._key(target)
+            reason = f"{type(error).__name__}: {error}"
+            logger.warning(f"[LLM] Цепь {key} разомкнута на {self._breaker(target).cooldown:.0f} сек ({reason})")
+            if self.on_circuit_open:
+                asyncio.create_task(self.on_circuit_open(key, reason))
+
+    async def complete(self, provider: str, model: str, messages: List[Dict[str, str]],
+                       on_delta: Callable[[str], Awaitable[None]] = None) -> str:
+        """Полный текст ответа; с on_delta фрагменты передаются по мере прихода.
+
+        Переключение на запасную модель возможно, пока пользователю не ушёл ни один фрагмент.
+        """
+        candidates = self.candidates(provider, model)
+        tried = set()
+        last_error: Optional[BaseException] = None
+        for target in candidates:
+            if target in tried or not self._breaker(target).allow():
+                continue
+            if target != candidates[0]:
+                self.failovers += 1
+                logger.warning(f"[LLM] Переключение {self._key(candidates[0])} -> {self._key(target)}")
+            hedge = None
+            if self.hedging:
+                hedge = next((t for t in candidates if t != target and t not in tried), None)
+            try:
+                ticket = await self._admit(target, messages)
+            except (LLMOverloaded, asyncio.CancelledError) as e:
+                # Провайдер перегружен нашими же запросами - пробуем запасной, цепь не трогаем
+                self._breaker(target).release()
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                last_error = e
+                continue
+            try:
+                return await self._attempt(target, hedge, messages, on_delta, tried, ticket)
+            except _StreamBroken as e:
+                # Часть ответа уже показана - повторять на другом провайдере нельзя
+                raise e.__cause__
+            except Exception as e:
+                last_error = e
+        if last_error is None:
+            raise LLMUnavailable(f"Все провайдеры для {model} временно отключены")
+        if isinstance(last_error, (asyncio.TimeoutError, LLMOverloaded)):
+            raise last_error
+        raise LLMUnavailable(str(last_error)) from last_error
+
+    async def _admit(self, target: Target, messages) -> AdmissionTicket:
+        if self.admission is None:
+            return AdmissionTicket(None)
+        return await self.admission.acquire(target[0], estimate_tokens(messages))
+
+    async def _attempt(self, primary: Target, hedge: Optional[Target], messages, on_delta, tried: set,
+                       ticket: AdmissionTicket) -> str:
+        tasks: Dict[asyncio.Future, Tuple[Target, AsyncIterator[str], float]] = {}
+        tickets: Dict[Target, AdmissionTicket] = {primary: ticket}
+        try:
+            return await self._race(primary, hedge, messages, on_delta, tried, tasks, tickets)
+        finally:
+            for ticket in tickets.values():
+                ticket.release()
+
+    async def _race(self, primary: Target, hedge: Optional[Target], messages, on_delta, tried: set,
+                    tasks: Dict[asyncio.Future, Tuple[Target, AsyncIterator[str], float]],
+                    tickets: Dict[Target, AdmissionTicket]) -> str:
+        def launch(target: Target):
+            tried.add(target)
+            stream = self.providers[target[0]](messages, target[1])
+            tasks[asyncio.ensure_future(stream.__anext__())] = (target, stream, time.monotonic())
+
+        start = time.monotonic()
+        launch(primary)
+        deadline = start + self.ttft_timeout(primary)
+        hedge_at = start + self.hedge_delay(primary) if hedge else None
+        winner = None
+        last_error: Optional[BaseException] = None
+        try:
+            # Ждём первый фрагмент от основной модели (и страхующей, если запущена)
+            while winner is None:
+                if not tasks:
+                    raise last_error
+                now = time.monotonic()
+                wake = min(deadline, hedge_at) if hedge_at else deadline
+                done, _ = await asyncio.wait(tasks, timeout=max(0.0, wake - now),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    target, stream, started = tasks.pop(task)
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
+                        first = ''
+                    except Exception as e:
+                        self._record_failure(target, e)
+                        tickets[target].release()
+                        last_error = e
+                        continue
+                    winner = (target, stream, started, first)
+                    break
+                if winner is not None:
+                    break
+                now = time.monotonic()
+                if hedge_at and now >= hedge_at:
+                    hedge_at = None
+                    # Страховка необязательна: без свободного слота провайдера её не запускаем
+                    hedge_ticket = (self.admission.try_acquire(hedge[0], estimate_tokens(messages))
+                                    if self.admission else AdmissionTicket(None))
+                    if hedge_ticket and not self._breaker(hedge).allow():
+                        hedge_ticket.release()
+                        hedge_ticket = None
+                    if hedge_ticket:
+                        tickets[hedge] = hedge_ticket
+                        self.hedges += 1
+                        logger.info(f"[LLM] Нет первого фрагмента от {self._key(primary)}, "
+                                    f"страхующий запрос к {self._key(hedge)}")
+                        launch(hedge)
+                        deadline = max(deadline, now + self.ttft_timeout(hedge))
+                elif now >= deadline and tasks:
+                    error = asyncio.TimeoutError()
+                    for target, _, _ in tasks.values():
+                        self._record_failure(target, error)
+                    raise error
+        finally:
+            await self._cancel(tasks, tickets)
+
+        target, stream, started, first = winner
+        if target != primary:
+            self.hedge_wins += 1
+        ttft = time.monotonic() - started
+        parts = []
+        try:
+            async with asyncio.timeout(max(0.0, started + self.total_timeout(target) - time.monotonic())):
+                if first:
+                    parts.append(first)
+                    if on_delta:
+                        await on_delta(first)
+                    async for delta in stream:
+                        parts.append(delta)
+                        if on_delta:
+                            await on_delta(delta)
+        except Exception as e:
+            self._record_failure(target, e)
+            if parts and on_delta:
+                raise _StreamBroken() from e
+            raise
+        finally:
+            await stream.aclose()
+            self._breaker(target).release()
+        self._record_success(target, ttft, time.monotonic() - started)
+        return ''.join(parts)
+
+    async def _cancel(self, tasks, tickets: Dict[Target, AdmissionTicket]):
+        """Отменяет проигравшие запросы, закрывает их потоки (с соединениями) и освобождает слоты"""
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for target, stream, _ in tasks.values():
+            self._breaker(target).release()
+            tickets[target].release()
+            try:
+                await stream.aclose()
+            except Exception:
+                pass
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        for key, stats in self._stats.items():
+            rate, count = stats.error_rate()
+            ttft = stats.percentile('ttft', min_samples=1)
+            latency = stats.percentile('latency', min_samples=1)
+            result[key] = {
+                'requests': count,
+                'error_rate': round(rate, 3),
+                'p95_ttft': round(ttft, 2) if ttft is not None else None,
+                'p95_latency': round(latency, 2) if latency is not None else None,
+                'circuit': self._breakers[key].state if key in self._breakers else 'closed',
+            }
+        result['_router'] = {'failovers': self.failovers, 'hedges': self.hedges, 'hedge_wins': self.hedge_wins}
+        return result
+
+
+class _StreamBroken(Exception):
+    """Поток оборвался после того, как часть ответа уже отдана в on_delta"""
@@ -0,0 +1,184 @@
+"""
+Потоковый клиент OpenAI-совместимых API (Server-Sent Events).
+SSEParser разбирает события из буфера байтов по мере прихода кусков, не завися от
+того, как сеть нарезала поток на строки. LLMStream - асинхронный итератор фрагментов
+ответа, который копит их в список и замеряет TTFT и скорость генерации; его можно
+читать по фрагментам (async for) или дождаться полного текста (await stream).
+"""
+
+import json
+import logging
+import time
+from collections import deque, defaultdict
+from typing import Optional, Dict, Any, List, Callable, AsyncContextManager
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class SSEParser:
+    """Инкрементальный разбор SSE: feed() возвращает data-полезные нагрузки завершённых событий"""
+
+    __slots__ = ('_buffer',)
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        if b'\r' in chunk:
+            chunk = chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        self._buffer += chunk
+        end = self._buffer.rfind(b'\n\n')
+        if end < 0:
+            return []
+        complete = bytes(self._buffer[:end])
+        del self._buffer[:end + 2]
+
+        events = []
+        for block in complete.split(b'\n\n'):
+            data = [line[5:].lstrip(b' ') if line.startswith(b'data:') else None for line in block.split(b'\n')]
+            data = [line for line in data if line is not None]
+            if data:
+                events.append(data[0] if len(data) == 1 else b'\n'.join(data))
+        return events
+
+    def flush(self) -> List[bytes]:
+        """Последнее событие без завершающей пустой строки (если сервер оборвал поток)"""
+        if not self._buffer.strip():
+            return []
+        self._buffer += b'\n\n'
+        return self.feed(b'')
+
+
+class StreamMetrics:
+    """Последние замеры TTFT и скорости генерации по провайдерам"""
+
+    def __init__(self, window: int = 200):
+        self._samples: Dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+
+    def record(self, provider: str, ttft: Optional[float], tokens_per_second: Optional[float]):
+        self._samples[provider].append((ttft, tokens_per_second))
+
+    @staticmethod
+    def _median(values: List[float]) -> Optional[float]:
+        if not values:
+            return None
+        values.sort()
+        return round(values[len(values) // 2], 2)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            provider: {
+                'streams': len(samples),
+                'ttft_median': self._median([s[0] for s in samples if s[0] is not None]),
+                'tps_median': self._median([s[1] for s in samples if s[1] is not None]),
+            }
+            for provider, samples in self._samples.items()
+        }
+
+
+stream_metrics = StreamMetrics()
+
+
+class LLMStream:
+    """Фрагменты одного потокового ответа: async for по фрагментам или await за полным текстом"""
+
+    def __init__(self, open_response: Callable[[], AsyncContextManager[aiohttp.ClientResponse]], provider: str):
+        """
+        Args:
+            open_response: функция, открывающая запрос (например, lambda: session.post(...))
+            provider: имя провайдера для ошибок и метрик
+        """
+        self.provider = provider
+        self.parts: List[str] = []
+        self.started: Optional[float] = None
+        self.ttft: Optional[float] = None
+        self.duration: Optional[float] = None
+        self.completion_tokens: Optional[int] = None
+        self.malformed = 0
+        self._open_response = open_response
+        self._iterator = self._iterate()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        return await self._iterator.__anext__()
+
+    async def aclose(self):
+        await self._iterator.aclose()
+
+    def __await__(self):
+        return self.read().__await__()
+
+    async def read(self) -> str:
+        """Дочитывает поток и возвращает полный текст ответа"""
+        async for _ in self:
+            pass
+        return self.text
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.parts)
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        """Скорость генерации после первого фрагмента (токены из usage, иначе число фрагментов)"""
+        if self.duration is None or self.ttft is None:
+            return None
+        generating = self.duration - self.ttft
+        tokens = self.completion_tokens or len(self.parts)
+        return tokens / generating if generating > 0 else None
+
+    def _handle(self, data: bytes) -> Optional[str]:
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            self.malformed += 1
+            return None
+        if not isinstance(chunk, dict):
+            self.malformed += 1
+            return None
+        usage = chunk.get('usage') or (chunk.get('x_groq') or {}).get('usage')
+        if usage and usage.get('completion_tokens'):
+            self.completion_tokens = usage['completion_tokens']
+        try:
+            return chunk['choices'][0]['delta'].get('content')
+        except (KeyError, IndexError, TypeError, AttributeError):
+            # Служебные чанки (например, только с usage) без фрагмента текста
+            return None
+
+    @staticmethod
+    async def _events(response: aiohttp.ClientResponse, parser: SSEParser):
+        async for chunk in response.content.iter_any():
+            for data in parser.feed(chunk):
+                yield data
+        for data in parser.flush():
+            yield data
+
+    async def _iterate(self):
+        self.started = time.monotonic()
+        try:
+            async with self._open_response() as response:
+                if response.status != 200:
+                    body = (await response.text())[:200]
+                    raise Exception(f"{self.provider} API error: {response.status} {body}".rstrip())
+                events = self._events(response, SSEParser())
+                try:
+                    async for data in events:
+                        if data == b'[DONE]':
+                            break
+                        delta = self._handle(data)
+                        if delta:
+                            if self.ttft is None:
+                                self.ttft = time.monotonic() - self.started
+                            self.parts.append(delta)
+                            yield delta
+                finally:
+                    await events.aclose()
+            self.duration = time.monotonic() - self.started
+            stream_metrics.record(self.provider, self.ttft, self.tokens_per_second)
+        finally:
+            if self.malformed:
+                logger.warning(f"[LLM] {self.provider}: пропущено битых чанков: {self.malformed}")
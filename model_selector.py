@@ -12,6 +12,8 @@ import aiohttp_cors
 from aiohttp.web import Request, Response, json_response
 import html as html_lib
 
+from subscription_cache import SubscriptionCache, parse_expires_at
+
 # Импорт конфигурации
 try:
     from config import *
@@ -23,6 +25,10 @@ except ImportError:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Бот сбрасывает только свой кэш после оплаты или /gift, поэтому здесь отказ не кэшируем:
+# только что оплативший пользователь сразу видит премиум-модели открытыми
+subscription_cache = SubscriptionCache(negative_ttl=0)
+
 # Каталог моделей с подробной информацией
 BASIC_MODELS = {
     "Любовница": {
@@ -335,19 +341,16 @@ class Database:
     
     async def has_active_subscription(self, user_id: int) -> bool:
         """Проверяет наличие активной подписки у пользователя"""
+        cached = subscription_cache.lookup(user_id)
+        if cached is not None:
+            return cached
         assert self._conn is not None
         cursor = await self._conn.execute(
             'SELECT expires_at FROM subscriptions WHERE user_id = ?',
             (user_id,)
         )
         row = await cursor.fetchone()
-        if not row or not row['expires_at']:
-            return False
-        try:
-            expires_at = datetime.fromisoformat(row['expires_at'])
-            return expires_at >= datetime.now()
-        except Exception:
-            return False
+        return subscription_cache.store(user_id, parse_expires_at(row['expires_at'] if row else None))
 
 def generate_model_card(model_key: str, model_info: dict, current_model: str, has_premium: bool = False) -> str:
     """Генерирует HTML карточки модели"""
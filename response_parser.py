@@ -0,0 +1,90 @@
+"""
+Разбор ответа LLM за один проход.
+Один заранее скомпилированный токенизатор находит в тексте служебную разметку:
+[действия: ...], строки "Действия: ..." / "Варианты действий: ...", [image: ...]
+и [IMAGE_PROMPT] промпт|подпись - и возвращает чистый текст, варианты действий,
+промпты изображений и подписи в типизированном результате. Проход линейный,
+поэтому разбор дёшев и для каждого фрагмента потокового ответа.
+"""
+
+import re
+from typing import List, NamedTuple, Optional
+
+# Альтернативы токенизатора; флаги заданы внутри групп, общий флаг - MULTILINE для ^
+_TOKEN_RE = re.compile(
+    r'(?is:\[действия:(?P<actions>.*?)\])'
+    r'|(?i:\[image:\s*(?P<image>[^\n]*?)\])'
+    r'|(?s:\[IMAGE_PROMPT\]\s*(?P<prompt>.*?)\|)'
+    r'|^[ \t]*(?:[Вв]арианты\s+)?[Дд]ействи[яйе]?\b[ \t]*:?[ \t]*(?P<line>[^\n]*)\n?',
+    re.MULTILINE
+)
+
+# Нумерация и служебные слова, которые модель иногда пишет перед вариантом действия
+_ACTION_PREFIX_RE = re.compile(
+    r'^(первый|второй|третий|один|два|три)?\s*(вариант|действие)?\s*(продолжени[еяй]|диалога)?(:|\.|\s)*',
+    re.IGNORECASE
+)
+
+MAX_ACTIONS = 2
+
+
+class ImagePrompt(NamedTuple):
+    prompt: str
+    caption: str
+
+
+class ParsedResponse(NamedTuple):
+    text: str                    # текст для пользователя без разметки
+    actions: List[str]           # до двух вариантов продолжения для клавиатуры
+    images: List[str]            # промпты из [image: ...] (персонажи 18+)
+    prompts: List[ImagePrompt]   # [IMAGE_PROMPT] промпт|подпись (обычные персонажи)
+
+
+def _clean_actions(raw: Optional[str]) -> List[str]:
+    if not raw:
+        return []
+    actions = []
+    for action in raw.strip().split(','):
+        action = _ACTION_PREFIX_RE.sub('', action.strip(), count=1).strip()
+        if action:
+            actions.append(action)
+            if len(actions) == MAX_ACTIONS:
+                break
+    return actions
+
+
+def parse_response(text: str) -> ParsedResponse:
+    """Разбирает ответ за один проход.
+
+    Действия берутся из последнего тега [действия: ...], а без него - из последней
+    строки "Действия: ...". Подпись к [IMAGE_PROMPT] - текст после "|" до следующего
+    [IMAGE_PROMPT] или конца ответа; в тексте сообщения она тоже остаётся.
+    """
+    pieces: List[str] = []
+    images: List[str] = []
+    prompts: List[ImagePrompt] = []
+    tag_actions = line_actions = None
+    prompt: Optional[str] = None
+    caption_start = 0
+    pos = 0
+    for match in _TOKEN_RE.finditer(text):
+        pieces.append(text[pos:match.start()])
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == 'actions':
+            tag_actions = match.group('actions')
+        elif kind == 'line':
+            line_actions = match.group('line')
+        elif kind == 'image':
+            images.append(match.group('image'))
+        else:
+            if prompt is not None:
+                prompts.append(ImagePrompt(prompt, ''.join(pieces[caption_start:]).strip()))
+            prompt = match.group('prompt').strip()
+            caption_start = len(pieces)
+    pieces.append(text[pos:])
+    if prompt is not None:
+        prompts.append(ImagePrompt(prompt, ''.join(pieces[caption_start:]).strip()))
+
+    actions = _clean_actions(tag_actions if tag_actions is not None else line_actions)
+    return ParsedResponse(''.join(pieces).strip(), actions, images, prompts)
@@ -0,0 +1,76 @@
+"""
+Кэш статуса подписок с учётом срока действия.
+Используется в bot.py и model_selector.py (у каждого процесса свой экземпляр): хранит
+expires_at пользователя и отвечает локально до этого момента, не обращаясь к таблице
+subscriptions. Отрицательный ответ живёт negative_ttl секунд; 0 - не кэшируется.
+"""
+
+import time
+from datetime import datetime
+from typing import Optional, Dict, Tuple
+
+
+def parse_expires_at(raw: Optional[str]) -> Optional[datetime]:
+    """Разбирает expires_at из БД, пустые и битые значения считаются отсутствием подписки"""
+    if not raw:
+        return None
+    try:
+        return datetime.fromisoformat(raw)
+    except (TypeError, ValueError):
+        return None
+
+
+class SubscriptionCache:
+    """Кэш подписок: положительный ответ живёт до expires_at, отрицательный - negative_ttl секунд"""
+
+    def __init__(self, negative_ttl: float = 60.0, max_entries: int = 100000):
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        # user_id -> (expires_at или None, время проверки по time.monotonic())
+        self._entries: Dict[int, Tuple[Optional[datetime], float]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, user_id: int) -> Optional[bool]:
+        """
+        Возвращает True/False, если статус известен, и None, если нужно идти в БД
+        """
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            expires_at, checked_at = entry
+            if expires_at is not None and expires_at >= datetime.now():
+                self.hits += 1
+                return True
+            if time.monotonic() - checked_at < self.negative_ttl:
+                self.hits += 1
+                return False
+            del self._entries[user_id]
+        self.misses += 1
+        return None
+
+    def expires_at(self, user_id: int) -> Optional[datetime]:
+        """Закэшированная дата окончания подписки (None, если неизвестна или подписки нет)"""
+        entry = self._entries.get(user_id)
+        return entry[0] if entry else None
+
+    def store(self, user_id: int, expires_at: Optional[datetime]) -> bool:
+        """Запоминает результат запроса к БД и возвращает, активна ли подписка"""
+        active = expires_at is not None and expires_at >= datetime.now()
+        if not active and self.negative_ttl <= 0:
+            self._entries.pop(user_id, None)
+            return False
+        if len(self._entries) >= self.max_entries:
+            self._entries.clear()
+        self._entries[user_id] = (expires_at, time.monotonic())
+        return active
+
+    def invalidate(self, user_id: int = None):
+        """Сбрасывает кэш пользователя (или весь кэш) после изменения подписки"""
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user_id, None)
+
+
+# Экземпляр на процесс
+subscription_cache = SubscriptionCache()
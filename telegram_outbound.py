@@ -0,0 +1,262 @@
+"""
+Планировщик исходящих сообщений Telegram.
+Подключается как request middleware сессии aiogram, поэтому через него проходят все
+send_message/answer/answer_photo/send_photo/edit_message_text бота, откуда бы они
+ни вызывались. Лимиты расходуют только вызовы, которые публикуют или правят сообщение
+в чате; чтение (getChatMember, getChat, getMe), getUpdates и служебные вызовы идут
+напрямую. Соблюдает общий лимит (~30 сообщений/с) и лимит на чат через
+token bucket, выдаёт слоты по классам приоритета (ответы в диалоге, платежи,
+авто/промо-сообщения, рассылки) и держит резерв общего лимита для ответов в диалоге,
+чтобы они не вставали в очередь за массовой отправкой. На 429 RetryAfter ждёт
+указанное время и повторяет запрос; 403 от пользователя передаётся в on_blocked.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque, OrderedDict
+from contextvars import ContextVar
+from typing import Optional, Dict, Any, Callable, Awaitable
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+from aiogram.methods import (
+    SendMessage, SendPhoto, SendVideo, SendAudio, SendDocument, SendVoice, SendAnimation,
+    SendVideoNote, SendSticker, SendMediaGroup, SendLocation, SendVenue, SendContact,
+    SendPoll, SendDice, SendInvoice, CopyMessage, CopyMessages, ForwardMessage, ForwardMessages,
+    EditMessageText, EditMessageCaption, EditMessageReplyMarkup, EditMessageMedia,
+    EditMessageLiveLocation,
+)
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета в порядке убывания
+PRIORITIES = ('interactive', 'payment', 'auto', 'broadcast')
+
+# Класс текущей отправки: выставляется фоновой задачей и наследуется её подзадачами
+send_priority: ContextVar[str] = ContextVar('send_priority', default='interactive')
+
+# Вызовы, которые публикуют или правят сообщение в чате - только они расходуют лимиты.
+# Остальные (getChatMember, getUpdates, sendChatAction, answerCallbackQuery...) идут напрямую:
+# проверка подписки несёт chat_id канала и иначе делила бы один bucket на всех пользователей
+_METERED = (
+    SendMessage, SendPhoto, SendVideo, SendAudio, SendDocument, SendVoice, SendAnimation,
+    SendVideoNote, SendSticker, SendMediaGroup, SendLocation, SendVenue, SendContact,
+    SendPoll, SendDice, SendInvoice, CopyMessage, CopyMessages, ForwardMessage, ForwardMessages,
+    EditMessageText, EditMessageCaption, EditMessageReplyMarkup, EditMessageMedia,
+    EditMessageLiveLocation,
+)
+
+# Правки не повторяем после RetryAfter: следующая правка черновика всё равно их заменит
+_NO_RETRY = (EditMessageText, EditMessageCaption, EditMessageReplyMarkup, EditMessageMedia)
+
+# Классы, которым доступен весь общий лимит; остальные не трогают резерв и встают на паузу после 429
+_URGENT = ('interactive', 'payment')
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # До этого момента bucket заморожен (после RetryAfter)
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, reserve: float = 0.0) -> bool:
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self._refill(now)
+        if self.tokens - 1 < reserve:
+            return False
+        self.tokens -= 1
+        return True
+
+    def delay(self, reserve: float = 0.0) -> float:
+        """Через сколько секунд станет возможен try_take(reserve)"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, (reserve + 1 - self.tokens) / self.rate) if self.rate > 0 else 1.0
+        return max(wait, self.paused_until - now)
+
+    def pause(self, seconds: float):
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0.0
+        self.updated = now
+
+    def give_back(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Лимиты и приоритеты исходящих запросов бота"""
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 interactive_reserve: float = 5.0, max_retries: int = 3, max_retry_after: float = 60.0,
+                 interactive_retry_after: float = 10.0, on_blocked: Callable[[int], Awaitable[None]] = None, max_chats: int = 50000):
+        """
+        Args:
+            global_rate: сообщений в секунду на весь бот
+            chat_rate, chat_burst: сообщений в секунду в один чат и допустимая пачка
+            interactive_reserve: сколько токенов общего лимита недоступны авто-сообщениям и рассылкам
+            max_retries: повторов после RetryAfter
+            max_retry_after: больше этого ожидания запрос не повторяется, ошибка уходит вызывающему
+            interactive_retry_after: то же для ответов в диалоге и платежей - пользователь ждёт
+            on_blocked: корутина (chat_id), когда пользователь заблокировал бота
+            max_chats: сколько bucket'ов чатов держать в памяти
+        """
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.interactive_reserve = interactive_reserve
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self.interactive_retry_after = interactive_retry_after
+        self.on_blocked = on_blocked
+        self.max_chats = max_chats
+        self._chats: OrderedDict = OrderedDict()
+        self._queues: Dict[str, deque] = {priority: deque() for priority in PRIORITIES}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # После 429 на массовой отправке авто-сообщения и рассылки ждут до этого момента
+        self._bulk_paused_until = 0.0
+        # Метрики
+        self.sent: Dict[str, int] = {priority: 0 for priority in PRIORITIES}
+        self.waits: Dict[str, deque] = {priority: deque(maxlen=500) for priority in PRIORITIES}
+        self.retry_after = 0
+        self.blocked = 0
+
+    def _reserve(self, priority: str) -> float:
+        return 0.0 if priority in _URGENT else self.interactive_reserve
+
+    def _take_global(self, priority: str) -> bool:
+        if priority not in _URGENT and time.monotonic() < self._bulk_paused_until:
+            return False
+        return self.global_bucket.try_take(self._reserve(priority))
+
+    def _global_delay(self, priority: str) -> float:
+        delay = self.global_bucket.delay(self._reserve(priority))
+        if priority not in _URGENT:
+            delay = max(delay, self._bulk_paused_until - time.monotonic())
+        return delay
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_chats:
+                self._chats.popitem(last=False)
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _wait_chat(self, chat_id):
+        bucket = self._chat_bucket(chat_id)
+        while not bucket.try_take():
+            await asyncio.sleep(bucket.delay())
+
+    async def _wait_global(self, priority: str):
+        ahead = any(self._queues[p] for p in PRIORITIES[:PRIORITIES.index(priority) + 1])
+        if not ahead and self._take_global(priority):
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].append(future)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                # Слот уже выдан - возвращаем токен
+                self.global_bucket.give_back()
+            raise
+
+    def _dispatch(self):
+        """Раздаёт токены общего лимита ожидающим строго по приоритету"""
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            while queue:
+                if queue[0].done():
+                    queue.popleft()
+                    continue
+                if not self._take_global(priority):
+                    self._schedule(self._global_delay(priority))
+                    return
+                queue.popleft().set_result(None)
+
+    def _schedule(self, delay: float):
+        loop = asyncio.get_running_loop()
+        when = loop.time() + max(delay, 0.01)
+        if self._timer is not None:
+            if self._timer.when() <= when:
+                return
+            # Ответ в диалоге не должен ждать таймера, заведённого для рассылки на паузе
+            self._timer.cancel()
+
+        def wake():
+            self._timer = None
+            self._dispatch()
+
+        self._timer = loop.call_at(when, wake)
+
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, _METERED):
+            return await make_request(bot, method)
+        chat_id = getattr(method, 'chat_id', None)
+        priority = send_priority.get()
+        if priority not in PRIORITIES:
+            priority = 'interactive'
+
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            if chat_id is not None:
+                await self._wait_chat(chat_id)
+            await self._wait_global(priority)
+            self.waits[priority].append(time.monotonic() - started)
+            try:
+                response = await make_request(bot, method)
+                self.sent[priority] += 1
+                return response
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                attempt += 1
+                logger.warning(f"[OUTBOUND] RetryAfter {e.retry_after} сек (чат {chat_id}, {priority}), попытка {attempt}")
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).pause(e.retry_after)
+                if priority not in _URGENT:
+                    # Массовые отправки притормаживаем целиком, ответы в диалоге идут дальше
+                    self._bulk_paused_until = max(self._bulk_paused_until, time.monotonic() + e.retry_after)
+                limit = self.interactive_retry_after if priority in _URGENT else self.max_retry_after
+                if isinstance(method, _NO_RETRY) or attempt > self.max_retries or e.retry_after > limit:
+                    raise
+            except TelegramForbiddenError:
+                if chat_id is not None and isinstance(chat_id, int) and chat_id > 0:
+                    self.blocked += 1
+                    if self.on_blocked:
+                        try:
+                            await self.on_blocked(chat_id)
+                        except Exception as e:
+                            logger.error(f"[OUTBOUND] Не удалось отметить блокировку {chat_id}: {e}")
+                raise
+
+    @staticmethod
+    def _percentile(values, q: float) -> Optional[float]:
+        if not values:
+            return None
+        ordered = sorted(values)
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))], 3)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'sent': dict(self.sent),
+            'queued': {priority: len(queue) for priority, queue in self._queues.items()},
+            'wait_p95': {priority: self._percentile(waits, 0.95) for priority, waits in self.waits.items()},
+            'retry_after': self.retry_after,
+            'blocked': self.blocked,
+            'chats': len(self._chats),
+        }
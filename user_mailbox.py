@@ -0,0 +1,119 @@
+"""
+Почтовый ящик пользователя: последовательная обработка апдейтов одного пользователя.
+aiogram запускает обработчики параллельно, поэтому несколько быстрых сообщений
+гонялись за одним контекстом и стоили несколько вызовов LLM. Ящик обрабатывает
+сообщения пользователя строго по очереди: первое - сразу, без ожидания, а пришедшие,
+пока ход пользователя уже обрабатывается, склеивает в следующий ход. Отказывает
+в приёме, когда очередь пользователя слишком длинная.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from typing import Optional, Dict, Any, List, Callable, Awaitable
+
+logger = logging.getLogger(__name__)
+
+
+class _Box:
+    __slots__ = ('pending', 'worker', 'overflow_notified')
+
+    def __init__(self):
+        # (элемент, future обработчика, который его прислал)
+        self.pending: deque = deque()
+        self.worker: Optional[asyncio.Task] = None
+        self.overflow_notified = False
+
+
+class UserMailbox:
+    """Очередь апдейтов на пользователя с одним обработчиком и склейкой сообщений"""
+
+    def __init__(self, handler: Callable[[int, List[Any]], Awaitable[None]], max_pending: int = 5,
+                 can_merge: Callable[[List[Any], Any], bool] = None,
+                 on_overflow: Callable[[int, Any], Awaitable[None]] = None):
+        """
+        Args:
+            handler: корутина (user_id, элементы) - обрабатывает пачку как один ход
+            max_pending: сколько сообщений может ждать в очереди пользователя
+            can_merge: (пачка, элемент) -> можно ли добавить элемент в пачку
+            on_overflow: корутина (user_id, элемент), вызывается один раз на переполнение
+        """
+        self.handler = handler
+        self.max_pending = max_pending
+        self.can_merge = can_merge
+        self.on_overflow = on_overflow
+        self._boxes: Dict[int, _Box] = {}
+        # Метрики
+        self.accepted = 0
+        self.batches = 0
+        self.coalesced = 0
+        self.rejected = 0
+
+    async def submit(self, user_id: int, item: Any) -> bool:
+        """Ставит элемент в очередь и ждёт его обработки; False - отклонён из-за переполнения.
+
+        Исключение обработчика пробрасывается тому, чьё сообщение завершило пачку.
+        """
+        box = self._boxes.get(user_id)
+        if box is None:
+            box = self._boxes[user_id] = _Box()
+        if len(box.pending) >= self.max_pending:
+            self.rejected += 1
+            if self.on_overflow and not box.overflow_notified:
+                box.overflow_notified = True
+                await self.on_overflow(user_id, item)
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        box.pending.append((item, future))
+        self.accepted += 1
+        if box.worker is None:
+            box.worker = asyncio.create_task(self._run(user_id, box))
+        await future
+        return True
+
+    async def _run(self, user_id: int, box: _Box):
+        try:
+            while box.pending:
+                # Ничего не ждём: в пачку попадает то, что накопилось за время предыдущего хода
+                batch = [box.pending.popleft()]
+                while box.pending and (self.can_merge is None or
+                                       self.can_merge([item for item, _ in batch], box.pending[0][0])):
+                    batch.append(box.pending.popleft())
+                box.overflow_notified = False
+                self.batches += 1
+                self.coalesced += len(batch) - 1
+                try:
+                    await self.handler(user_id, [item for item, _ in batch])
+                except Exception as e:
+                    *rest, (_, last) = batch
+                    for _, future in rest:
+                        if not future.done():
+                            future.set_result(None)
+                    if not last.done():
+                        last.set_exception(e)
+                else:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+        except asyncio.CancelledError:
+            for _, future in box.pending:
+                future.cancel()
+            raise
+        finally:
+            if self._boxes.get(user_id) is box:
+                del self._boxes[user_id]
+
+    def busy(self, user_id: int) -> bool:
+        """Есть ли у пользователя ход в обработке или в очереди"""
+        return user_id in self._boxes
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'active_users': len(self._boxes),
+            'queued': sum(len(box.pending) for box in self._boxes.values()),
+            'accepted': self.accepted,
+            'batches': self.batches,
+            'coalesced': self.coalesced,
+            'rejected': self.rejected,
+        }
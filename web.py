@@ -56,7 +56,7 @@ class Database:
 
 	async def get_all_users_basic(self) -> List[Dict[str, Any]]:
 		assert self._conn is not None
-		cursor = await self._conn.execute('SELECT id, username, name, last_active, current_model FROM users ORDER BY datetime(last_active) DESC')
+		cursor = await self._conn.execute('SELECT id, username, name, last_active, current_model FROM users ORDER BY last_active_at DESC')
 		users: List[Dict[str, Any]] = []
 		async for row in cursor:
 			users.append({
@@ -74,12 +74,14 @@ class Database:
 		row = await cursor.fetchone()
 		if not row:
 			return None
-		context_raw = row['context'] or '[]'
-		try:
-			import json
-			context = json.loads(context_raw)
-		except Exception:
-			context = []
+		cursor = await self._conn.execute(
+			'SELECT role, content, ts FROM context_turns WHERE user_id = ? ORDER BY seq',
+			(user_id,)
+		)
+		context = [
+			{'role': turn['role'], 'content': turn['content'], 'timestamp': turn['ts']}
+			async for turn in cursor
+		]
 		return {
 			'id': row['id'],
 			'username': row['username'],